@@ -0,0 +1,51 @@
+"""
+Integer codes for the categorical model features.
+
+The XGBoost model is trained on integer-coded categorical columns. The code tables are written
+once at training time to data/category_codes.json (next to model.xgb.bz2) by
+modeling/utils.py:save_category_codes, the training notebook calls it with the fitted OrdinalEncoder.
+The dashboard and the scenario engine (modeling/scenario_engine.py) only read this file, so they
+always use the order the model was trained with. The committed file belongs to the shipped model: its
+OrdinalEncoder sorted the categories of the training data, so every list is sorted.
+
+The file maps each categorical column to its list of categories, the position in the list is the code:
+
+    {"age": ["18-Jährige", "19-Jährige", ...], "education": [...], ...}
+
+There is no fallback: the codes can't be rebuilt from the population without knowing the order
+of the training, so a missing file is an error. Ship it together with model.xgb.bz2.
+"""
+import json
+import os
+import pandas as pd
+
+CAT_COLS = ["age", "education", "state", "gender", "sector", "nationality"]
+
+script_dir = os.path.dirname(__file__)
+category_codes_path = os.path.join(script_dir, 'data', 'category_codes.json')
+
+def load_category_codes(path=category_codes_path):
+    """Returns the code tables written at training time."""
+    if not os.path.exists(path):
+        raise FileNotFoundError(
+            f'{path} not found: the category codes are written by the training '
+            '(modeling/utils.py:save_category_codes) and have to be shipped with the model'
+        )
+    with open(path, encoding='utf-8') as f:
+        codes = json.load(f)
+    missing = [col for col in CAT_COLS if col not in codes]
+    if missing:
+        raise ValueError(f'{path} has no codes for {missing}')
+    return codes
+
+def encode_categories(df, codes):
+    """
+    Replace the categorical columns in df by their integer codes (in place).
+
+    The lookup is a vectorized hash lookup, so it doesn't matter how many rows df has.
+    Values that are not in the code table get -1.
+    """
+    for col, cats in codes.items():
+        if col in df.columns:
+            df[col] = pd.Categorical(df[col], categories=cats).codes
+    return df
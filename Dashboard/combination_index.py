@@ -0,0 +1,26 @@
+"""
+Lookup structure for the combinations of the prediction page.
+
+A combination is a tuple (sector, state, age, gender, nationality, education). The index maps each
+combination to the position of its template row (the row of the latest year), so a lookup is a
+dict access instead of filtering the whole population. The dropout history is read from the
+dropout cube (see dropout_cube.py).
+"""
+COMBO_COLS = ['sector', 'state', 'age', 'gender', 'nationality', 'education']
+
+class CombinationIndex:
+    def __init__(self, df):
+        """
+        Args:
+            df: Population with the model features, used for the template rows.
+        """
+        self.df = df
+        # position of the row with the latest year per combination
+        latest = df.groupby(COMBO_COLS, observed=True)['year'].idxmax()
+        self.template_pos = dict(zip(latest.index, df.index.get_indexer(latest.values)))
+
+    def template(self, combo):
+        """Template row of the latest year for combo, the first row if the combination doesn't exist."""
+        pos = self.template_pos.get(tuple(combo))
+        return self.df.iloc[0] if pos is None else self.df.iloc[pos]
+
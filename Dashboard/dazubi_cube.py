@@ -0,0 +1,138 @@
+"""
+Aggregation cube of the DAZUBI data for the Visualisierung page.
+
+The cube has the axes Jahr x Region x Beruf with one extra position at the end of Region and Beruf
+for the totals ("alle Regionen", "alle Berufe"). Each attribute is stored as its own array, so the page
+only reads the attributes it shows. It is stored in data/dazubi_cube/ as plain .npy files:
+
+    axes.json        categories of each axis (the position is the index in the arrays) and the attributes
+    present.npy      True if the base data has a row for the cell (or, for the totals, for one of its cells)
+    attribute_N.npy  sums of the N-th attribute (float32, float64 if float32 would round the values)
+
+The page answers each chart with DazubiCube.aggregate, which is the same as filtering the base data
+and grouping it by the given axes, but only sums the slice of the selected Regionen and Berufe.
+
+Usage (build the cube from data/dazubi_grouped_berufe.csv.bz2):
+
+    python Dashboard/dazubi_cube.py
+"""
+import argparse
+import json
+import os
+import numpy as np
+import pandas as pd
+
+script_dir = os.path.dirname(__file__)
+cube_dir = os.path.join(script_dir, 'data', 'dazubi_cube')
+dazubi_csv_path = os.path.join(script_dir, 'data', 'dazubi_grouped_berufe.csv.bz2')
+
+AXES = ['Jahr', 'Region', 'Beruf']
+# axes with a total at the last position
+TOTAL_AXES = ['Region', 'Beruf']
+
+class DazubiCube:
+    def __init__(self, axes, attributes, present, values):
+        self.axes = axes
+        self.attributes = attributes
+        self.present = present
+        self.values = values
+        self.positions = {col: {value: i for i, value in enumerate(values)} for col, values in axes.items()}
+
+    @classmethod
+    def load(cls, root=cube_dir):
+        """Memory-map the cube, returns None if it wasn't built yet."""
+        if not os.path.exists(os.path.join(root, 'axes.json')):
+            return None
+        with open(os.path.join(root, 'axes.json'), encoding='utf-8') as f:
+            meta = json.load(f)
+        present = np.load(os.path.join(root, 'present.npy'), mmap_mode='r')
+        values = {
+            attribute: np.load(os.path.join(root, f'attribute_{i}.npy'), mmap_mode='r')
+            for i, attribute in enumerate(meta['attributes'])
+        }
+        return cls(meta['axes'], meta['attributes'], present, values)
+
+    def save(self, root=cube_dir):
+        os.makedirs(root, exist_ok=True)
+        with open(os.path.join(root, 'axes.json'), 'w', encoding='utf-8') as f:
+            json.dump({'axes': self.axes, 'attributes': self.attributes}, f, ensure_ascii=False, indent=2)
+        np.save(os.path.join(root, 'present.npy'), np.asarray(self.present))
+        for i, attribute in enumerate(self.attributes):
+            np.save(os.path.join(root, f'attribute_{i}.npy'), np.asarray(self.values[attribute]))
+
+    def _index(self, col, selected, grouped):
+        """Positions of the selected categories on the axis col (all if selected is empty)."""
+        if selected:
+            return np.array(sorted(self.positions[col][value] for value in selected if value in self.positions[col]), dtype=int)
+        if grouped or col not in TOTAL_AXES:
+            return np.arange(len(self.axes[col]))
+        # the total of all categories
+        return np.array([len(self.axes[col])])
+
+    def aggregate(self, attributes, by, states=(), jobs=(), year=None):
+        """
+        Sums of the attributes grouped by the axes in by, answered from the cube. The same as
+
+            df[filters].groupby(by)[attributes].sum().reset_index()
+
+        on the base data, only groups with at least one row in the base data are returned.
+
+        Args:
+            attributes (list): Attributes to sum.
+            by (list): Axes to group by ('Jahr', 'Region', 'Beruf').
+            states, jobs: Only these Regionen / Berufe, all if empty.
+            year: Only this year (Jahr).
+        """
+        selected = {'Jahr': [] if year is None else [year], 'Region': list(states), 'Beruf': list(jobs)}
+        index = [self._index(col, selected[col], col in by) for col in AXES]
+        summed = tuple(i for i, col in enumerate(AXES) if col not in by)
+        mask = np.asarray(self.present[np.ix_(*index)]).any(axis=summed)
+        # the cells of the groups, in the order of groupby (the axes are sorted)
+        grid = np.meshgrid(*[np.asarray(self.axes[col])[index[AXES.index(col)]] for col in by], indexing='ij')
+        df = pd.DataFrame({col: labels[mask] for col, labels in zip(by, grid)})
+        for attribute in attributes:
+            values = np.asarray(self.values[attribute][np.ix_(*index)], dtype=np.float64).sum(axis=summed)
+            df[attribute] = values[mask]
+        return df
+
+def build_cube(df):
+    """
+    Aggregate the DAZUBI data (AXES and one column per attribute) into a DazubiCube (one np.bincount per attribute).
+    """
+    axes = {col: sorted(df[col].dropna().unique().tolist()) for col in AXES}
+    attributes = [col for col in df.columns if col not in AXES + ['Region_key']]
+    # one extra position for the totals of Region and Beruf
+    shape = tuple(len(axes[col]) + (col in TOTAL_AXES) for col in AXES)
+    codes = [pd.Categorical(df[col], categories=axes[col]).codes for col in AXES]
+    valid = np.logical_and.reduce([c >= 0 for c in codes])
+    flat = np.ravel_multi_index([c[valid] for c in codes], shape)
+    size = int(np.prod(shape))
+    n_regions, n_jobs = len(axes['Region']), len(axes['Beruf'])
+
+    present = np.bincount(flat, minlength=size).reshape(shape) > 0
+    present[:, n_regions, :] = present[:, :n_regions, :].any(axis=1)
+    present[:, :, n_jobs] = present[:, :, :n_jobs].any(axis=2)
+    values = {}
+    for attribute in attributes:
+        # like groupby().sum(), missing values count as 0
+        weights = np.nan_to_num(df[attribute].to_numpy(dtype=np.float64)[valid])
+        arr = np.bincount(flat, weights=weights, minlength=size).reshape(shape)
+        arr[:, n_regions, :] = arr[:, :n_regions, :].sum(axis=1)
+        arr[:, :, n_jobs] = arr[:, :, :n_jobs].sum(axis=2)
+        compact = arr.astype(np.float32)
+        values[attribute] = compact if np.array_equal(compact, arr) else arr
+    return DazubiCube(axes, attributes, present, values)
+
+def read_dazubi(path=dazubi_csv_path):
+    df = pd.read_csv(path, index_col=0)
+    return df.rename(columns={'Beruf_clean': 'Beruf'})
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Build the aggregation cube of the DAZUBI data for the Visualisierung page")
+    parser.add_argument('dazubi', nargs='?', default=dazubi_csv_path, help='CSV file with the grouped DAZUBI data')
+    parser.add_argument('-o', '--output', default=cube_dir, help='Directory of the cube')
+    args = parser.parse_args()
+    cube = build_cube(read_dazubi(args.dazubi))
+    cube.save(args.output)
+    size = sum(np.asarray(arr).nbytes for arr in cube.values.values())
+    print(f'Saved: {args.output} {cube.present.shape}, {len(cube.attributes)} attributes, {size / 1e6:.1f} MB')
@@ -0,0 +1,192 @@
+"""
+Persistent cache for predictions and aggregates on local disk.
+
+st.cache_data and st.cache_resource only live in the memory of one process, so they are lost on every
+redeploy and not shared between replicas on the same host. This cache stores pickled results in a
+SQLite file with LRU eviction and a size cap:
+
+    @st.cache_data          # in memory, per process
+    @cached(csv_path)       # on disk, shared
+    def load_dataframe():
+        ...
+
+The key of an entry contains the function and its source code, its arguments (except the ones starting
+with an underscore, like st.cache_data) and a fingerprint (sha256) of the files it depends on. So the entries
+are invalidated automatically when new data is deployed. The model is a dependency like the data files, only
+functions that use it list it, so a new model doesn't invalidate the other entries:
+
+    @cached(model_path, population_dir)
+    def predict_something():
+        ...
+
+The fingerprints are memoized per process: they are only computed again if the modification time
+of one of the files or directories changes, or at the latest after DASHBOARD_FINGERPRINT_TTL seconds
+(files changed inside a directory don't change its modification time). So a request doesn't walk the
+data directories.
+
+The location and the size are configured with the environment variables DASHBOARD_CACHE_DIR and
+DASHBOARD_CACHE_MB.
+"""
+import contextlib
+import functools
+import hashlib
+import inspect
+import os
+import pickle
+import sqlite3
+import threading
+import time
+
+script_dir = os.path.dirname(__file__)
+model_path = os.path.join(script_dir, 'data', 'model.xgb.bz2')
+
+cache_dir = os.environ.get('DASHBOARD_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'fa_dashboard'))
+cache_max_bytes = int(os.environ.get('DASHBOARD_CACHE_MB', 512)) * 1024 ** 2
+fingerprint_ttl = float(os.environ.get('DASHBOARD_FINGERPRINT_TTL', 60))
+
+MISSING = object()
+
+class DiskCache:
+    def __init__(self, path=None, max_bytes=cache_max_bytes):
+        self.path = path or os.path.join(cache_dir, 'cache.sqlite')
+        self.max_bytes = max_bytes
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        # one connection for all threads of the process, the lock serializes its use
+        self._con = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        self._lock = threading.Lock()
+        self._hashes = {}
+        self._fingerprints = {}
+        with self._connect() as con:
+            con.execute('PRAGMA journal_mode=WAL')
+            con.execute('CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, value BLOB, size INTEGER, accessed REAL)')
+            con.execute('CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)')
+            con.execute('CREATE TABLE IF NOT EXISTS file_hashes (path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, sha256 TEXT)')
+
+    @contextlib.contextmanager
+    def _connect(self):
+        # a transaction on the shared connection, the cache is used from the threads of all sessions
+        with self._lock, self._con:
+            yield self._con
+
+    def close(self):
+        with self._lock:
+            self._con.close()
+
+    def get(self, key, default=MISSING):
+        """Value of key (and mark it as recently used), `default` if it isn't cached."""
+        with self._connect() as con:
+            row = con.execute('SELECT value FROM entries WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return default
+            con.execute('UPDATE entries SET accessed = ? WHERE key = ?', (time.time(), key))
+        return pickle.loads(row[0])
+
+    def set(self, key, value):
+        """Store value, the least recently used entries are evicted if the cache gets bigger than max_bytes."""
+        blob = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        if len(blob) > self.max_bytes:
+            return
+        with self._connect() as con:
+            con.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)', (key, blob, len(blob), time.time()))
+            con.execute("""
+                DELETE FROM entries WHERE key IN (
+                    SELECT key FROM (SELECT key, SUM(size) OVER (ORDER BY accessed DESC) AS total FROM entries)
+                    WHERE total > ?
+                )""", (self.max_bytes,))
+
+    def clear(self):
+        with self._connect() as con:
+            con.execute('DELETE FROM entries')
+
+    def file_hash(self, path):
+        """sha256 of a file, only computed again if its size or modification time changed."""
+        stat = os.stat(path)
+        file_key = (path, stat.st_size, stat.st_mtime_ns)
+        if file_key in self._hashes:
+            return self._hashes[file_key]
+        with self._connect() as con:
+            row = con.execute('SELECT sha256 FROM file_hashes WHERE path = ? AND size = ? AND mtime = ?', file_key).fetchone()
+        if row is None:
+            sha = hashlib.sha256()
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1024 ** 2), b''):
+                    sha.update(chunk)
+            row = (sha.hexdigest(),)
+            with self._connect() as con:
+                con.execute('INSERT OR REPLACE INTO file_hashes VALUES (?, ?, ?, ?)', (*file_key, row[0]))
+        self._hashes[file_key] = row[0]
+        return row[0]
+
+    def fingerprint(self, paths):
+        """
+        Hash of the given files or directories (missing ones are part of the hash as well).
+
+        The result is memoized, see the module docstring.
+        """
+        paths = tuple(os.path.abspath(path) for path in paths)
+        stamp = tuple(_stat(path) for path in paths)
+        now = time.monotonic()
+        memo = self._fingerprints.get(paths)
+        if memo is not None and memo[1] == stamp and now - memo[0] < fingerprint_ttl:
+            return memo[2]
+        sha = hashlib.sha256()
+        for path in paths:
+            if os.path.isdir(path):
+                files = sorted(os.path.join(root, name) for root, _, names in os.walk(path) for name in names)
+            else:
+                files = [path]
+            for file in files:
+                digest = self.file_hash(file) if os.path.exists(file) else 'missing'
+                sha.update(f'{os.path.relpath(file, script_dir)}:{digest}\n'.encode())
+        self._fingerprints[paths] = (now, stamp, sha.hexdigest())
+        return sha.hexdigest()
+
+def _stat(path):
+    """(modification time, size) of a file or directory, None if it doesn't exist."""
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+_cache = None
+_cache_lock = threading.Lock()
+
+def get_cache():
+    """The DiskCache of this process (created on first use)."""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = DiskCache()
+        return _cache
+
+def make_key(*parts):
+    """Key of an entry from picklable parts."""
+    return hashlib.sha256(pickle.dumps(parts, protocol=4)).hexdigest()
+
+def cached(*files):
+    """
+    Decorator: cache the results of the function on disk.
+
+    Args:
+        files: Data files or directories the result depends on, model_path if it uses the model.
+    """
+    def decorator(func):
+        signature = inspect.signature(func)
+        # a changed implementation must not return the results of the old one
+        source = inspect.getsource(func)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            cache = get_cache()
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            hashed_args = {name: value for name, value in bound.arguments.items() if not name.startswith('_')}
+            key = make_key(func.__module__, func.__qualname__, source, cache.fingerprint(files), hashed_args)
+            value = cache.get(key)
+            if value is MISSING:
+                value = func(*args, **kwargs)
+                cache.set(key, value)
+            return value
+        return wrapper
+    return decorator
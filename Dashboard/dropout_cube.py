@@ -0,0 +1,119 @@
+"""
+Dense cube of the dropouts per combination and year.
+
+The cube has one axis per combination column (sector, state, age, gender, nationality, education)
+and one for the year. It is stored in data/dropout_cube/ as plain .npy files, so the dashboard
+and the notebooks can memory-map it and only read the slice of one combination:
+
+    axes.json     categories of each axis (the position is the index in the arrays)
+    count.npy     number of synthetic apprentices per cell (uint32)
+    dropouts.npy  number of them with dropped_out == 1 (uint32)
+
+Usage (build the cube from the synthetic population):
+
+    python Dashboard/dropout_cube.py
+
+In a notebook:
+
+    sys.path.append('../Dashboard')
+    from dropout_cube import DropoutCube
+    cube = DropoutCube.load()
+    cube.to_frame()
+"""
+import argparse
+import json
+import os
+import numpy as np
+import pandas as pd
+from combination_index import COMBO_COLS
+from population import WEIGHT_COL, read_population
+
+script_dir = os.path.dirname(__file__)
+cube_dir = os.path.join(script_dir, 'data', 'dropout_cube')
+
+AXES = COMBO_COLS + ['year']
+
+class DropoutCube:
+    def __init__(self, axes, count, dropouts):
+        self.axes = axes
+        self.count = count
+        self.dropouts = dropouts
+        self.positions = {col: {value: i for i, value in enumerate(values)} for col, values in axes.items()}
+
+    @classmethod
+    def load(cls, root=cube_dir):
+        """Memory-map the cube, returns None if it wasn't built yet."""
+        if not os.path.exists(os.path.join(root, 'axes.json')):
+            return None
+        with open(os.path.join(root, 'axes.json'), encoding='utf-8') as f:
+            axes = json.load(f)
+        count = np.load(os.path.join(root, 'count.npy'), mmap_mode='r')
+        dropouts = np.load(os.path.join(root, 'dropouts.npy'), mmap_mode='r')
+        return cls(axes, count, dropouts)
+
+    def save(self, root=cube_dir):
+        os.makedirs(root, exist_ok=True)
+        with open(os.path.join(root, 'axes.json'), 'w', encoding='utf-8') as f:
+            json.dump(self.axes, f, ensure_ascii=False, indent=2)
+        np.save(os.path.join(root, 'count.npy'), np.asarray(self.count))
+        np.save(os.path.join(root, 'dropouts.npy'), np.asarray(self.dropouts))
+
+    def mean(self):
+        """Dropout rate (0 - 1) of all cells, NaN for empty cells."""
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(self.count > 0, self.dropouts / self.count, np.nan)
+
+    def history(self, combo, min_year=None, max_year=None):
+        """
+        Years and dropout rates (0 - 1) of one combination, only years with data are returned.
+
+        Only the slice of the combination is read, empty arrays if the combination doesn't exist.
+        """
+        try:
+            idx = tuple(self.positions[col][value] for col, value in zip(COMBO_COLS, combo))
+        except KeyError:
+            return np.array([], dtype=int), np.array([])
+        years = np.asarray(self.axes['year'])
+        count = np.asarray(self.count[idx])
+        dropouts = np.asarray(self.dropouts[idx])
+        mask = count > 0
+        if min_year is not None:
+            mask &= years >= min_year
+        if max_year is not None:
+            mask &= years <= max_year
+        return years[mask], dropouts[mask] / count[mask]
+
+    def to_frame(self):
+        """Long DataFrame with one row per non-empty cell (AXES, count, dropouts, dropout_rate)."""
+        idx = np.nonzero(np.asarray(self.count))
+        df = pd.DataFrame({col: np.asarray(self.axes[col], dtype=object)[i] for col, i in zip(AXES, idx)})
+        df['count'] = np.asarray(self.count)[idx]
+        df['dropouts'] = np.asarray(self.dropouts)[idx]
+        df['dropout_rate'] = df['dropouts'] / df['count']
+        return df
+
+def build_cube(df):
+    """
+    Aggregate a population with AXES and dropped_out into a DropoutCube (one pass with np.bincount).
+
+    A population of weighted profiles (column weight) is aggregated with its weights.
+    """
+    axes = {col: sorted(df[col].dropna().unique().tolist()) for col in AXES}
+    shape = tuple(len(axes[col]) for col in AXES)
+    codes = [pd.Categorical(df[col], categories=axes[col]).codes for col in AXES]
+    valid = np.logical_and.reduce([c >= 0 for c in codes])
+    flat = np.ravel_multi_index([c[valid] for c in codes], shape)
+    size = int(np.prod(shape))
+    weights = df[WEIGHT_COL].to_numpy()[valid] if WEIGHT_COL in df.columns else None
+    dropped_out = df['dropped_out'].to_numpy()[valid]
+    count = np.bincount(flat, weights=weights, minlength=size)
+    dropouts = np.bincount(flat, weights=dropped_out if weights is None else dropped_out * weights, minlength=size)
+    return DropoutCube(axes, count.astype(np.uint32).reshape(shape), dropouts.astype(np.uint32).reshape(shape))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Build the dropout cube from the synthetic population")
+    parser.add_argument('-o', '--output', default=cube_dir, help='Directory of the cube')
+    args = parser.parse_args()
+    cube = build_cube(read_population(columns=AXES + ['dropped_out'], weights=True))
+    cube.save(args.output)
+    print(f'Saved: {args.output} {cube.count.shape}')
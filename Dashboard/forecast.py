@@ -0,0 +1,414 @@
+"""
+Forecasts of the dropout rate per combination.
+
+Fitting a forecaster takes time (Prophet runs a Stan optimization per combination), but the history
+only changes when the synthetic population is regenerated. So the forecasts of all observed
+combinations are fitted once by a batch job and written to data/forecasts.parquet, one row per
+combination and prediction year:
+
+    sector | state | age | gender | nationality | education | year | yhat
+
+The Parquet metadata of the table records the forecaster, its parameters, the history and prediction
+years and the fingerprint of the history data (the dropout cube and the population). The dashboard only
+uses the table if all of them match its configuration and data, looks the forecasts up and only fits
+combinations that are missing in the table.
+
+There are three forecasters, selected with the environment variable FORECASTER (or --backend for the
+batch job):
+
+    prophet  Prophet with yearly seasonality, one fit per combination (in a process pool)
+    linear   least-squares linear trend, all combinations in one vectorized call
+    holt     damped Holt exponential smoothing, all combinations in one vectorized call
+
+The histories have at most 10 yearly points, so the cheap forecasters are good candidates.
+--compare runs a backtest (the last years of the history are held out) of all forecasters. The
+parameters of Holt are fitted in the backtest as well (grid search on the years before the held-out
+years) and can be set with the environment variable HOLT_PARAMS, e.g. HOLT_PARAMS='{"alpha": 0.3,
+"beta": 0.1, "phi": 0.9}'. The report of the backtest is written next to the table
+(data/forecast_comparison.txt), the backend is only switched on its results.
+
+Usage (after building the dropout cube):
+
+    python Dashboard/forecast.py --workers 8
+    FORECASTER=linear python Dashboard/forecast.py
+    python Dashboard/forecast.py --compare 200
+"""
+import argparse
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, wait
+from itertools import repeat
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from combination_index import COMBO_COLS
+from disk_cache import get_cache
+from dropout_cube import DropoutCube, cube_dir
+from population import population_dir
+
+# === Parameters for historical and prediction years ===
+min_year = 2010  # Start year for historical data used in Prophet
+max_year = 2019  # End year for historical data because of the COVID year (adjust as needed)
+prediction_years = list(range(2025, 2031))  # Forecast years for the plot and metrics
+
+# === Forecaster configuration ===
+FORECASTER_LABELS = {'prophet': 'Prophet', 'linear': 'linearer Trend', 'holt': 'Holt'}
+# Prophet stays the default until a backtest on the production data shows that a cheaper one is as good
+FORECASTER = os.environ.get('FORECASTER', 'prophet')  # 'prophet', 'linear' or 'holt'
+if FORECASTER not in FORECASTER_LABELS:
+    raise ValueError(f'Unknown forecaster: {FORECASTER}')
+# smoothing of level and trend, damping of the trend (set the values fitted by --compare with HOLT_PARAMS)
+HOLT_PARAMS = json.loads(os.environ.get('HOLT_PARAMS', '{"alpha": 0.5, "beta": 0.3, "phi": 0.8}'))
+# parameters tried by fit_holt_params
+HOLT_GRID = dict(alpha=[0.1, 0.3, 0.5, 0.7, 0.9], beta=[0.05, 0.1, 0.3, 0.5], phi=[0.7, 0.8, 0.9, 0.98])
+FORECAST_WORKERS = int(os.environ.get('FORECAST_WORKERS', os.cpu_count() or 1))  # processes for on-demand Prophet fits
+FORECAST_TIMEOUT = 30  # seconds per request, unfinished fits fall back to the model prediction
+
+script_dir = os.path.dirname(__file__)
+forecast_path = os.path.join(script_dir, 'data', 'forecasts.parquet')
+comparison_path = os.path.join(script_dir, 'data', 'forecast_comparison.txt')
+# key of the Parquet metadata with the configuration of the table
+METADATA_KEY = b'forecast'
+
+logger = logging.getLogger(__name__)
+
+def history_fingerprint():
+    """Fingerprint of the data the histories come from (the dropout cube, the population if it isn't built)."""
+    return get_cache().fingerprint([cube_dir, population_dir])
+
+def forecast_config(backend=None, fingerprint=None):
+    """Everything a forecast depends on besides the combination, stored with the precomputed table."""
+    backend = backend or FORECASTER
+    return {
+        'backend': backend,
+        'params': HOLT_PARAMS if backend == 'holt' else {},
+        'min_year': min_year,
+        'max_year': max_year,
+        'prediction_years': prediction_years,
+        'data': history_fingerprint() if fingerprint is None else fingerprint,
+    }
+
+def prophet_forecast(years, rates, target_years=prediction_years):
+    """
+    Prophet forecast of the dropout rate (in %) for `target_years`, NaN if there is too little history.
+
+    `years` and `rates` are the history of one combination (min_year - max_year), the rates as fraction.
+    """
+    if len(years) < 2:
+        return np.full(len(target_years), np.nan)
+
+    from prophet import Prophet
+    logging.getLogger("prophet").setLevel(logging.WARNING)
+    logging.getLogger("cmdstanpy").setLevel(logging.WARNING)
+
+    prophet_df = pd.DataFrame({
+        "ds": pd.to_datetime(pd.Series(years), format='%Y'),
+        "y": rates * 100  # in %
+    })
+    m = Prophet(
+        yearly_seasonality=True,
+        weekly_seasonality=False,
+        daily_seasonality=False
+    )
+    m.fit(prophet_df)
+    future = pd.DataFrame({"ds": pd.to_datetime(list(target_years), format='%Y')})
+    forecast = m.predict(future)
+    return np.clip(forecast["yhat"].values, 0, 100)
+
+def history_matrix(histories, history_years):
+    """
+    Dense matrix of the histories.
+
+    Returns the rates (in %) and a mask of the observed years, both of shape (len(histories), len(history_years)).
+    """
+    history_years = np.asarray(history_years)
+    rates = np.zeros((len(histories), len(history_years)))
+    mask = np.zeros(rates.shape, dtype=bool)
+    for i, (years, values) in enumerate(histories):
+        years = np.asarray(years)
+        inside = np.isin(years, history_years)
+        pos = np.searchsorted(history_years, years[inside])
+        rates[i, pos] = np.asarray(values)[inside] * 100
+        mask[i, pos] = True
+    return rates, mask
+
+def linear_forecast(histories, history_years, target_years):
+    """Least-squares linear trend of each history, fitted for all histories at once."""
+    rates, mask = history_matrix(histories, history_years)
+    t = np.asarray(history_years, dtype=float)
+    n = mask.sum(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t_mean = (mask * t).sum(axis=1) / n
+        y_mean = (mask * rates).sum(axis=1) / n
+        dt = np.where(mask, t - t_mean[:, None], 0)
+        slope = (dt * (rates - y_mean[:, None])).sum(axis=1) / (dt ** 2).sum(axis=1)
+    preds = y_mean[:, None] + slope[:, None] * (np.asarray(target_years, dtype=float) - t_mean[:, None])
+    preds[n < 2] = np.nan
+    return np.clip(preds, 0, 100)
+
+def holt_forecast(histories, history_years, target_years, alpha=None, beta=None, phi=None):
+    """
+    Damped Holt exponential smoothing of each history, vectorized over the histories.
+
+    Missing years are bridged by the damped trend, the smoothing starts at the first observed year.
+    """
+    alpha = HOLT_PARAMS['alpha'] if alpha is None else alpha
+    beta = HOLT_PARAMS['beta'] if beta is None else beta
+    phi = HOLT_PARAMS['phi'] if phi is None else phi
+    rates, mask = history_matrix(histories, history_years)
+    level = np.full(len(rates), np.nan)
+    trend = np.zeros(len(rates))
+    for t in range(rates.shape[1]):
+        y, observed = rates[:, t], mask[:, t]
+        started = ~np.isnan(level)
+        predicted = level + phi * trend
+        new_level = alpha * y + (1 - alpha) * predicted
+        new_trend = beta * (new_level - level) + (1 - beta) * phi * trend
+        update = observed & started
+        level = np.where(observed & ~started, y, np.where(update, new_level, predicted))
+        trend = np.where(update, new_trend, np.where(started, phi * trend, 0))
+    # damped trend h steps after the last history year: (phi + phi^2 + ... + phi^h) * trend
+    h = np.asarray(target_years) - history_years[-1]
+    damping = np.array([np.sum(phi ** np.arange(1, k + 1)) for k in h])
+    preds = level[:, None] + damping[None, :] * trend[:, None]
+    preds[mask.sum(axis=1) < 2] = np.nan
+    return np.clip(preds, 0, 100)
+
+def _fit_prophet(history, target_years):
+    return prophet_forecast(*history, target_years)
+
+def forecast_batch(histories, backend=None, history_years=None, target_years=None, workers=None):
+    """
+    Forecasts (in %) of all histories with the given backend (default: FORECASTER).
+
+    `histories` is a list of (years, rates) pairs as returned by DropoutCube.history.
+    Returns an array of shape (len(histories), len(target_years)), NaN for too short histories.
+    Prophet is fitted in a process pool with `workers` processes (sequentially for workers=1).
+    """
+    backend = backend or FORECASTER
+    history_years = list(range(min_year, max_year + 1)) if history_years is None else list(history_years)
+    target_years = prediction_years if target_years is None else list(target_years)
+    if backend == 'linear':
+        return linear_forecast(histories, history_years, target_years)
+    if backend == 'holt':
+        return holt_forecast(histories, history_years, target_years)
+    if backend != 'prophet':
+        raise ValueError(f'Unknown forecaster: {backend}')
+    if workers == 1:
+        preds = [prophet_forecast(*history, target_years) for history in histories]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            preds = list(executor.map(_fit_prophet, histories, repeat(target_years), chunksize=16))
+    return np.array(preds, dtype=float).reshape(len(histories), len(target_years))
+
+class ProphetPool:
+    """
+    Process pool for the on-demand Prophet fits, shared by all requests of the process.
+
+    A fit is submitted once per key: while it is queued or running, requests for the same key wait for
+    the same future instead of fitting it again. Every fit that finishes is passed to on_done(key, yhat)
+    (e.g. DiskCache.set), also if the request that submitted it has timed out, so its work isn't lost.
+    """
+    def __init__(self, workers=None, on_done=None, mp_context=None):
+        self.executor = ProcessPoolExecutor(max_workers=workers, mp_context=mp_context)
+        self.on_done = on_done
+        self.inflight = {}
+        # reentrant, the callback runs in the submitting thread if the future is already done
+        self.lock = threading.RLock()
+
+    def submit(self, key, history, target_years=prediction_years):
+        """Future of the Prophet fit of `history` (an existing one if the key is in flight)."""
+        with self.lock:
+            future = self.inflight.get(key)
+            if future is None:
+                future = self.executor.submit(prophet_forecast, *history, target_years)
+                self.inflight[key] = future
+                future.add_done_callback(lambda f, key=key: self._done(key, f))
+            return future
+
+    def _done(self, key, future):
+        with self.lock:
+            self.inflight.pop(key, None)
+        if self.on_done is not None and not future.cancelled() and future.exception() is None:
+            try:
+                self.on_done(key, future.result())
+            except Exception:
+                logger.exception('Storing the forecast failed')
+
+def parallel_prophet(pool, histories, keys, target_years=prediction_years, timeout=None):
+    """
+    Fit Prophet for all histories in `pool` (a ProphetPool shared by all requests), `keys` identify the fits.
+
+    Fits that are not finished after `timeout` seconds (for all histories together) are NaN for this
+    request, they keep running in the pool and their results are passed to its on_done.
+    Returns the forecasts in the order of `histories` and a mask of the finished fits.
+    """
+    futures = [pool.submit(key, history, target_years) if len(history[0]) >= 2 else None
+               for key, history in zip(keys, histories)]
+    wait([future for future in futures if future is not None], timeout=timeout)
+    preds = np.full((len(histories), len(target_years)), np.nan)
+    finished = np.ones(len(histories), dtype=bool)
+    for i, future in enumerate(futures):
+        if future is None:
+            continue  # too little history, NaN is the result
+        if future.done() and not future.cancelled() and future.exception() is None:
+            preds[i] = future.result()
+        else:
+            finished[i] = False
+    return preds, finished
+
+def observed_combinations(cube):
+    """All combinations with at least two years of history in min_year - max_year."""
+    years = np.asarray(cube.axes['year'])
+    in_range = (years >= min_year) & (years <= max_year)
+    n_years = (np.asarray(cube.count)[..., in_range] > 0).sum(axis=-1)
+    idx = np.nonzero(n_years >= 2)
+    return list(zip(*(np.asarray(cube.axes[col], dtype=object)[i] for col, i in zip(COMBO_COLS, idx))))
+
+def fit_forecasts(cube, combinations, backend=None, workers=None):
+    """Forecasts of all combinations for `prediction_years`, an array (len(combinations), len(prediction_years))."""
+    histories = [cube.history(combo, min_year, max_year) for combo in combinations]
+    return forecast_batch(histories, backend, workers=workers)
+
+def split_histories(histories, years, holdout):
+    """Split histories into the first years (train) and the last `holdout` years (test) of `years`."""
+    train_years, test_years = list(years[:-holdout]), list(years[-holdout:])
+    train = [(np.asarray(y)[np.isin(y, train_years)], np.asarray(r)[np.isin(y, train_years)]) for y, r in histories]
+    actual, observed = history_matrix(histories, test_years)
+    return train, train_years, test_years, actual, observed
+
+def backtest_errors(preds, actual, observed):
+    """Errors (in percentage points) of the forecasts of the observed held-out years."""
+    valid = observed & ~np.isnan(preds)
+    return (preds - actual)[valid]
+
+def fit_holt_params(histories, history_years, holdout=3, grid=HOLT_GRID):
+    """
+    Holt parameters with the smallest MAE of the last `holdout` years of `history_years`,
+    fitted on the years before (grid search, vectorized over the histories).
+
+    Returns the parameters and their MAE.
+    """
+    train, train_years, test_years, actual, observed = split_histories(histories, list(history_years), holdout)
+    best, best_mae = None, np.inf
+    for alpha in grid['alpha']:
+        for beta in grid['beta']:
+            for phi in grid['phi']:
+                errors = backtest_errors(holt_forecast(train, train_years, test_years, alpha, beta, phi), actual, observed)
+                mae = np.abs(errors).mean() if len(errors) else np.inf
+                if mae < best_mae:
+                    best, best_mae = dict(alpha=alpha, beta=beta, phi=phi), mae
+    return best, best_mae
+
+def compare_forecasters(cube, combinations, holdout=3, workers=None):
+    """
+    Backtest of all forecasters on the given combinations.
+
+    The forecasters are fitted on min_year - (max_year - holdout) and compared with the observed rates
+    of the held-out years (MAE and RMSE in percentage points). Holt is run with HOLT_PARAMS and with
+    parameters fitted by fit_holt_params on the training years only (so the held-out years stay unseen).
+    MAE_vs_prophet compares the forecasts for `prediction_years` with the Prophet forecasts.
+
+    Returns the results and the fitted Holt parameters.
+    """
+    history_years = list(range(min_year, max_year + 1))
+    full = [cube.history(combo, min_year, max_year) for combo in combinations]
+    train, train_years, test_years, actual, observed = split_histories(full, history_years, holdout)
+    fitted_params, _ = fit_holt_params(train, train_years, holdout)
+
+    backends = {
+        'prophet': lambda h, years, target: forecast_batch(h, 'prophet', years, target, workers),
+        'linear': lambda h, years, target: forecast_batch(h, 'linear', years, target),
+        'holt': lambda h, years, target: holt_forecast(h, years, target),
+        'holt (fitted)': lambda h, years, target: holt_forecast(h, years, target, **fitted_params),
+    }
+    results, future = [], {}
+    for name, forecaster in backends.items():
+        start = time.time()
+        errors = backtest_errors(forecaster(train, train_years, test_years), actual, observed)
+        future[name] = forecaster(full, history_years, prediction_years)
+        results.append({
+            'backend': name,
+            'n': len(errors),
+            'MAE': np.abs(errors).mean(),
+            'RMSE': np.sqrt((errors ** 2).mean()),
+            'seconds': time.time() - start
+        })
+    for result in results:
+        diff = future[result['backend']] - future['prophet']
+        result['MAE_vs_prophet'] = np.nanmean(np.abs(diff))
+    return pd.DataFrame(results), fitted_params
+
+def save_forecasts(combinations, preds, config, path=forecast_path):
+    """Write the forecasts with `config` (see forecast_config) as metadata."""
+    df = pd.DataFrame(np.repeat(np.array(combinations, dtype=object), len(prediction_years), axis=0), columns=COMBO_COLS)
+    df['year'] = np.tile(prediction_years, len(combinations)).astype('int16')
+    df['yhat'] = preds.ravel()
+    for col in COMBO_COLS:
+        df[col] = df[col].astype('category')
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    table = table.replace_schema_metadata({**table.schema.metadata, METADATA_KEY: json.dumps(config).encode()})
+    pq.write_table(table, path)
+
+def load_forecasts(path=forecast_path, backend=None):
+    """
+    Precomputed forecasts as dict combination -> yhat array (in the order of `prediction_years`).
+
+    Returns an empty dict if the table doesn't exist or was computed with another forecaster (default:
+    FORECASTER), other parameters or years, or from other data than the current history.
+    """
+    if not os.path.exists(path):
+        return {}
+    metadata = pq.read_schema(path).metadata or {}
+    config = json.loads(metadata[METADATA_KEY]) if METADATA_KEY in metadata else None
+    if config != forecast_config(backend):
+        logger.warning('%s was computed with another forecaster or from other data, it is not used', path)
+        return {}
+    df = pd.read_parquet(path).sort_values(COMBO_COLS + ['year'])
+    if sorted(df['year'].unique()) != prediction_years:
+        return {}
+    # every combination has exactly one row per prediction year
+    keys = df[COMBO_COLS].iloc[::len(prediction_years)].itertuples(index=False, name=None)
+    return dict(zip(keys, df['yhat'].to_numpy().reshape(-1, len(prediction_years))))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Fit the forecasts of all observed combinations")
+    parser.add_argument('-b', '--backend', default=FORECASTER, choices=['prophet', 'linear', 'holt'], help='Forecaster')
+    parser.add_argument('-w', '--workers', type=int, default=None, help='Number of processes for Prophet (default: all cores)')
+    parser.add_argument('-o', '--output', default=forecast_path, help='Path of the Parquet file')
+    parser.add_argument('--compare', type=int, metavar='N', help='Backtest all forecasters on N random combinations instead')
+    parser.add_argument('--holdout', type=int, default=3, help='Number of held-out years for --compare')
+    parser.add_argument('--report', default=comparison_path, help='Text file for the results of --compare')
+    args = parser.parse_args()
+    cube = DropoutCube.load()
+    if cube is None:
+        raise SystemExit('Dropout cube not found, run Dashboard/dropout_cube.py first')
+    combinations = observed_combinations(cube)
+    if args.compare:
+        rng = np.random.default_rng(0)
+        sample = [combinations[i] for i in rng.choice(len(combinations), min(args.compare, len(combinations)), replace=False)]
+        results, fitted_params = compare_forecasters(cube, sample, args.holdout, args.workers)
+        report = '\n'.join([
+            f'Backtest of {len(sample)} combinations, held-out years {max_year - args.holdout + 1}-{max_year}',
+            f'data: {history_fingerprint()}',
+            f'HOLT_PARAMS: {json.dumps(HOLT_PARAMS)}',
+            f'fitted Holt parameters: {json.dumps(fitted_params)}',
+            '',
+            results.to_string(index=False),
+        ])
+        print(report)
+        with open(args.report, 'w', encoding='utf-8') as f:
+            f.write(report + '\n')
+        print(f'Saved: {args.report}')
+    else:
+        print(f'Fitting {len(combinations)} combinations ({args.backend})')
+        # the fingerprint of the data before fitting, so a cube rebuilt during the fits doesn't match
+        config = forecast_config(args.backend)
+        save_forecasts(combinations, fit_forecasts(cube, combinations, args.backend, args.workers), config, args.output)
+        if args.backend != FORECASTER:
+            print(f'Note: the dashboard uses {FORECASTER}, it ignores a table of {args.backend}')
+        print(f'Saved: {args.output}')
@@ -0,0 +1,144 @@
+"""
+Packaging of the XGBoost model for the dashboard.
+
+model.xgb.bz2 is the model as written by the training notebooks. bz2 is slow to decompress, so the
+packaging step writes the booster as UBJSON, optionally compressed with zstd or lz4, together with a
+manifest (data/model_artifact.json):
+
+    {"file": "model.ubj.zst", "format": "ubj", "codec": "zstd", "sha256": "...", "source_sha256": "..."}
+
+sha256 is the hash of the UBJSON bytes, source_sha256 the hash of model.xgb.bz2 the artifact was built
+from. The loader checks both, so a corrupt or outdated artifact is never used (model.xgb.bz2 is loaded
+instead). Uncompressed artifacts are read by XGBoost directly from the file, compressed ones are
+decompressed as a stream.
+
+Usage:
+
+    python Dashboard/model_artifact.py                # UBJSON without compression
+    python Dashboard/model_artifact.py --codec zstd   # needs the zstandard package
+"""
+import argparse
+import bz2
+import hashlib
+import json
+import logging
+import mmap
+import os
+import numpy as np
+import xgboost as xgb
+
+script_dir = os.path.dirname(__file__)
+model_path = os.path.join(script_dir, 'data', 'model.xgb.bz2')
+manifest_path = os.path.join(script_dir, 'data', 'model_artifact.json')
+
+CODECS = {None: '', 'zstd': '.zst', 'lz4': '.lz4'}
+
+logger = logging.getLogger(__name__)
+
+def file_sha256(path):
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        return hashlib.sha256(data).hexdigest()
+
+def compress(raw, codec):
+    if codec == 'zstd':
+        import zstandard
+        return zstandard.ZstdCompressor(level=19).compress(raw)
+    if codec == 'lz4':
+        import lz4.frame
+        return lz4.frame.compress(raw, compression_level=lz4.frame.COMPRESSIONLEVEL_MAX)
+    return raw
+
+def decompress_stream(f, codec):
+    """Read and decompress the file object f."""
+    if codec == 'zstd':
+        import zstandard
+        with zstandard.ZstdDecompressor().stream_reader(f) as reader:
+            return reader.read()
+    if codec == 'lz4':
+        import lz4.frame
+        with lz4.frame.open(f, 'rb') as reader:
+            return reader.read()
+    return f.read()
+
+def load_bz2_model(path=model_path):
+    model = xgb.Booster()
+    with bz2.open(path, 'rb') as f:
+        model.load_model(bytearray(f.read()))
+    return model
+
+def package_model(codec=None, source=model_path, manifest=manifest_path):
+    """Write the booster of `source` as (compressed) UBJSON next to the manifest and return the manifest."""
+    raw = bytes(load_bz2_model(source).save_raw('ubj'))
+    file_name = 'model.ubj' + CODECS[codec]
+    with open(os.path.join(os.path.dirname(manifest), file_name), 'wb') as f:
+        f.write(compress(raw, codec))
+    info = {
+        'file': file_name,
+        'format': 'ubj',
+        'codec': codec,
+        'sha256': hashlib.sha256(raw).hexdigest(),
+        'source_sha256': file_sha256(source),
+    }
+    with open(manifest, 'w', encoding='utf-8') as f:
+        json.dump(info, f, indent=2)
+    return info
+
+def prewarm(model):
+    """Run one prediction, so the first request doesn't pay for the initialization of the booster."""
+    model.predict(xgb.DMatrix(np.zeros((1, model.num_features())), feature_names=model.feature_names))
+
+def load_artifact(manifest=manifest_path, source=model_path):
+    """Packaged booster, None if there is no artifact or it is outdated, corrupt or can't be decompressed."""
+    if not os.path.exists(manifest):
+        return None
+    with open(manifest, encoding='utf-8') as f:
+        info = json.load(f)
+    path = os.path.join(os.path.dirname(manifest), info['file'])
+    if not os.path.exists(path):
+        logger.warning('%s is missing', info['file'])
+        return None
+    if info['source_sha256'] != file_sha256(source):
+        logger.warning('%s was built from another model', info['file'])
+        return None
+    model = xgb.Booster()
+    if info['codec'] is None:
+        # XGBoost reads the file itself, no copy in Python
+        if file_sha256(path) != info['sha256']:
+            logger.warning('%s is corrupt', info['file'])
+            return None
+        model.load_model(path)
+        return model
+    try:
+        with open(path, 'rb') as f:
+            raw = decompress_stream(f, info['codec'])
+    except ImportError:
+        logger.warning('Codec %s of %s is not installed', info['codec'], info['file'])
+        return None
+    if hashlib.sha256(raw).hexdigest() != info['sha256']:
+        logger.warning('%s is corrupt', info['file'])
+        return None
+    model.load_model(bytearray(raw))
+    return model
+
+def load_model(manifest=manifest_path, source=model_path, warm=True):
+    """
+    Load the packaged booster, model.xgb.bz2 if there is no valid artifact.
+
+    Args:
+        manifest: Path of the manifest written by package_model.
+        source: model.xgb.bz2, the artifact is only used if it was built from this file.
+        warm: Run a dummy prediction after loading.
+    """
+    model = load_artifact(manifest, source)
+    if model is None:
+        model = load_bz2_model(source)
+    if warm:
+        prewarm(model)
+    return model
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Package the XGBoost model for the dashboard")
+    parser.add_argument('-c', '--codec', choices=['none', 'zstd', 'lz4'], default='none', help='Compression of the UBJSON file')
+    args = parser.parse_args()
+    info = package_model(None if args.codec == 'none' else args.codec)
+    print(f"Saved: {info['file']} ({info['sha256'][:12]})")
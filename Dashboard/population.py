@@ -0,0 +1,156 @@
+"""
+Columnar storage of the synthetic population.
+
+The population is stored as a Parquet dataset partitioned by year and state
+(data/synthetic_population/year=2019/state=Bayern/...). The string columns are stored as
+categoricals and the numeric columns with the smallest possible dtype, so the dashboard
+only reads the columns and partitions it needs and keeps them compact in memory.
+
+Identical synthetic apprentices are stored once, as a profile with an integer weight (column
+weight) instead of one row per apprentice. Aggregations use the weights (read_population(weights=True)),
+code that needs one row per apprentice reads the population with expand=True.
+
+Usage (convert the CSV file of the data pipeline):
+
+    python Dashboard/population.py data/synthetic_population_with_features.csv.bz2
+"""
+import argparse
+import os
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+script_dir = os.path.dirname(__file__)
+population_dir = os.path.join(script_dir, 'data', 'synthetic_population')
+population_csv_path = os.path.join(script_dir, 'data', 'synthetic_population_with_features.csv.bz2')
+
+PARTITION_COLS = ['year', 'state']
+WEIGHT_COL = 'weight'
+PARTITIONING = ds.partitioning(pa.schema([('year', pa.int16()), ('state', pa.string())]), flavor='hive')
+
+def optimize_dtypes(df):
+    """
+    Use categoricals for the string columns and downcast the integer columns.
+
+    The float columns are the numeric model features, they keep float64, so the model gets
+    exactly the values of the CSV file (see check_predictions).
+    """
+    for col in df.columns:
+        if df[col].dtype == object:
+            df[col] = df[col].astype('category')
+        elif pd.api.types.is_integer_dtype(df[col]):
+            df[col] = pd.to_numeric(df[col], downcast='integer')
+    return df
+
+def collapse_population(df):
+    """Unique profiles of df with the number of identical rows (or the sum of their weights) as weight."""
+    if WEIGHT_COL in df.columns:
+        weights = df.groupby([col for col in df.columns if col != WEIGHT_COL], observed=True, dropna=False, sort=False)[WEIGHT_COL].sum()
+    else:
+        weights = df.groupby(list(df.columns), observed=True, dropna=False, sort=False).size()
+    return weights.rename(WEIGHT_COL).astype('int32').reset_index()
+
+def expand_population(df):
+    """One row per unit of weight (the individual-level form), without the weight column."""
+    if WEIGHT_COL not in df.columns:
+        return df
+    return df.loc[df.index.repeat(df[WEIGHT_COL])].drop(columns=WEIGHT_COL).reset_index(drop=True)
+
+def write_population(df, root=population_dir):
+    """Write df as Parquet dataset partitioned by year and state, existing partitions are replaced."""
+    df = optimize_dtypes(df.drop(columns=['Unnamed: 0'], errors='ignore'))
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    pq.write_to_dataset(table, root, partition_cols=PARTITION_COLS,
+                        existing_data_behavior='delete_matching')
+
+def read_population(columns=None, filters=None, root=population_dir, weights=False, expand=False):
+    """
+    Read the synthetic population.
+
+    Only the given columns are read, the filters are pushed down to the partitions and row groups,
+    e.g. filters=[('year', '>=', 2010), ('state', 'in', ['Bayern', 'Berlin'])].
+    If the Parquet dataset doesn't exist (yet), the CSV file is read instead.
+
+    Args:
+        weights: Add the weight column to the columns (1 for populations stored as individuals),
+                 it is always part of the result if columns is None.
+        expand: Return one row per synthetic apprentice instead of the weighted profiles.
+    """
+    if os.path.exists(root):
+        dataset = ds.dataset(root, format='parquet', partitioning=PARTITIONING)
+    else:
+        # the filter columns have to be read as well, even if they are not in the projection
+        header = pd.read_csv(population_csv_path, nrows=0).columns
+        usecols = None if columns is None else [
+            col for col in dict.fromkeys(columns + [f[0] for f in filters or []] + [WEIGHT_COL]) if col in header
+        ]
+        df = pd.read_csv(population_csv_path, usecols=usecols)
+        dataset = ds.dataset(pa.Table.from_pandas(optimize_dtypes(df.drop(columns=['Unnamed: 0'], errors='ignore')), preserve_index=False))
+    weighted = WEIGHT_COL in dataset.schema.names
+    if columns is not None and weighted and (weights or expand):
+        columns = list(dict.fromkeys(columns + [WEIGHT_COL]))
+    expression = pq.filters_to_expression(filters) if filters else None
+    table = dataset.to_table(columns=columns, filter=expression)
+    if 'state' in table.column_names and not pa.types.is_dictionary(table.schema.field('state').type):
+        table = table.set_column(table.column_names.index('state'), 'state', pc.dictionary_encode(table['state']))
+    df = table.to_pandas()
+    if expand:
+        return expand_population(df)
+    if weights and not weighted:
+        df[WEIGHT_COL] = np.ones(len(df), dtype='int32')
+    return df
+
+def check_predictions(csv_df, root=population_dir):
+    """
+    Compare the model predictions on the rows of the CSV file with the predictions on the stored dataset.
+
+    Every distinct feature vector of csv_df is scored once from the CSV values and once from the
+    values read from root. Returns (number of feature vectors, number not found in the dataset,
+    largest absolute difference of the predictions).
+    """
+    import xgboost as xgb
+    from model_artifact import load_model
+    from category_codes import encode_categories, load_category_codes
+    model = load_model(warm=False)
+    features = model.feature_names
+    codes = load_category_codes()
+
+    def predict(df):
+        return model.predict(xgb.DMatrix(encode_categories(df[features].copy(), codes)))
+
+    expected = csv_df[features].drop_duplicates().reset_index(drop=True)
+    stored = read_population(columns=features, root=root).drop_duplicates().reset_index(drop=True)
+    expected['prediction_csv'] = predict(expected)
+    stored['prediction_dataset'] = predict(stored)
+    # merge on the values, not on the categoricals of the dataset
+    for col in codes:
+        if col in features:
+            expected[col] = expected[col].astype(object)
+            stored[col] = stored[col].astype(object)
+    merged = expected.merge(stored, on=features, how='left')
+    missing = int(merged['prediction_dataset'].isna().sum())
+    diff = (merged['prediction_csv'] - merged['prediction_dataset']).abs().max()
+    return len(expected), missing, float(0 if pd.isna(diff) else diff)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Convert the synthetic population to a partitioned Parquet dataset")
+    parser.add_argument('population', nargs='?', default=population_csv_path, help='CSV file with the synthetic population')
+    parser.add_argument('-o', '--output', default=population_dir, help='Directory of the Parquet dataset')
+    parser.add_argument('--expanded', action='store_true', help='Store one row per apprentice instead of weighted profiles')
+    parser.add_argument('--check', action='store_true', help='Check that the model predicts the same on the dataset as on the CSV file')
+    args = parser.parse_args()
+    df = pd.read_csv(args.population)
+    if not args.expanded:
+        rows = len(df)
+        df = collapse_population(df.drop(columns=['Unnamed: 0'], errors='ignore'))
+        print(f'{rows} rows -> {len(df)} weighted profiles')
+    write_population(df, args.output)
+    print(f'Saved: {args.output}')
+    if args.check:
+        vectors, missing, diff = check_predictions(pd.read_csv(args.population), args.output)
+        print(f'{vectors} feature vectors, {missing} not in the dataset, max. difference of the predictions {diff:g}')
+        if missing or diff > 0:
+            raise SystemExit('The predictions on the dataset differ from the CSV file')
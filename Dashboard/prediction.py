@@ -2,68 +2,166 @@ import streamlit as st
 import pandas as pd
 import numpy as np
 import plotly.express as px
-import os
-import bz2
-from prophet import Prophet
+import multiprocessing
+from itertools import product
 import xgboost as xgb
 from utils import apply_common_layout_settings
-
-import logging
-logging.getLogger("prophet").setLevel(logging.WARNING)
-
-# === Parameters for historical and prediction years ===
-min_year = 2010  # Start year for historical data used in Prophet
-max_year = 2019  # End year for historical data because of the COVID year (adjust as needed)
-prediction_years = list(range(2025, 2031))  # Forecast years for the plot and metrics
+from model_artifact import load_model
+from category_codes import encode_categories, load_category_codes
+from population import read_population
+from combination_index import CombinationIndex
+from dropout_cube import AXES, DropoutCube, build_cube
+from disk_cache import get_cache, make_key
+# the historical and prediction years are defined in forecast.py (shared with the batch job)
+from forecast import (FORECASTER, FORECASTER_LABELS, FORECAST_TIMEOUT, FORECAST_WORKERS, ProphetPool, forecast_batch,
+                      forecast_config, load_forecasts, max_year, min_year, parallel_prophet, prediction_years)
 
 # === Data Loading Functions ===
 
-script_dir = os.path.dirname(__file__)
-
 @st.cache_data
 def load_data():
-    csv_file_path = os.path.join(script_dir, 'data', 'synthetic_population_with_features.csv.bz2')
-    df = pd.read_csv(csv_file_path)
-    if "Unnamed: 0" in df.columns:
-        df = df.drop(columns=["Unnamed: 0"])
-    return df
+    # only the model features and the target, the categorical columns are read as categoricals
+    model = load_xgb_model()
+    return read_population(columns=model.feature_names + ['dropped_out'])
+
+@st.cache_resource
+def load_cube():
+    # dropout history for the Prophet forecast, memory-mapped from the prebuilt cube
+    cube = DropoutCube.load()
+    if cube is None:
+        cube = build_cube(read_population(
+            columns=AXES + ['dropped_out'],
+            filters=[('year', '>=', min_year), ('year', '<=', max_year)],
+            weights=True
+        ))
+    return cube
 
 @st.cache_resource
 def load_xgb_model():
-    model = xgb.Booster()
-    model_file_path = os.path.join(script_dir, 'data', 'model.xgb.bz2')
-    with bz2.open(model_file_path, 'rb') as f:
-        model.load_model(bytearray(f.read()))
-    return model
-
-# Encode categorical columns in a row (as used in training). Categories are assigned integer indices.
-
-def encode_input(row_df, df, cat_cols):
-    for col in cat_cols:
-        cats = list(df[col].dropna().unique())
-        row_df[col] = row_df[col].apply(lambda x: cats.index(x) if x in cats else -1)
-    return row_df
-
-def get_template_row(df, beruf, bundesland, alter, geschlecht, herkunft, abschluss):
-    match = df[
-        (df['sector'] == beruf) &
-        (df['state'] == bundesland) &
-        (df['age'] == alter) &
-        (df['gender'] == geschlecht) &
-        (df['nationality'] == herkunft) &
-        (df['education'] == abschluss)
+    # packaged UBJSON model (see model_artifact.py), model.xgb.bz2 if it wasn't packaged
+    return load_model()
+
+@st.cache_resource
+def load_codes():
+    # The code tables are written at training time, without them the model can't be used
+    return load_category_codes()
+
+@st.cache_resource
+def load_forecast_table():
+    # forecasts precomputed by forecast.py, empty if the table doesn't exist
+    return load_forecasts()
+
+@st.cache_resource
+def load_index():
+    # template row per combination, built once per process
+    return CombinationIndex(load_data())
+
+# === Forecasts ===
+
+@st.cache_resource
+def load_forecast_pool():
+    # worker processes for the Prophet fits, shared by all sessions
+    # (spawned, so the Streamlit server with its threads isn't forked),
+    # every finished fit is cached on disk, also if its request has timed out
+    return ProphetPool(FORECAST_WORKERS, on_done=get_cache().set, mp_context=multiprocessing.get_context('spawn'))
+
+def fit_on_demand(cube, combos):
+    """
+    Forecasts of combinations missing in the precomputed table as dict combination -> yhat array.
+
+    Prophet fits run in parallel in the shared pool, fits that time out are NaN (so only the model
+    prediction is used) but keep running, the next request finds them in the cache or waits for the
+    same fit. The finished fits are cached on disk, keyed on the forecaster and the history data
+    (like the precomputed table).
+    """
+    cache = get_cache()
+    config = forecast_config()
+    keys = {combo: make_key('forecast', config, combo) for combo in combos}
+    fitted = {combo: cache.get(keys[combo], None) for combo in combos}
+    todo = [combo for combo in combos if fitted[combo] is None]
+    if todo:
+        histories = [cube.history(combo, min_year, max_year) for combo in todo]
+        if FORECASTER == 'prophet':
+            # the pool stores the finished fits in the cache
+            preds, finished = parallel_prophet(load_forecast_pool(), histories, [keys[combo] for combo in todo],
+                                               timeout=FORECAST_TIMEOUT)
+        else:
+            preds, finished = forecast_batch(histories), np.ones(len(todo), dtype=bool)
+            for combo, pred in zip(todo, preds):
+                cache.set(keys[combo], pred)
+        fitted.update(zip(todo, preds))
+        if not finished.all():
+            st.info(f"⏱️ {(~finished).sum()} Prognose(n) nicht rechtzeitig fertig, es wird nur das Modell verwendet.")
+    return fitted
+
+# === Batch prediction ===
+
+def build_feature_grid(templates, years, model_features):
+    """
+    Build one feature matrix for all combinations and years.
+
+    Every template row is repeated for each year in `years`, so row i * len(years) + j
+    belongs to combination i and year j.
+    """
+    grid = pd.DataFrame(templates).reset_index(drop=True)[model_features]
+    grid = grid.loc[grid.index.repeat(len(years))].reset_index(drop=True)
+    grid["year"] = np.tile(years, len(templates))
+    return grid
+
+def predict_batch(model, codes, templates, years, model_features):
+    """
+    Score all combinations for all years with a single Booster.predict call.
+
+    Returns an array of shape (len(templates), len(years)) with the dropout rate in percent.
+    """
+    grid = build_feature_grid(templates, years, model_features)
+    grid = encode_categories(grid, codes)
+    preds = model.predict(xgb.DMatrix(grid))
+    preds = np.where(preds < 1, preds * 100, preds)
+    return np.clip(preds, 0, 100).reshape(len(templates), len(years))
+
+def forecast_combinations(index, cube, forecasts, model, codes, combinations, model_features):
+    """
+    Hybrid forecast (mean of time series forecast and model) for all selected combinations.
+
+    The time series forecasts are taken from `forecasts` (see forecast.load_forecasts), missing ones are fitted.
+
+    `combinations` is a list of (beruf, bundesland, alter, geschlecht, herkunft, abschluss) tuples.
+    Returns a long DataFrame with the columns Jahr, Prognose and Kombination.
+    """
+    missing = tuple(combo for combo in combinations if combo not in forecasts)
+    fitted = fit_on_demand(cube, missing) if missing else {}
+    series_preds = [forecasts[combo] if combo in forecasts else fitted[combo] for combo in combinations]
+    templates = [index.template(combo) for combo in combinations]
+
+    # --- XGBoost Model prediction for all combinations and prediction years at once ---
+    model_preds = predict_batch(model, codes, templates, prediction_years, model_features)
+
+    # --- Hybrid: Mean of time series forecast & Model (if both values are available) ---
+    series_preds = np.asarray(series_preds, dtype=float)
+    # Weighting forecast:Model
+    hybrid_preds = np.where(np.isnan(series_preds), model_preds, 0.5 * series_preds + 0.5 * model_preds)
+
+    labels = [
+        f"{beruf} | {bundesland} | {geschlecht} | {herkunft} | {abschluss} | {alter}"
+        for beruf, bundesland, alter, geschlecht, herkunft, abschluss in combinations
     ]
-    if not match.empty:
-        return match.sort_values("year").iloc[-1]
-    else:
-        return df.iloc[0]
+    return pd.DataFrame({
+        "Jahr": np.tile(prediction_years, len(combinations)),
+        "Prognose": hybrid_preds.ravel(),
+        "Kombination": np.repeat(labels, len(prediction_years))
+    })
 
 def app():
     st.title("Prognose der Vertragslösungsquote")
 
     # === Load data and ML model ===
     df = load_data()
+    index = load_index()
+    cube = load_cube()
+    forecasts = load_forecast_table()
     model = load_xgb_model()
+    codes = load_codes()
 
     # --- Sidebar filters for user selection ---
     st.sidebar.markdown("### 🔍 Auswahlkriterien")
@@ -93,99 +191,17 @@ def app():
     # Prepare feature list for ML input (all except 'dropped_out' and 'Unnamed: 0')
     model_features = [col for col in df.columns if col not in ['dropped_out', 'Unnamed: 0']]
 
-    # Collect all forecast results for the selected combinations
-    all_hybrid = []
-
-    for beruf in selected_beruf:
-        for bundesland in selected_bundesland:
-            for alter in selected_alter:
-                for geschlecht in selected_geschlecht:
-                    for herkunft in selected_herkunft:
-                        for abschluss in selected_abschluss:
-                            # filter for this combination
-                            combo_mask = (
-                                (df['sector'] == beruf) &
-                                (df['state'] == bundesland) &
-                                (df['age'] == alter) &
-                                (df['gender'] == geschlecht) &
-                                (df['nationality'] == herkunft) &
-                                (df['education'] == abschluss)
-                            )
-                            df_combo = df[combo_mask]
-
-                            # dropout rate per year (min_year - max_year)
-                            dropout_per_year = (
-                                df_combo[df_combo["year"].between(min_year, max_year)]
-                                .groupby("year")["dropped_out"]
-                                .mean()
-                                .reset_index()
-                            )
-                            dropout_per_year["dropped_out"] = dropout_per_year["dropped_out"] * 100  # in %
-
-                            # --- Prophet Forecast ---
-                            if len(dropout_per_year) >= 2:
-                                prophet_df = pd.DataFrame({
-                                    "ds": pd.to_datetime(dropout_per_year["year"], format='%Y'),
-                                    "y": dropout_per_year["dropped_out"]
-                                })
-                                m = Prophet(
-                                    yearly_seasonality=True,
-                                    weekly_seasonality=False,
-                                    daily_seasonality=False
-                                )
-                                m.fit(prophet_df)
-                                future = pd.DataFrame({"ds": pd.to_datetime(prediction_years, format='%Y')})
-                                forecast = m.predict(future)
-                                prophet_pred = forecast["yhat"].values
-                                prophet_pred = np.clip(prophet_pred, 0, 100)
-                            else:
-                                prophet_pred = [np.nan] * len(prediction_years)
-
-                            # --- XGBoost Model prediction for predictionyear ---
-                            template = get_template_row(df, beruf, bundesland, alter, geschlecht, herkunft, abschluss)
-                            model_preds = []
-                            for jahr in prediction_years:
-                                row = template.copy()
-                                row["year"] = jahr
-                                row_df = pd.DataFrame([row])[model_features]
-                                cat_cols = ["age", "education", "state", "gender", "sector", "nationality"]
-                                row_df = encode_input(row_df, df, cat_cols)
-                                # TODO: check if this is needed
-                                # this line gives a FutureWarning:
-                                #     errors='ignore' is deprecated and will raise in a future version.
-                                #     Use to_numeric without passing `errors` and catch exceptions
-                                #     explicitly instead
-                                # but the variable frow_df is not used anywhere
-                                # frow_df = row_df.apply(pd.to_numeric, errors='ignore')
-                                dmatrix = xgb.DMatrix(row_df)
-                                pred = model.predict(dmatrix)[0]
-                                if pred < 1:  
-                                    pred = pred * 100
-                                pred = np.clip(pred, 0, 100)
-                                model_preds.append(pred)
-
-                            # --- Hybrid: Mean of Prophet & Model (if both values are available) ---
-                            hybrid_pred = []
-                            for p, m in zip(prophet_pred, model_preds):
-                                if np.isnan(p):
-                                    hybrid_pred.append(m)
-                                else:
-                                    # Weighting Prophet:Model
-                                    hybrid_pred.append(0.5 * p + 0.5 * m)
-
-                            # output
-                            df_out = pd.DataFrame({
-                                "Jahr": prediction_years,
-                                "Prognose": hybrid_pred,
-                                "Kombination": f"{beruf} | {bundesland} | {geschlecht} | {herkunft} | {abschluss} | {alter}"
-                            })
-                            all_hybrid.append(df_out)
-
-    if not all_hybrid:
+    # All combinations of the selected values
+    combinations = list(product(
+        selected_beruf, selected_bundesland, selected_alter,
+        selected_geschlecht, selected_herkunft, selected_abschluss
+    ))
+
+    if not combinations:
         st.error("⚠️ Keine gültigen Vorhersagen gefunden.")
         return
 
-    result = pd.concat(all_hybrid)
+    result = forecast_combinations(index, cube, forecasts, model, codes, combinations, model_features)
 
     # ==== Dynamischen y-Achsenbereich bestimmen ====
     y_min = max(0, result["Prognose"].min() - 2)
@@ -199,7 +215,7 @@ def app():
         color="Kombination",
         markers=True,
         labels={"Jahr": "Jahr", "Prognose": "Prognose Vertragslösungsquote (%)"},
-        title="Prognose (Prophet + Modell) der Vertragslösungsquote (2025–2030)"
+        title=f"Prognose ({FORECASTER_LABELS[FORECASTER]} + Modell) der Vertragslösungsquote (2025–2030)"
     )
     fig.update_yaxes(range=[y_min, y_max])
     apply_common_layout_settings(fig)
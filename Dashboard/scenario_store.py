@@ -0,0 +1,163 @@
+"""
+Columnar storage of the scenario analysis results.
+
+The simulation writes one wide CSV with one column per scenario, effect size and region
+(e.g. EDU+1_HH_proportion_ones). The store keeps the results in a long, typed schema as a Parquet
+dataset partitioned by scenario (data/scenario_results/scenario=EDU/...):
+
+    year         int16    year of the simulation
+    scenario     string   scenario code (BAU, EDU, UNEMP, WAGE, ...)
+    effect_size  int16    effect size in %, null for the base run
+    region       string   region code (bund, hh, by, ...), null if the column has no region
+    value        float64  proportion of dropouts
+    series       int32    id of the series (scenario, effect size, region), the key of a row is (series, year)
+
+The store is always written as a whole from one CSV file of the simulation, so the series ids of all
+partitions belong to the same run. Every run is written to a new version directory next to it
+(data/.scenario_results_<random>) and data/scenario_results is a symlink to the current version, switched
+with one atomic rename. A reader never sees a missing or half-written store, and the previous version is
+kept for readers that are still reading it. If the store doesn't exist, it is built once from
+data/scenario_analysis_results.csv.bz2.
+
+query_scenario_results pushes the filters down, so only the partitions and row groups of the
+selected scenarios are read.
+
+Usage (convert the CSV file of the simulation, modeling/scenario_engine.py writes it):
+
+    python Dashboard/scenario_store.py Dashboard/data/scenario_analysis_results.csv.bz2
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import threading
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+script_dir = os.path.dirname(__file__)
+scenario_store_dir = os.path.join(script_dir, 'data', 'scenario_results')
+scenario_csv_path = os.path.join(script_dir, 'data', 'scenario_analysis_results.csv.bz2')
+
+SCHEMA = pa.schema([
+    ('year', pa.int16()),
+    ('scenario', pa.string()),
+    ('effect_size', pa.int16()),
+    ('region', pa.string()),
+    ('value', pa.float64()),
+    ('series', pa.int32())
+])
+PARTITIONING = ds.partitioning(pa.schema([('scenario', pa.string())]), flavor='hive')
+
+COLUMN_NAME_PATTERN = r'^(?P<scenario>[A-Z]+)(?P<effect_size>[+-]?\d+)?(?:_?(?P<region>[A-Z]+))?_proportion_ones$'
+
+def wide_to_long(df):
+    """
+    Convert the wide simulation output (year + one column per scenario) to the long schema.
+
+    Every column name is parsed once, columns that don't match COLUMN_NAME_PATTERN are ignored.
+    The region ALL is stored as bund (the whole country).
+    """
+    scenario_cols = pd.Series([col for col in df.columns if col != 'year'])
+    parsed = scenario_cols.str.extract(COLUMN_NAME_PATTERN)
+    parsed['column'] = scenario_cols
+    parsed = parsed[parsed['scenario'].notna()]
+    parsed['series'] = np.arange(len(parsed), dtype='int32')
+    parsed['effect_size'] = pd.to_numeric(parsed['effect_size']).astype('Int16')
+    parsed['region'] = parsed['region'].str.lower().replace('all', 'bund')
+
+    df_long = df.melt(id_vars='year', value_vars=parsed['column'].tolist(), var_name='column', value_name='value')
+    df_long = df_long.merge(parsed, on='column', how='left')
+    df_long['year'] = df_long['year'].astype('int16')
+    return df_long[SCHEMA.names]
+
+def _remove(path):
+    if os.path.islink(path) or os.path.isfile(path):
+        os.remove(path)
+    else:
+        shutil.rmtree(path, ignore_errors=True)
+
+def write_scenario_results(df_long, root=scenario_store_dir):
+    """
+    Write the long results partitioned by scenario, replacing the whole store.
+
+    The series ids are only unique within one run, so partitions of an older run must not be kept.
+    The store is written to a new version directory next to root, then the symlink root is switched to it
+    with one atomic rename. The previous version is kept, older ones are deleted.
+    """
+    root = os.path.abspath(root)
+    parent = os.path.dirname(root)
+    prefix = f'.{os.path.basename(root)}_'
+    os.makedirs(parent, exist_ok=True)
+    version = tempfile.mkdtemp(prefix=prefix, dir=parent)
+    try:
+        table = pa.Table.from_pandas(df_long, schema=SCHEMA, preserve_index=False)
+        pq.write_to_dataset(table, version, partitioning=PARTITIONING)
+        link = version + '.link'
+        # relative, so the store can be copied (e.g. by the deployment)
+        os.symlink(os.path.basename(version), link)
+    except BaseException:
+        _remove(version)
+        raise
+    previous = os.path.realpath(root) if os.path.islink(root) else None
+    if os.path.isdir(root) and not os.path.islink(root):
+        # a store written as a plain directory (before the versions) can't be replaced atomically
+        os.replace(root, version + '.old')
+    os.replace(link, root)
+    for name in os.listdir(parent):
+        path = os.path.join(parent, name)
+        if name.startswith(prefix) and path not in (version, previous):
+            _remove(path)
+
+def build_store(csv_path=scenario_csv_path, root=scenario_store_dir):
+    """Convert the wide CSV file of the simulation to the store."""
+    write_scenario_results(wide_to_long(pd.read_csv(csv_path)), root)
+
+_build_lock = threading.Lock()
+
+def _dataset(root):
+    """The store, built once from the CSV file of the simulation if it doesn't exist (yet)."""
+    if not os.path.exists(root):
+        with _build_lock:
+            if not os.path.exists(root):
+                if not os.path.exists(scenario_csv_path):
+                    raise FileNotFoundError(f'Neither {root} nor {scenario_csv_path} exist')
+                build_store(scenario_csv_path, root)
+    # resolved once, so a query reads one version even if the store is replaced meanwhile
+    return ds.dataset(os.path.realpath(root), format='parquet', partitioning=PARTITIONING)
+
+def _isin(field, values):
+    """Expression field in values, None in values matches null."""
+    expression = ds.field(field).isin([value for value in values if value is not None])
+    if None in values:
+        expression = expression | ds.field(field).is_null()
+    return expression
+
+def query_scenario_results(scenarios=None, effect_sizes=None, regions=None, columns=None, root=scenario_store_dir):
+    """
+    Read the scenario results, only the given scenarios, effect sizes and regions (None: all).
+
+    The filters are pushed down to the partitions and row groups, e.g.
+    query_scenario_results(['BAU'], [None], ['bund', 'hh']) reads the base run of two regions.
+    """
+    expression = None
+    for field, values in [('scenario', scenarios), ('effect_size', effect_sizes), ('region', regions)]:
+        if values is not None:
+            condition = _isin(field, list(values))
+            expression = condition if expression is None else expression & condition
+    table = _dataset(root).to_table(columns=columns, filter=expression)
+    return table.to_pandas()
+
+def scenario_options(root=scenario_store_dir):
+    """All series (scenario, effect_size, region) in the store, without reading the values."""
+    return query_scenario_results(columns=['scenario', 'effect_size', 'region', 'series'], root=root).drop_duplicates('series')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Convert the scenario analysis results to a partitioned Parquet dataset")
+    parser.add_argument('results', nargs='?', default=scenario_csv_path, help='Wide CSV file of the scenario analysis')
+    parser.add_argument('-o', '--output', default=scenario_store_dir, help='Directory of the Parquet dataset')
+    args = parser.parse_args()
+    build_store(args.results, args.output)
+    print(f'Saved: {args.output}')
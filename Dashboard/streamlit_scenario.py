@@ -1,9 +1,11 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 import plotly.express as px
-import re # For regular expression parsing of column names
 import os
 from utils import apply_common_layout_settings
+from disk_cache import cached
+from scenario_store import query_scenario_results, scenario_csv_path, scenario_options, scenario_store_dir
 
 
 st.title("Abbruchquote Szenario Analysen")
@@ -43,96 +45,90 @@ SCENARIO_DISPLAY_NAMES = {
     'WAGE': 'Löhne'
 }
 
-script_dir = os.path.dirname(__file__)
+BASIS_SCENARIO = 'BAU'
 
-csv_file_path = os.path.join(script_dir, 'data', 'scenario_analysis_results.csv.bz2')
 
+# --- Conversion between the codes of the scenario store and the display names ---
+def to_display(df, scopes_dict, scenario_names_dict):
+    """
+    Rows of the scenario store with the display names of this page and the Label of their series.
+
+    The labels are built once per series (not per row) and attached as categorical.
+    """
+    display = pd.DataFrame({
+        'year': df['year'],
+        'Abbruchquote': df['value'],
+        'Scenario': df['scenario'].map(scenario_names_dict).fillna(df['scenario']).astype('category'),
+        'Effect Size': (df['effect_size'].astype('string') + '%').fillna("Base").astype('category'),
+        'Region': df['region'].map(scopes_dict).fillna(df['region']).fillna("Overall").astype('category'),
+        'series': df['series']
+    }).reset_index(drop=True)
+
+    series = display.drop_duplicates('series')
+    is_basis = (series['Scenario'] == scenario_names_dict[BASIS_SCENARIO]) & (series['Effect Size'] == "Base")
+    labels = (
+        series['Scenario'].astype(str) + ' ' +
+        np.where(is_basis, '', series['Effect Size'].astype(str) + ' ') +
+        series['Region'].astype(str)
+    )
+    label_categories = pd.Index(sorted(labels.unique()))
+    label_codes = label_categories.get_indexer(labels)[pd.Index(series['series']).get_indexer(display['series'])]
+    display['Label'] = pd.Categorical.from_codes(label_codes, categories=label_categories)
+    return display
+
+def to_codes(scenarios, effect_sizes, regions, scopes_dict, scenario_names_dict):
+    """Selected display names as filters of the scenario store."""
+    scenario_codes = {name: code for code, name in scenario_names_dict.items()}
+    region_codes = {name: code for code, name in scopes_dict.items()}
+    return (
+        tuple(scenario_codes.get(scenario, scenario) for scenario in scenarios),
+        tuple(None if effect_size == "Base" else int(effect_size.rstrip('%')) for effect_size in effect_sizes),
+        tuple(None if region == "Overall" else region_codes.get(region, region) for region in regions)
+    )
 
-# --- Data Loading and Preprocessing (cached for performance) ---
+
+# --- Data Loading (cached for performance) ---
 @st.cache_data
-def load_and_preprocess_data(file_path, scopes_dict, scenario_names_dict):
+@cached(scenario_store_dir, scenario_csv_path)
+def load_filter_options(scopes_dict, scenario_names_dict):
     """
-    Loads the CSV data, preprocesses column names, and returns a long-format DataFrame
-    along with unique filter options, separating the 'Basis' scenario.
+    Returns the scenarios, effect sizes and regions that can be selected (without the 'Basis' scenario).
+    Only the scenario, effect size and region columns of the store are read.
     """
     try:
-        df = pd.read_csv(file_path)
+        options = scenario_options()
         st.success("Daten erfolgreich geladen!")
     except FileNotFoundError:
-        st.error(f"Error: '{os.path.basename(file_path)}' not found at '{file_path}'. Please ensure the file is in the correct directory.")
-        st.stop()
-
-    if 'year' not in df.columns:
-        st.error("Error: 'year' column not found in the dataset. Please ensure your CSV has a 'year' column.")
+        st.error(f"Error: '{os.path.basename(scenario_csv_path)}' not found at '{scenario_csv_path}'. Please ensure the file is in the correct directory.")
         st.stop()
 
-    scenario_cols = [col for col in df.columns if col != 'year']
-    parsed_data = []
-
-    col_name_pattern = re.compile(r'^(?P<Szenario>[A-Z]+)(?P<EffectSize>[+-]?\d+)?(?:_?(?P<Region>[A-Z]+))?_proportion_ones$')
-
-    for col in scenario_cols:
-        match = col_name_pattern.match(col)
-        if match:
-            szenario = match.group('Szenario')
-            effect_size_str = match.group('EffectSize')
-            region_code = match.group('Region')
-
-            display_scenario = scenario_names_dict.get(szenario, szenario)
-
-            display_effect_size = "Base"
-            if effect_size_str is not None:
-                display_effect_size = f"{int(effect_size_str)}%"
-
-            display_region = "Overall"
-            if region_code is not None:
-                if region_code.lower() == 'all':
-                    display_region = scopes_dict['bund']
-                elif region_code.lower() in scopes_dict:
-                    display_region = scopes_dict[region_code.lower()]
-                else:
-                    display_region = region_code
-
-
-            for index, row in df.iterrows():
-                parsed_data.append({
-                    'year': row['year'],
-                    'Abbruchquote': row[col],
-                    'Scenario': display_scenario,
-                    'Effect Size': display_effect_size,
-                    'Region': display_region,
-                    'Original Column': col
-                })
-        else:
-            pass
-
-
-    if not parsed_data:
-        st.error("No scenario data columns found matching the expected pattern. Please check your column names or the regex pattern.")
+    options = options[~((options['scenario'] == BASIS_SCENARIO) & options['effect_size'].isna())]
+    if options.empty:
+        st.error("No scenario data found. Please check the scenario results or their column names.")
         st.stop()
 
-    df_long = pd.DataFrame(parsed_data)
-
-    basis_scenario_display_name = scenario_names_dict['BAU']
-
-    basis_scenario_df_all_regions = df_long[
-        (df_long['Scenario'].str.strip() == basis_scenario_display_name) &
-        (df_long['Effect Size'].str.strip() == 'Base')
-    ].copy()
+    options = to_display(options.assign(year=0, value=0.0), scopes_dict, scenario_names_dict)
+    all_scenarios = sorted(options['Scenario'].unique().tolist())
+    all_effect_sizes = sorted(options['Effect Size'].unique().tolist())
+    all_regions = sorted(options['Region'].unique().tolist())
+    return all_scenarios, all_effect_sizes, all_regions
 
-    df_long_filtered_for_selection = df_long[
-        ~((df_long['Scenario'].str.strip() == basis_scenario_display_name) &
-          (df_long['Effect Size'].str.strip() == 'Base'))
-    ].copy()
-
-    all_scenarios = sorted(df_long_filtered_for_selection['Scenario'].unique().tolist())
-    all_effect_sizes = sorted(df_long_filtered_for_selection['Effect Size'].unique().tolist())
-    all_regions = sorted(df_long_filtered_for_selection['Region'].unique().tolist())
-
-    return df_long, basis_scenario_df_all_regions, all_scenarios, all_effect_sizes, all_regions
+@st.cache_data
+def load_scenario_results(scenarios, effect_sizes, regions, show_basis):
+    """
+    Long DataFrame with the results of the selected scenarios and the 'Basis' scenario of the selected
+    regions (if show_basis). The filters are pushed down to the store.
+    """
+    parts = [query_scenario_results(*to_codes(scenarios, effect_sizes, regions, SCOPES, SCENARIO_DISPLAY_NAMES))]
+    if show_basis:
+        parts.append(query_scenario_results(
+            [BASIS_SCENARIO], [None], to_codes([], [], regions, SCOPES, SCENARIO_DISPLAY_NAMES)[2]
+        ))
+    df = pd.concat(parts, ignore_index=True).drop_duplicates(subset=['series', 'year'])
+    return to_display(df, SCOPES, SCENARIO_DISPLAY_NAMES).drop(columns='series')
 
-# Load data and get filter options
-df_long_full, basis_scenario_df_all_regions, all_scenarios, all_effect_sizes, all_regions = load_and_preprocess_data(csv_file_path, SCOPES, SCENARIO_DISPLAY_NAMES)
+# Get filter options
+all_scenarios, all_effect_sizes, all_regions = load_filter_options(SCOPES, SCENARIO_DISPLAY_NAMES)
 
 
 # --- Sidebar Filters ---
@@ -183,30 +179,15 @@ with st.sidebar:
     st.markdown('**Region(en):**\n' + '\n'.join([f' - {r}' for r in selected_regions_filtered]))
 
 
-# --- Filter Data Based on Selections ---
-filtered_df = df_long_full[
-    (df_long_full['Scenario'].isin(selected_scenarios_filtered)) &
-    (df_long_full['Effect Size'].isin(selected_effect_sizes_filtered)) &
-    (df_long_full['Region'].isin(selected_regions_filtered))
-].copy()
-
-if show_basis_scenario:
-    filtered_basis_df_for_display = basis_scenario_df_all_regions[
-        basis_scenario_df_all_regions['Region'].isin(selected_regions_filtered)
-    ].copy()
-    combined_df = pd.concat([filtered_df, filtered_basis_df_for_display]).drop_duplicates().copy()
-else:
-    combined_df = filtered_df.copy()
+# --- Load the data of the selections ---
+combined_df = load_scenario_results(
+    tuple(selected_scenarios_filtered), tuple(selected_effect_sizes_filtered), tuple(selected_regions_filtered),
+    show_basis_scenario
+)
 
 if combined_df.empty:
     st.info("Keine Daten für die ausgewählten Filter gefunden. Bitte passen Sie Ihre Auswahl an oder aktivieren Sie 'Basis-Szenario anzeigen'.")
 else:
-    basis_scenario_name = SCENARIO_DISPLAY_NAMES.get('BAU', 'BAU')
-    combined_df['Label'] = combined_df.apply(
-        lambda row: f"{row['Scenario']} {row['Region']}" if row['Scenario'] == basis_scenario_name and row['Effect Size'] == 'Base'
-        else f"{row['Scenario']} {row['Effect Size']} {row['Region']}", axis=1
-    )
-
     fig = px.line(
         combined_df,
         x="year",
@@ -274,7 +255,7 @@ else:
     st.subheader("Zusammenfassende Statistiken")
 
     if not combined_df.empty:
-        summary_stats = combined_df.groupby(['Region', 'Label'])['Abbruchquote'].agg(['mean', 'std', 'min', 'max']).reset_index()
+        summary_stats = combined_df.groupby(['Region', 'Label'], observed=True)['Abbruchquote'].agg(['mean', 'std', 'min', 'max']).reset_index()
         summary_stats.columns = ['Region', 'Szenario Details', 'Mittelwert', 'Standardabweichung', 'Minimum', 'Maximum']
         # Format numerical columns as percentages for better readability
         summary_stats['Mittelwert'] = summary_stats['Mittelwert'].map('{:.2%}'.format)
@@ -4,10 +4,22 @@ import plotly.express as px
 import plotly.graph_objects as go
 import plotly.io as pio
 import requests
+import os
 from utils import apply_common_layout_settings, get_contrast_text_color
+from disk_cache import cached
+from dazubi_cube import DazubiCube, build_cube
+
+base_dir = os.path.dirname(os.path.abspath(__file__))
+csv_path = os.path.join(base_dir, 'data', 'dazubi_grouped_berufe.csv.bz2')
+
+# Berlin is our only special case for the keys of the map
+STATE_NAME_MAPPING = {
+    "Berlin (ab 1991 mit Berlin-Ost)": "Berlin"
+}
 
 # Load German GeoJSON data
 @st.cache_data
+@cached()
 def load_german_states_geojson():
     # URL for German states GeoJSON
     url = "https://raw.githubusercontent.com/isellsoap/deutschlandGeoJSON/main/2_bundeslaender/2_hoch.geo.json"
@@ -16,30 +28,33 @@ def load_german_states_geojson():
 
 # Daten laden
 @st.cache_data
+@cached(csv_path)
 def load_dataframe():
-    import os
-    base_dir = os.path.dirname(os.path.abspath(__file__))
-    csv_path = os.path.join(base_dir, 'data', 'dazubi_grouped_berufe.csv.bz2')
     df = pd.read_csv(csv_path, index_col=0)
     df.rename(columns={'Beruf_clean': 'Beruf'}, inplace=True)
-    # We need the plain state names to use them as keys in the map
-    # Berlin is our only special case
-    STATE_NAME_MAPPING = {
-        "Berlin (ab 1991 mit Berlin-Ost)": "Berlin"
-    }
-    df['Region_key'] = df['Region'].map(lambda x: STATE_NAME_MAPPING.get(x, x))
+    df['Region_key'] = df['Region'].map(region_key)
     return df
 
-@st.cache_data
-def load_data(df):
-    attributes = [x for x in df.columns if x not in ['Region', 'Region_key', 'Beruf', 'Jahr']]
+@st.cache_resource
+def load_cube():
+    # the charts are answered from the prebuilt cube (see dazubi_cube.py), memory-mapped
+    cube = DazubiCube.load()
+    if cube is None:
+        cube = build_cube(load_dataframe())
+    return cube
+
+def load_data(cube):
     return {
-        'states': df['Region'].unique(),
-        'jobs': df['Beruf'].unique(),
-        'years': df['Jahr'].unique(),
-        'attributes': attributes
+        'states': cube.axes['Region'],
+        'jobs': cube.axes['Beruf'],
+        'years': cube.axes['Jahr'],
+        'attributes': cube.attributes
     }
 
+def region_key(region):
+    # We need the plain state names to use them as keys in the map
+    return STATE_NAME_MAPPING.get(region, region)
+
 colors_chart = px.colors.qualitative.Set1
 
 def add_spike(fig, number_format, tickvals, attribute=None):
@@ -75,8 +90,8 @@ def add_spike(fig, number_format, tickvals, attribute=None):
 
 
 def app():
-    df = load_dataframe()
-    data = load_data(df)
+    cube = load_cube()
+    data = load_data(cube)
     type_analysis = 'Zeitreihe'
     selected_states = []
     selected_year = data['years'][-1]
@@ -134,22 +149,17 @@ def app():
     if len(selected_attributes) == 0:
         st.warning("Bitte wähle mindestens ein Merkmal aus.")
     else:
-        df_filtered = df.copy()
-        # At first filter the dataframe based on the selected years, states, jobs, and attributes
+        # The charts are sums over the selected years, states and jobs, they are answered from the cube
+        # (the same as filtering the dataframe and grouping it), without copying the data
         if type_analysis == 'Karte':
-            df_filtered = df_filtered[df_filtered['Jahr'] == selected_year]
-        if type_analysis == 'Zeitreihe' and len(selected_states) > 0:
-            df_filtered = df_filtered[df_filtered['Region'].isin(selected_states)]
-        if len(selected_jobs) > 0:
-            df_filtered = df_filtered[df_filtered['Beruf'].isin(selected_jobs)] 
+            selected_states = []
 
         if type_analysis == 'Zeitreihe':
             # What should happen, if we have more than one state and more than one job?
             if len(selected_states) > 1:
                 # If we have more than one state, we show a line chart per state
-                df_time = df_filtered.groupby(['Jahr', 'Region'])
                 for attribute in selected_attributes:
-                    df_attr = df_time[attribute].sum().reset_index()
+                    df_attr = cube.aggregate([attribute], ['Jahr', 'Region'], selected_states, selected_jobs)
                     # Define colors explicitly
                     fig = px.line(df_attr, x='Jahr', y=attribute, color='Region', 
                                 labels={'variable': 'Ausgewählte Bundesländer'}, 
@@ -162,16 +172,15 @@ def app():
                     st.plotly_chart(fig, use_container_width=True)
             elif len(selected_jobs) > 1:
                 # If we have more than one job, we show a line chart per job
-                df_time = df_filtered.groupby(['Jahr', 'Beruf'])
                 for attribute in selected_attributes:
-                    df_attr = df_time[attribute].sum().reset_index()
+                    df_attr = cube.aggregate([attribute], ['Jahr', 'Beruf'], selected_states, selected_jobs)
                     fig = px.line(df_attr, x='Jahr', y=attribute, color='Beruf', labels={'variable': 'Ausgewählte Berufe'}, color_discrete_sequence=colors_chart)
                     apply_common_layout_settings(fig, number_format_x='d', number_format_y=number_format)
                     add_spike(fig, number_format, data['years'], attribute)
                     st.plotly_chart(fig, use_container_width=True)
             else: 
                 # We have no selected states or jobs, so we show a line chart for the selected attributes
-                df_time = df_filtered.groupby(['Jahr'])[selected_attributes].sum().reset_index()
+                df_time = cube.aggregate(selected_attributes, ['Jahr'], selected_states, selected_jobs)
                 fig = px.line(df_time, x='Jahr', y=selected_attributes, labels={'variable': 'Ausgewählte Merkmale'}, color_discrete_sequence=colors_chart)
                 fig.update_layout(yaxis_title='')
                 apply_common_layout_settings(fig, number_format_x='d', number_format_y=number_format)
@@ -182,8 +191,9 @@ def app():
                 st.markdown(f'<h3 style="text-align: center;">Merkmal: {attribute}</h3>', unsafe_allow_html=True)
                 col1, col2 = st.columns(2)
                 with col1:
-                    # We group by Region and Region_key, so we can use Region_key as the key in the map and Region for the hover text
-                    df_map = df_filtered.groupby(['Region', 'Region_key'])[attribute].sum().reset_index()
+                    # We use Region_key as the key in the map and Region for the hover text
+                    df_map = cube.aggregate([attribute], ['Region'], jobs=selected_jobs, year=selected_year)
+                    df_map.insert(1, 'Region_key', df_map['Region'].map(region_key))
                     
                     # Create the choropleth map for German states
                     fig = px.choropleth(
@@ -220,12 +230,14 @@ def app():
 
                 with col2:
                     state = None
-                    df_map_filtered = df_filtered.copy()
+                    bar_states = []
                     if len(event_map.get('selection', {}).get('points', [])) > 0:
                         state = event_map.get('selection', {}).get('points', [])[0]['location']
                         if state is not None:
-                            df_map_filtered = df_map_filtered[df_map_filtered['Region_key'] == state]
-                    df_bar = df_map_filtered.groupby(['Beruf'])[attribute].sum().sort_values(ascending=False).reset_index()
+                            # a state without data gives an empty chart, like filtering the dataframe
+                            bar_states = [region for region in data['states'] if region_key(region) == state] or [None]
+                    df_bar = cube.aggregate([attribute], ['Beruf'], bar_states, selected_jobs, selected_year)
+                    df_bar = df_bar.set_index('Beruf')[attribute].sort_values(ascending=False).reset_index()
                     # take the top 15 and reverse the order, so the bar chart shows the longest at the top
                     df_bar = df_bar.head(15)[::-1]
                     # fig = px.bar(df_bar, x=attribute, y='Beruf', text_auto=True, orientation='h', height=len(df_bar) * 40)
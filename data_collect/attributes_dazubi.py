@@ -6,6 +6,7 @@ import requests
 from bs4 import BeautifulSoup
 import pandas as pd
 import term
+from replay_dazubi import add_fixture_arguments, mount_fixtures
 
 url = "https://www.bibb.de/dienst/dazubi/de/2252.php"
 url_excel = "https://www.bibb.de/dienst/dazubi/dazubi/timeserie/download/timeseries.xls?st[attribute]={attribute}&st[countries][0]={country}&st[occupations][0]={occupation}&st[year]={year}&st[search]=&department=10"
@@ -19,7 +20,7 @@ def get_dropdown_values(soup: BeautifulSoup, select_id: str):
 	options = select.find_all('option')
 	return [(option['value'], option.text.strip()) for option in options if option['value']]
 
-def download(url: str, retries=5):
+def download(url: str, retries=5, session: Optional[requests.Session] = None):
 	xls = None
 	r = 0
 	# we use while instead of for, so pylace doesn't complain about the return type
@@ -29,7 +30,7 @@ def download(url: str, retries=5):
 	while True:
 		response = None
 		try:
-			response = requests.get(url)
+			response = (session or requests).get(url)
 			return response
 			oo
 		except Exception as e:
@@ -147,11 +148,13 @@ def parse_arguments():
 	)
 	parser.add_argument('-d', '--download', action='store_true', help='Start the download process. You have to give this option, to do anything.')
 	parser.add_argument('-s', '--sleep', default=1.0, type=float, help='Time to sleep between the individuel downloads. Use a reasonable value to not overwhelming the server.')
+	add_fixture_arguments(parser)
 	return parser.parse_args()
 
 def main(args: argparse.Namespace):
+	session = mount_fixtures(requests.Session(), args.record, args.replay, args.latency)
 	# Get initial page
-	response = requests.get(url)
+	response = session.get(url)
 	soup = BeautifulSoup(response.content, 'html.parser')
 
 	# Get all dropdown values
@@ -172,7 +175,7 @@ def main(args: argparse.Namespace):
 			occ_id, occ_name = occupations[0]
 			year_id, year_name = years[0]
 			url_download = url_excel.format(attribute=attr_id, occupation=occ_id, year=year_id, country=country_id)
-			response = download(url_download)
+			response = download(url_download, session=session)
 			filepath = output_dir + '/attr/' + attr_name.replace('/', '_')
 			xls = pd.read_excel(BytesIO(response.content), sheet_name=None)
 			# with open(filepath + '.xlsx', 'wb') as file:
@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+"""
+Benchmark of the DAZUBI collector (download_dazubi.py) on recorded responses (see replay_dazubi.py).
+
+The stages of the collector run one after the other on a fresh cache:
+
+	download: the Excel files are fetched through the replay adapter (with a latency per response) into the cache
+	parse:    the files are parsed to fragments in the parse pool
+	assemble: the fragments are joined per occupation and saved as one CSV file
+
+For each stage the benchmark reports the files per second and the peak RSS of the process (and of the parse
+workers). Each stage runs in a fresh process, so the peak RSS belongs to that stage alone and isn't the peak
+of the stages before it. For the parse stage it also reports the parse time per sheet, split into read_excel
+and parse_excel (header detection and renaming).
+
+Usage:
+
+	python data_collect/benchmark_dazubi.py fixtures/dazubi --latency 0.2 -p 8 -P 4 --files 500
+"""
+import os, sys, time, argparse, tempfile, shutil, multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from contextlib import nullcontext
+from functools import partial
+from itertools import groupby
+from io import BytesIO
+import pandas as pd
+from download_dazubi import (DownloadCache, TokenBucket, base_url, build_tasks, create_session, fetch_cached, get_index,
+	join_attributes, ordered_map, parse_cached, parse_excel, save_parts, url_excel_path, url_path, write_parquet)
+
+try:
+	import resource
+except ImportError:
+	# not available on Windows
+	resource = None
+
+def peak_rss_mb(who: str = 'self'):
+	"""Peak RSS of the process ('self') or of its finished child processes ('children') in MB"""
+	if resource is None:
+		return None
+	usage = resource.getrusage(resource.RUSAGE_SELF if who == 'self' else resource.RUSAGE_CHILDREN)
+	# ru_maxrss is in bytes on macOS and in kilobytes on Linux
+	return usage.ru_maxrss / (1e6 if sys.platform == 'darwin' else 1e3)
+
+def timed_parse(cache_root: str, task: tuple):
+	"""
+	Parse one cached file (key, occ_name, country_name) like parse_cached and write the fragment
+
+	return
+		number of sheets (without the 'Deckblatt'), seconds of read_excel, seconds of parse_excel
+	"""
+	key, occ_name, country_name = task
+	cache = DownloadCache(cache_root)
+	entry = cache.entry(key)
+	start = time.perf_counter()
+	xls = pd.read_excel(BytesIO(cache.read_blob(entry['sha256'])), sheet_name=None)
+	read = time.perf_counter() - start
+	df = parse_excel(xls, occ_name, country_name, key[0])
+	rename = time.perf_counter() - start - read
+	cache.write_fragment(key, entry, df)
+	return sum(sheet != 'Deckblatt' for sheet in xls), read, rename
+
+def load_tasks(fixture_dir: str, files=None, workers=8, latency=0.0, url=base_url):
+	"""The replay session and the first `files` tasks of the index page"""
+	session = create_session(workers, replay=fixture_dir, latency=latency)
+	attributes, occupations, countries, years = get_index(session, url + url_path)
+	return session, build_tasks(url + url_excel_path, attributes, occupations, countries, years)[:files]
+
+def download_stage(fixture_dir: str, work_dir: str, files=None, workers=8, latency=0.0, rate=None, url=base_url) -> dict:
+	"""Only the network stage, the files are written to the cache"""
+	cache = DownloadCache(os.path.join(work_dir, 'cache'))
+	session, tasks = load_tasks(fixture_dir, files, workers, latency, url)
+	rate_limit = TokenBucket(rate) if rate else None
+	start = time.perf_counter()
+	with ThreadPoolExecutor(max_workers=workers) as pool:
+		fetch = lambda task: fetch_cached(cache, task[4], task[5], session=session, rate_limit=rate_limit)
+		for _ in ordered_map(pool, fetch, tasks, 2 * workers): pass
+	return {'stage': 'download', 'files': len(tasks), 'seconds': time.perf_counter() - start, 'peak_rss_mb': peak_rss_mb()}
+
+def parse_stage(fixture_dir: str, work_dir: str, files=None, parse_workers=os.cpu_count(), url=base_url) -> dict:
+	"""The parse stage on the cached files"""
+	cache = DownloadCache(os.path.join(work_dir, 'cache'))
+	_, tasks = load_tasks(fixture_dir, files, url=url)
+	start = time.perf_counter()
+	with (ProcessPoolExecutor(max_workers=parse_workers) if parse_workers > 0 else nullcontext()) as pool:
+		parse = partial(timed_parse, cache.root)
+		parse_tasks = [(task[4], task[2], task[1]) for task in tasks]
+		results = list(ordered_map(pool, parse, parse_tasks, 2 * parse_workers) if pool is not None else map(parse, parse_tasks))
+	sheets = sum(n for n, _, _ in results)
+	return {
+		'stage': 'parse', 'files': len(tasks), 'seconds': time.perf_counter() - start, 'sheets': sheets,
+		'read_ms_per_sheet': 1000 * sum(read for _, read, _ in results) / max(sheets, 1),
+		'rename_ms_per_sheet': 1000 * sum(rename for _, _, rename in results) / max(sheets, 1),
+		'peak_rss_mb': peak_rss_mb(), 'peak_rss_workers_mb': peak_rss_mb('children'),
+	}
+
+def assemble_stage(fixture_dir: str, work_dir: str, files=None, url=base_url) -> dict:
+	"""Join the fragments per occupation, write the parts and the CSV file"""
+	cache = DownloadCache(os.path.join(work_dir, 'cache'))
+	_, tasks = load_tasks(fixture_dir, files, url=url)
+	start = time.perf_counter()
+	parts = []
+	for (country_name, occ_name), occ_tasks in groupby(tasks, key=lambda task: task[1:3]):
+		frames = []
+		for task in occ_tasks:
+			df_attr, _ = parse_cached(cache.root, (task[4], occ_name, country_name, 'cached'))
+			if len(df_attr.columns) > 0: frames.append((task[3], df_attr))
+		df_occ = join_attributes(frames) if frames else pd.DataFrame()
+		if len(df_occ) > 0:
+			parts.append(os.path.join(work_dir, 'occ', f'dazubi_{task[0]:06d}.parquet'))
+			os.makedirs(os.path.dirname(parts[-1]), exist_ok=True)
+			write_parquet(df_occ, parts[-1])
+	n_rows, n_columns = save_parts(parts, os.path.join(work_dir, 'dazubi_complete.csv'))
+	return {
+		'stage': 'assemble', 'files': len(tasks), 'seconds': time.perf_counter() - start, 'rows': n_rows, 'columns': n_columns,
+		'peak_rss_mb': peak_rss_mb(),
+	}
+
+def in_fresh_process(function, *args):
+	"""
+	Call function in a new (spawned) process, so its peak RSS doesn't include the stages before it
+	(ru_maxrss is the peak over the lifetime of a process). On Linux the new process starts with the peak of its
+	parent, which only starts the stages and stays small.
+	"""
+	with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as pool:
+		return pool.submit(function, *args).result()
+
+def benchmark(fixture_dir: str, work_dir: str, files=None, workers=8, parse_workers=os.cpu_count(), latency=0.0, rate=None, url=base_url) -> pd.DataFrame:
+	"""Run the stages on the fixtures, each in a fresh process, and return one row of measurements per stage"""
+	rows = [
+		in_fresh_process(download_stage, fixture_dir, work_dir, files, workers, latency, rate, url),
+		in_fresh_process(parse_stage, fixture_dir, work_dir, files, parse_workers, url),
+		in_fresh_process(assemble_stage, fixture_dir, work_dir, files, url),
+	]
+	df = pd.DataFrame(rows).set_index('stage')
+	df.insert(2, 'files_per_s', df['files'] / df['seconds'])
+	return df
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(
+		formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+		description="Benchmark the stages of the DAZUBI collector on recorded responses",
+	)
+	parser.add_argument('fixture_dir', help='Directory with the recorded responses (download_dazubi.py --record)')
+	parser.add_argument('-f', '--files', default=None, type=int, help='Number of Excel files (default: all files of the index page).')
+	parser.add_argument('-p', '--workers', default=8, type=int, help='Number of parallel downloads.')
+	parser.add_argument('-P', '--parse-workers', default=os.cpu_count(), type=int, help='Number of processes that parse the Excel files (0: parse in the main process).')
+	parser.add_argument('--latency', default=0.0, type=float, help='Latency of each replayed response in seconds.')
+	parser.add_argument('-r', '--rate', default=None, type=float, help='Maximum number of downloads per second (default: no limit).')
+	parser.add_argument('--base-url', default=base_url, help='Base URL of the recorded responses.')
+	parser.add_argument('--work-dir', default=None, help='Directory for the cache and the output (default: a temporary directory, removed at the end).')
+	args = parser.parse_args()
+
+	work_dir = args.work_dir or tempfile.mkdtemp(prefix='benchmark_dazubi_')
+	try:
+		result = benchmark(args.fixture_dir, work_dir, args.files, args.workers, args.parse_workers, args.latency, args.rate, args.base_url)
+	finally:
+		if args.work_dir is None:
+			shutil.rmtree(work_dir, ignore_errors=True)
+	print(result.to_string(float_format='{:.2f}'.format))
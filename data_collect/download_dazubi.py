@@ -1,30 +1,53 @@
 #!/usr/bin/env python
-import os, re, math, time, argparse, glob, sys
+import os, re, math, time, argparse, glob, sys, random, threading, hashlib, json, bz2, shutil
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from functools import partial
+from contextlib import nullcontext
+from itertools import groupby
 from typing import Optional, Tuple
 from io import BytesIO
 import requests
+from requests.adapters import HTTPAdapter
 from bs4 import BeautifulSoup
 import pandas as pd
+import pyarrow.parquet as pq
 import term
+from replay_dazubi import add_fixture_arguments, mount_fixtures
 
 # Base URL and directory for saving files
-url = "https://www.bibb.de/dienst/dazubi/de/2252.php"
-url_excel = "https://www.bibb.de/dienst/dazubi/dazubi/timeserie/download/timeseries.xls?st[attribute]={attribute}&st[countries][0]={country}&st[occupations][0]={occupation}&st[year]={year}&st[search]=&department=10"
+base_url = "https://www.bibb.de"
+url_path = "/dienst/dazubi/de/2252.php"
+url_excel_path = "/dienst/dazubi/dazubi/timeserie/download/timeseries.xls?st[attribute]={attribute}&st[countries][0]={country}&st[occupations][0]={occupation}&st[year]={year}&st[search]=&department=10"
+url = base_url + url_path
+url_excel = base_url + url_excel_path
 output_dir = "data"
 output_dir_occ = f"{output_dir}/occ"
 output_dir_attr = f"{output_dir}/attr"
 output_file = output_dir + '/dazubi_complete.csv'
+# the first bytes of an xls (OLE2) and an xlsx (zip) file
+excel_signatures = (b'\xd0\xcf\x11\xe0', b'PK\x03\x04')
+cache_dir = f"{output_dir}/cache"
 
 def parse_arguments():
 	parser = argparse.ArgumentParser(
 		formatter_class=argparse.ArgumentDefaultsHelpFormatter,
 		description="Dowload the files from DAZUBI and convert them to a csv file",
 	)
-	parser.add_argument('-w', '--start-with', type=int, default=0, help="For Debugging: Start with this file and skip the previous ones.")
-	parser.add_argument('-a', '--save-attributes', action='store_true', help="For Debugging: Save csv file after each attribute. You only need this, if you want to check the parsing of single Excel files.")
+	parser.add_argument('-w', '--start-with', type=int, default=0, help="For Debugging: Start with this file, the previous ones are only taken from the cache.")
+	parser.add_argument('-a', '--save-attributes', action='store_true', help="For Debugging: Save a csv file for each attribute. You only need this, if you want to check the parsing of single Excel files.")
 	parser.add_argument('-d', '--download', action='store_true', help='Start the download process. You have to give this option, to do anything.')
-	parser.add_argument('-s', '--sleep', default=1.0, type=float, help='Time to sleep between the individuel downloads. Use a reasonable value to not overwhelming the server.')
-	parser.add_argument('-x', '--write-skip', type=int, default=0, help='Write only each x\'th file.')
+	parser.add_argument('-s', '--sleep', default=1.0, type=float, help='Time to sleep between the individuel downloads. Use a reasonable value to not overwhelming the server. Only used if --rate is not given (rate = 1 / sleep, 0: no rate limit).')
+	parser.add_argument('-r', '--rate', default=None, type=float, help='Maximum number of downloads per second (over all workers).')
+	parser.add_argument('-p', '--workers', default=1, type=int, help='Number of parallel downloads.')
+	parser.add_argument('-P', '--parse-workers', default=os.cpu_count(), type=int, help='Number of processes that parse the Excel files (0: parse in the main process).')
+	parser.add_argument('--retries', default=5, type=int, help='Number of retries of a failed download (with exponential backoff).')
+	parser.add_argument('--base-url', default=base_url, help='Base URL of DAZUBI, e.g. a local server for testing.')
+	parser.add_argument('--cache-dir', default=cache_dir, help='Directory of the download cache (Excel files and parsed fragments).')
+	parser.add_argument('--max-age', default=0.0, type=float, help='Use cached files checked less than this many seconds ago without asking the server, e.g. to continue an interrupted download.')
+	parser.add_argument('--offline', action='store_true', help="Don't download the Excel files, assemble the dataset from the cache (only the index page is requested).")
+	parser.add_argument('--limit', default=None, type=int, help='For Debugging: Only the first files, e.g. to record a sample with --record.')
+	add_fixture_arguments(parser)
 	parser.add_argument('-n', '--no-sanity-check', action='store_true', help='No sanity check when deleting old files.')
 	parser.add_argument('-c', '--compress', action='store_true', help='Compress the CSV files.')
 	return parser.parse_args()
@@ -67,13 +90,13 @@ def cleanup_dazubi_files(dir, keep: int = 10, sanity_check: bool = True):
 
 	if sanity_check:
 		# Check: Each file with a lower number must be smaller and older than each file with a higher number
-		for i in range(len(files)):
-			for j in range(i+1, len(files)):
-				if not (files[i]["size"] <= files[j]["size"] and files[i]["mtime"] <= files[j]["mtime"]):
-					raise RuntimeError(
-						f"File {files[i]['path']} is not smaller/older than {files[j]['path']}.\n"
-						f"Properties of files:\n\t{files[i]}\nvs.\n\t{files[j]}"
-					)
+		# size and age are compared with <=, so it's enough to compare each file with the next one
+		for lower, higher in zip(files, files[1:]):
+			if not (lower["size"] <= higher["size"] and lower["mtime"] <= higher["mtime"]):
+				raise RuntimeError(
+					f"File {lower['path']} is not smaller/older than {higher['path']}.\n"
+					f"Properties of files:\n\t{lower}\nvs.\n\t{higher}"
+				)
 
 	for f in files[:-keep]:
 		term.up(value=1)
@@ -131,6 +154,47 @@ def save_dataframe(
 			os.remove(tmp_filename)
 		raise
 
+def save_parts(parts: list[str], filename: str = output_file, compress: bool = False) -> Tuple[int, int]:
+	"""
+	Save the Parquet files of the occupations (see write_parquet) as one CSV file.
+
+	The parts are written one after the other, so only one part is in memory. The columns are the union of the
+	columns of all parts, in the order they first appear. Like save_dataframe, the file is written to a temporary
+	file first and then moved to the target location.
+
+	return
+		number of rows and columns
+	"""
+	compression = 'bz2'
+	dirname = os.path.dirname(filename)
+	if dirname and not os.path.exists(dirname):
+		os.makedirs(dirname, exist_ok=True)
+	if compress:
+		filename += '.' + compression
+	tmp_filename = filename + '.tmp'
+	# only the schemas are read to get the columns
+	columns = list(dict.fromkeys(col for part in parts for col in pq.read_schema(part).names))
+	rows = 0
+	try:
+		term.up(value=2)
+		term.clearLine()
+		print(f'Saving: {filename}')
+		term.down(value=1)
+		with (bz2.open(tmp_filename, 'wt', newline='') if compress else open(tmp_filename, 'w', newline='')) as f:
+			for part in parts:
+				df = pd.read_parquet(part).reindex(columns=columns)
+				df.index = pd.RangeIndex(rows, rows + len(df))
+				df.to_csv(f, header=rows == 0)
+				rows += len(df)
+			if rows == 0:
+				pd.DataFrame().to_csv(f)
+		os.replace(tmp_filename, filename)
+	except (KeyboardInterrupt, OSError):
+		if os.path.exists(tmp_filename):
+			os.remove(tmp_filename)
+		raise
+	return rows, len(columns)
+
 def get_dropdown_values(soup: BeautifulSoup, select_id: str):
 	"""Extract values from dropdown menu"""
 	select = soup.find('select', {'id': select_id})
@@ -184,65 +248,357 @@ def rename_columns(df: pd.DataFrame) -> pd.DataFrame:
 		raise
 	return df
 
-from pandas import DataFrame
+def unique_columns(columns, seen: Optional[set] = None) -> list[str]:
+	"""
+	The column names made unique the way pandas reads a CSV file with duplicate columns: the second 'X' becomes 'X.1',
+	the third 'X.2' and so on. Names in seen count as taken, seen is updated with the returned names.
+	"""
+	seen = set() if seen is None else seen
+	result = []
+	for col in columns:
+		name, n = col, 0
+		while name in seen:
+			n += 1
+			name = f'{col}.{n}'
+		seen.add(name)
+		result.append(name)
+	return result
 
-def restore_download() -> Tuple[int, DataFrame]:
-	'''
-	if we already donwloaded files, create a DataFrame from the file with the highest number (the last file)
+def merge_attribute(df_occ: pd.DataFrame, df_attr: pd.DataFrame, attr_id: str) -> pd.DataFrame:
+	"""
+	Merge the DataFrame of a sheet on the 'Jahr' column, columns that already exist get the suffix _<attr_id>
+	(made unique like in unique_columns, if the suffixed name exists as well)
+	"""
+	if 'Jahr' in df_occ.columns and 'Jahr' in df_attr.columns:
+		# take Beruf and Region in the on-clause to not duplicate these columns
+		on = ['Jahr', 'Beruf', 'Region']
+		seen = set(df_occ.columns)
+		names = [
+			col if col in on else unique_columns([f'{col}_{attr_id}' if col in df_occ.columns else col], seen)[0]
+			for col in df_attr.columns
+		]
+		return pd.merge(df_occ, df_attr.set_axis(names, axis=1), on=on, how='outer')
+	return pd.concat([df_occ, df_attr], axis=1)
 
-	The restore only works, if the countries and occupation stays the same between the download sessions
-	The attributes doesn't matter, because the downloads for the attributes are not restored
-	
-	return
-		highest number + 1 - use this as index for the next file to download
-		DataFrame with data from the last csv file
-	'''
-	pattern = re.compile(r'dazubi_(\d+)\.csv.*$')
-	max_number = -1
-	max_filename = None
-	if os.path.exists(output_dir_occ):
-		for filename in os.listdir(output_dir_occ):
-			match = pattern.match(filename)
-			if match:
-				number = int(match.group(1))
-				if number > max_number:
-					max_number = number
-					max_filename = filename
-	if max_filename is not None:
+def join_attributes(frames: list[Tuple[str, pd.DataFrame]]) -> pd.DataFrame:
+	"""
+	Outer join of the DataFrames of the attributes (attr_id, DataFrame) of one occupation on 'Jahr', 'Beruf' and 'Region'.
+
+	All DataFrames are joined in one step instead of merging them one after the other (quadratic in the number of
+	attributes). Columns that already exist get the suffix _<attr_id>, like in merge_attribute. If that name exists as
+	well (e.g. the sheets of the attribute file already produced 'Insgesamt_a2'), it is made unique like in unique_columns.
+	Beruf and Region are the same in all rows of one occupation, so the join only needs the 'Jahr' column.
+	"""
+	keys = ['Jahr', 'Beruf', 'Region']
+	indexed = [
+		df_attr.drop(columns=keys[1:]).set_index('Jahr') if set(keys) <= set(df_attr.columns) else None
+		for _, df_attr in frames
+	]
+	if any(df_attr is None or not df_attr.index.is_unique for df_attr in indexed):
+		# the join needs unique years, otherwise merge one after the other
+		df_occ = pd.DataFrame()
+		for attr_id, df_attr in frames:
+			df_occ = merge_attribute(df_occ, df_attr, attr_id)
+		df_occ.columns = unique_columns(df_occ.columns)
+		return df_occ
+	seen = set(keys)
+	for (attr_id, _), df_attr in zip(frames, indexed):
+		# the names of this attribute are only checked against the previous attributes, like the suffixes of the merge
+		suffixed = [f'{col}_{attr_id}' if col in seen else col for col in df_attr.columns]
+		df_attr.columns = unique_columns(suffixed, seen)
+	df_occ = pd.concat(indexed, axis=1, join='outer')
+	try:
+		# sorted like the outer merge
+		df_occ.sort_index(inplace=True)
+	except TypeError:
+		pass
+	first = next((df_attr for _, df_attr in frames if len(df_attr) > 0), frames[0][1])
+	df_keys = pd.DataFrame({
+		'Jahr': df_occ.index,
+		'Beruf': first['Beruf'].iloc[0] if len(first) > 0 else None,
+		'Region': first['Region'].iloc[0] if len(first) > 0 else None,
+	})
+	return pd.concat([df_keys, df_occ.reset_index(drop=True)], axis=1)
+
+def parse_excel(xls: dict[str, pd.DataFrame], occ_name: str, country_name: str, attr_id: str) -> pd.DataFrame:
+	"""
+	Convert the sheets of one Excel file (without the 'Deckblatt') to one DataFrame, merged on the 'Jahr' column
+
+	The merge gives every sheet's copy of a column the same suffix (e.g. 'Insgesamt', 'Insgesamt_7', 'Insgesamt_7'),
+	Parquet needs unique names, so the duplicates are renamed (see unique_columns).
+	"""
+	df_file = pd.DataFrame()
+	for sheet, df_attr in xls.items():
+		if sheet != 'Deckblatt':
+			df_attr = rename_columns(df_attr)
+			df_attr.insert(1, 'Beruf', occ_name)
+			df_attr.insert(2, 'Region', country_name)
+			df_file = merge_attribute(df_file, df_attr, attr_id)
+	df_file.columns = unique_columns(df_file.columns)
+	return df_file
+
+def write_atomic(path: str, write):
+	"""Call write with a temporary filename and rename the file afterwards, so there are never half written files"""
+	tmp_path = f'{path}.{threading.get_ident()}.tmp'
+	try:
+		write(tmp_path)
+		os.replace(tmp_path, path)
+	except BaseException:
+		if os.path.exists(tmp_path):
+			os.remove(tmp_path)
+		raise
+
+def write_parquet(df: pd.DataFrame, path: str):
+	"""Write df atomically as Parquet file"""
+	df = df.copy()
+	for i in range(len(df.columns)):
+		# Parquet needs one type per column, but the Excel cells can mix numbers and text
+		col = df.iloc[:, i]
+		if col.dtype == object and pd.api.types.infer_dtype(col, skipna=True).startswith('mixed'):
+			df.isetitem(i, col.map(lambda value: value if pd.isna(value) else str(value)))
+	write_atomic(path, lambda tmp_path: df.to_parquet(tmp_path, index=False))
+
+class DownloadCache:
+	"""
+	Content-addressed cache of the DAZUBI Excel files.
+
+	The raw files are stored under the SHA-256 of their content (blobs/<sha>.xls), so identical files are stored once.
+	For each key (attribute, occupation, country, year) there is an entry (keys/<key>.json) with the SHA-256 of the
+	current content, the ETag and Last-Modified header of the response (for conditional requests) and the time of the
+	last check. The parsed file is stored per key as Parquet fragment (fragments/<key>.parquet), together with the
+	SHA-256 of the content it was parsed from, so a file is only parsed again if its content changed.
+	"""
+	def __init__(self, root: str = cache_dir):
+		self.root = root
+		for subdir in ('blobs', 'keys', 'fragments'):
+			os.makedirs(os.path.join(root, subdir), exist_ok=True)
+
+	@staticmethod
+	def key_name(key: tuple) -> str:
+		return hashlib.sha256('|'.join(map(str, key)).encode()).hexdigest()
+
+	def entry(self, key: tuple) -> dict:
+		"""The entry of key, an empty dict if the key is not cached"""
 		try:
-			df = pd.read_csv(os.path.join(output_dir_occ, max_filename), index_col=0)
-			print(f'===> restore file {max_filename} with {len(df)} rows')
-			return max_number+1, df
-		except Exception as e:
-			print(f'{term.red}Can not read the file {max_filename}. Remove the file and restart.', file=sys.stderr)
-			raise
-	else:
-		print('===> Nothing to restore')
-		return 0, pd.DataFrame()
+			with open(os.path.join(self.root, 'keys', self.key_name(key) + '.json'), encoding='utf-8') as f:
+				return json.load(f)
+		except (OSError, ValueError):
+			return {}
 
-def download_convert(url: str, retries=5) -> dict[str, pd.DataFrame]:
-	xls = None
+	def save_entry(self, key: tuple, entry: dict):
+		def write(path):
+			with open(path, 'w', encoding='utf-8') as f:
+				json.dump(entry, f, ensure_ascii=False)
+		write_atomic(os.path.join(self.root, 'keys', self.key_name(key) + '.json'), write)
+
+	def blob_path(self, sha: str) -> str:
+		return os.path.join(self.root, 'blobs', sha + '.xls')
+
+	def has_content(self, entry: dict) -> bool:
+		return 'sha256' in entry and os.path.exists(self.blob_path(entry['sha256']))
+
+	def read_blob(self, sha: str) -> bytes:
+		with open(self.blob_path(sha), 'rb') as f:
+			return f.read()
+
+	def write_blob(self, content: bytes) -> str:
+		"""Store content (if it isn't stored yet) and return its SHA-256"""
+		sha = hashlib.sha256(content).hexdigest()
+		if not os.path.exists(self.blob_path(sha)):
+			def write(path):
+				with open(path, 'wb') as f:
+					f.write(content)
+			write_atomic(self.blob_path(sha), write)
+		return sha
+
+	def fragment_path(self, key: tuple) -> str:
+		return os.path.join(self.root, 'fragments', self.key_name(key) + '.parquet')
+
+	def read_fragment(self, key: tuple, entry: dict) -> Optional[pd.DataFrame]:
+		"""The parsed fragment of key, None if there is none or it was parsed from another content"""
+		if entry.get('fragment') != entry.get('sha256') or not os.path.exists(self.fragment_path(key)):
+			return None
+		return pd.read_parquet(self.fragment_path(key))
+
+	def write_fragment(self, key: tuple, entry: dict, df: pd.DataFrame):
+		write_parquet(df, self.fragment_path(key))
+		entry['fragment'] = entry['sha256']
+		self.save_entry(key, entry)
+
+	def invalidate(self, key: tuple):
+		"""Remove the entry of key and its file, so the file is downloaded again"""
+		entry = self.entry(key)
+		for path in (os.path.join(self.root, 'keys', self.key_name(key) + '.json'), self.blob_path(entry.get('sha256', ''))):
+			if os.path.exists(path):
+				os.remove(path)
+
+class TokenBucket:
+	"""
+	Thread-safe token bucket: on average at most `rate` acquisitions per second, bursts up to `capacity`.
+	"""
+	def __init__(self, rate: float, capacity: float = 1.0):
+		self.rate = rate
+		self.capacity = capacity
+		self.tokens = capacity
+		self.updated = time.monotonic()
+		self.lock = threading.Lock()
+
+	def acquire(self):
+		"""Take one token, wait until one is available."""
+		while True:
+			with self.lock:
+				now = time.monotonic()
+				self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+				self.updated = now
+				if self.tokens >= 1:
+					self.tokens -= 1
+					return
+				wait = (1 - self.tokens) / self.rate
+			time.sleep(wait)
+
+def create_session(workers: int = 1, record: Optional[str] = None, replay: Optional[str] = None, latency: float = 0.0) -> requests.Session:
+	"""
+	HTTP session with keep-alive connections for all workers.
+	The responses are recorded to the directory record or replayed from the directory replay (see replay_dazubi).
+	"""
+	session = requests.Session()
+	adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(workers, 1))
+	session.mount('http://', adapter)
+	session.mount('https://', adapter)
+	return mount_fixtures(session, record, replay, latency, max(workers, 1))
+
+def backoff_delay(attempt: int, response: Optional[requests.Response] = None, base: float = 1.0, maximum: float = 60.0) -> float:
+	"""
+	Seconds to wait before the next attempt: exponential with jitter (base * 2^attempt, at most maximum),
+	or the Retry-After header of the server, if it sent one.
+	"""
+	if response is not None:
+		retry_after = response.headers.get('Retry-After')
+		if retry_after is not None and retry_after.isdigit():
+			return min(float(retry_after), maximum)
+	return min(maximum, base * 2 ** attempt) * random.uniform(0.5, 1.0)
+
+def download(url: str, retries=5, session: Optional[requests.Session] = None, rate_limit: Optional[TokenBucket] = None, headers: Optional[dict] = None, convert=None):
+	"""
+	Download url and return convert(response) (or the response, if convert is None).
+	An exception in convert (e.g. the server sent an error page instead of an Excel file) is retried like a failed download.
+	"""
 	r = 0
 	# we use while instead of for, so pylace doesn't complain about the return type
-	# if the creation of the DataFrame was successful, we return it
-	# if we got an exception, we retry a fixed number of times and than raise the error 
+	# if the download and conversion was successful, we return the result
+	# if we got an exception, we retry a fixed number of times (waiting longer after each attempt) and than raise the error 
 	# in both cases we break out of the while loop
 	while True:
 		response = None
 		try:
-			response = requests.get(url)
-			xls = pd.read_excel(BytesIO(response.content), sheet_name=None)
-			return xls
+			if rate_limit is not None: rate_limit.acquire()
+			response = (session or requests).get(url, headers=headers)
+			response.raise_for_status()
+			return convert(response) if convert is not None else response
 		except Exception as e:
 			print(f'{r} attempt, Exception: {type(e).__name__} - {e}')
 			if response is not None:
 				print(f'Status: {response.status_code}, Content-Type: {response.headers.get("Content-Type")}, Content-Length: {response.headers.get("Content-Length")}')
 			if r >= retries: raise
-			else: r += 1
+			else:
+				time.sleep(backoff_delay(r, response))
+				r += 1
 
-def main(args: argparse.Namespace):
+def download_convert(url: str, retries=5, session: Optional[requests.Session] = None, rate_limit: Optional[TokenBucket] = None) -> dict[str, pd.DataFrame]:
+	return download(url, retries, session, rate_limit, convert=lambda response: pd.read_excel(BytesIO(response.content), sheet_name=None))
+
+def check_excel(response: requests.Response) -> requests.Response:
+	"""Raise an error if the response is no Excel file (e.g. an error page), so it is downloaded again"""
+	if response.status_code != 304 and not response.content.startswith(excel_signatures):
+		raise ValueError(f'No Excel file, Content-Type: {response.headers.get("Content-Type")}')
+	return response
+
+def fetch_cached(
+	cache: DownloadCache,
+	key: tuple,
+	url: str,
+	max_age: float = 0.0,
+	offline: bool = False,
+	retries=5,
+	session: Optional[requests.Session] = None,
+	rate_limit: Optional[TokenBucket] = None
+) -> str:
+	"""
+	Download the Excel file of key (attribute, occupation, country, year) to the cache, only if it changed.
+
+	A cached file is checked with a conditional request (If-None-Match / If-Modified-Since), unless it was checked less
+	than max_age seconds ago or offline is True. The file is not parsed here (see parse_cached).
+
+	return
+		the status: 'cached' (no request), 'unchanged' (not modified or the same content), 'downloaded'
+		or 'missing' (offline and the key is not cached)
+	"""
+	entry = cache.entry(key)
+	cached = cache.has_content(entry)
+	if cached and (offline or time.time() - entry.get('checked', 0) < max_age):
+		return 'cached'
+	if offline:
+		return 'missing'
+	headers = {}
+	if cached and entry.get('etag'): headers['If-None-Match'] = entry['etag']
+	if cached and entry.get('last_modified'): headers['If-Modified-Since'] = entry['last_modified']
+	response = download(url, retries, session, rate_limit, headers or None, check_excel)
+	if response.status_code == 304:
+		sha = entry['sha256']
+	else:
+		sha = cache.write_blob(response.content)
+		entry.update(etag=response.headers.get('ETag'), last_modified=response.headers.get('Last-Modified'))
+	status = 'unchanged' if sha == entry.get('sha256') else 'downloaded'
+	entry.update(key=list(key), sha256=sha, checked=time.time())
+	cache.save_entry(key, entry)
+	return status
+
+def parse_cached(cache_root: str, task: tuple) -> Tuple[Optional[pd.DataFrame], str]:
+	"""
+	The parsed Excel file of a task (key, occ_name, country_name, status), runs in a worker process of the parse pool.
+
+	The file is only parsed if there is no fragment of its current content in the cache. If the parsing fails, the
+	cache entry is removed, so the file is downloaded again in the next run.
+
+	return
+		the DataFrame (see parse_excel), None if the status is 'missing'
+		the status
+	"""
+	key, occ_name, country_name, status = task
+	if status == 'missing':
+		return None, status
+	cache = DownloadCache(cache_root)
+	entry = cache.entry(key)
+	df = cache.read_fragment(key, entry)
+	if df is None:
+		try:
+			xls = pd.read_excel(BytesIO(cache.read_blob(entry['sha256'])), sheet_name=None)
+			df = parse_excel(xls, occ_name, country_name, key[0])
+		except Exception:
+			cache.invalidate(key)
+			raise
+		cache.write_fragment(key, entry, df)
+	return df, status
+
+def ordered_map(executor, fn, items, ahead: int):
+	"""
+	Submit fn(item) for each item to the executor, the results are returned in the order of the items.
+
+	At most `ahead` results are submitted but not consumed yet. This is the bounded queue between two stages
+	(e.g. downloads and parsing), so a slow consumer doesn't let the memory grow.
+	"""
+	pending = deque()
+	for item in items:
+		pending.append(executor.submit(fn, item))
+		if len(pending) >= ahead:
+			yield pending.popleft().result()
+	while pending:
+		yield pending.popleft().result()
+
+def get_index(session: requests.Session, page_url: str):
+	"""The dropdown values (attributes, occupations, countries, years) of the DAZUBI page"""
 	# Get initial page
-	response = requests.get(url)
+	response = session.get(page_url)
 	soup = BeautifulSoup(response.content, 'html.parser')
 
 	# Get all dropdown values
@@ -250,63 +606,85 @@ def main(args: argparse.Namespace):
 	occupations = get_dropdown_values(soup, 'st_occupations')
 	countries = get_dropdown_values(soup, 'st_countries')
 	years = get_dropdown_values(soup, 'st_year')
+	return attributes, occupations, countries, years
+
+def build_tasks(excel_url: str, attributes, occupations, countries, years) -> list[tuple]:
+	"""
+	One task (index, country_name, occ_name, attr_id, key, url) per Excel file, ordered by country, occupation and attribute
+	"""
+	# iterate over each country, each occupation and each attribute
+	# for the year we just take the first value, than we get all years
+	year_id, year_name = years[0]
+	return [
+		(i, country_name, occ_name, attr_id, (attr_id, occ_id, country_id, year_id), excel_url.format(attribute=attr_id, occupation=occ_id, year=year_id, country=country_id))
+		for i, ((country_id, country_name), (occ_id, occ_name), (attr_id, attr_name)) in enumerate(
+			(country, occ, attr) for country in countries for occ in occupations for attr in attributes
+		)
+	]
+
+def main(args: argparse.Namespace):
+	session = create_session(args.workers, args.record, args.replay, args.latency)
+	attributes, occupations, countries, years = get_index(session, args.base_url + url_path)
 	
 	print(f'===> {len(attributes)} attributes, {len(occupations)} occupations, {len(countries)} countries, {len(years)} years')
 	complete = len(attributes) * len(occupations) * len(countries)
 	
-	cnt = 0
-	cnt_write = 0
-	start_with, df = restore_download()
-	start_with = max(start_with, args.start_with)
 	print('\n\n\n')
-	if (args.download):
+	cnt = 0
+	if (args.download or args.offline):
 		start = time.time()
-		# iterate over each country, each occupation and each attribute
-		# for the year we just take the first value, than we get all years
-		for country_id, country_name in countries:
-			for occ_id, occ_name in occupations:
-				df_occ = pd.DataFrame()
+		cache = DownloadCache(args.cache_dir)
+		tasks = build_tasks(args.base_url + url_excel_path, attributes, occupations, countries, years)[:args.limit]
+		# two stages: the downloads run in a pool of threads (limited to args.rate per second), the parsing of the
+		# Excel files (CPU-bound) in a pool of processes, the results are merged in order
+		# --sleep 0 without --rate: no rate limit
+		rate = args.rate or (1.0 / args.sleep if args.sleep > 0 else None)
+		rate_limit = TokenBucket(rate) if rate else None
+		def fetch(task):
+			i, country_name, occ_name, attr_id, key, url_download = task
+			status = fetch_cached(
+				cache, key, url_download, args.max_age, args.offline or i < args.start_with, args.retries, session, rate_limit
+			)
+			return key, occ_name, country_name, status
+		with ThreadPoolExecutor(max_workers=args.workers) as download_pool, \
+			(ProcessPoolExecutor(max_workers=args.parse_workers) if args.parse_workers > 0 else nullcontext()) as parse_pool:
+			fetched = ordered_map(download_pool, fetch, tasks, 2 * args.workers)
+			if parse_pool is not None:
+				downloads = ordered_map(parse_pool, partial(parse_cached, cache.root), fetched, 2 * args.parse_workers)
+			else:
+				downloads = map(partial(parse_cached, cache.root), fetched)
+			statuses = {}
+			# the DataFrame of each country and job is written to its own Parquet file (the parts of the complete file)
+			# so only the DataFrame of the current country and job is in memory
+			parts = []
+			shutil.rmtree(output_dir_occ, ignore_errors=True)
+			os.makedirs(output_dir_occ, exist_ok=True)
+			for (country_name, occ_name), occ_tasks in groupby(tasks, key=lambda task: task[1:3]):
+				frames = []
 				# we create a DataFrame that contains each attribute for the current country and job
-				# this DataFrame is appended to the final DataFrame
-				for attr_id, attr_name in attributes:
-					# for the attributes DataFrame, we create a separate DataFrame for each sheet in each Excel file
-					# these DataFrames are merged on the 'Jahr' column
-					year_id, year_name = years[0]
-					url_download = url_excel.format(attribute=attr_id, occupation=occ_id, year=year_id, country=country_id)
-					if cnt >= start_with:
-						term.up(value=2)
-						term.up(value=1)
-						term.clearLine()
-						term.up(value=1)
-						term.clearLine()
-						print(f'{cnt:6d} / {complete} {round(time.time() - start):6d}s {url_download}')
-						term.down(value=2)
-						xls = download_convert(url_download)
-						for sheet, df_attr in xls.items():
-							if sheet != 'Deckblatt':
-								df_attr = rename_columns(df_attr)
-								df_attr.insert(1, 'Beruf', occ_name)
-								df_attr.insert(2, 'Region', country_name)
-								if 'Jahr' in df_occ.columns and 'Jahr' in df_attr.columns: 
-									# take Beruf and Region in the on-clause to not duplicate these columns
-									df_occ = pd.merge(df_occ, df_attr, suffixes=(None, f'_{attr_id}'), on=['Jahr', 'Beruf', 'Region'], how='outer')
-								else:
-									df_occ = pd.concat([df_occ, df_attr], axis=1)
-								if args.save_attributes: save_dataframe(df_occ, f'{output_dir_attr}/dazubi_{cnt:06d}.csv', compress=args.compress, sanity_check=not args.no_sanity_check)
-						# add sleep to avoid overwhelming the server
-						time.sleep(args.sleep)
-					cnt += 1
+				for cnt, _, _, attr_id, _, url_download in occ_tasks:
+					# each Excel file is parsed to one DataFrame (a fragment in the cache), they are joined on the 'Jahr' column
+					df_attr, status = next(downloads)
+					statuses[status] = statuses.get(status, 0) + 1
+					term.up(value=2)
+					term.up(value=1)
+					term.clearLine()
+					term.up(value=1)
+					term.clearLine()
+					print(f'{cnt:6d} / {complete} {round(time.time() - start):6d}s {status:10s} {url_download}')
+					term.down(value=2)
+					if df_attr is not None and len(df_attr.columns) > 0:
+						frames.append((attr_id, df_attr))
+						if args.save_attributes: save_dataframe(df_attr, f'{output_dir_attr}/dazubi_{cnt:06d}.csv', compress=args.compress, sanity_check=not args.no_sanity_check)
+				df_occ = join_attributes(frames) if frames else pd.DataFrame()
 				if (len(df_occ) > 0):
-					df = pd.concat([df, df_occ])
-					df.reset_index(inplace=True, drop=True)
-					if cnt_write >= args.write_skip:
-						save_dataframe(df, f'{output_dir_occ}/dazubi_{cnt:06d}.csv', sanity_check=not args.no_sanity_check, compress=args.compress)
-						cnt_write = 0
-					else:
-						cnt_write += 1
-		save_dataframe(df, compress=args.compress)
+					parts.append(f'{output_dir_occ}/dazubi_{cnt:06d}.parquet')
+					write_parquet(df_occ, parts[-1])
+		cnt = len(tasks)
+		rows, columns = save_parts(parts, compress=args.compress)
+		print(f'===> {", ".join(f"{n} {status}" for status, n in statuses.items())}')
+		print(f'===> {rows} rows, {columns} columns')
 	print(f'===> {cnt} files donwloaded')
-	df.info()
 
 if __name__ == '__main__':
 	args = parse_arguments()
@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+"""
+Record and replay the responses of DAZUBI, so the collectors can run (and be measured) without bibb.de.
+
+Record the index page and a sample of Excel files while downloading:
+
+	python data_collect/download_dazubi.py -d --record fixtures/dazubi --limit 200
+
+Replay them with a latency of 0.2 seconds per response:
+
+	python data_collect/download_dazubi.py -d --replay fixtures/dazubi --latency 0.2
+
+A request for a file that wasn't recorded gets one of the recorded Excel files (always the same for the same URL),
+so a small sample replays a complete run. Show the recorded responses:
+
+	python data_collect/replay_dazubi.py fixtures/dazubi
+"""
+import os, json, time, random, hashlib, argparse
+from typing import Optional
+from urllib.parse import urlparse
+import requests
+from requests.adapters import BaseAdapter, HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+
+# headers that are recorded (the conditional requests need ETag and Last-Modified)
+recorded_headers = ['Content-Type', 'ETag', 'Last-Modified']
+
+def fixture_name(url: str) -> str:
+	return hashlib.sha256(url.encode()).hexdigest()
+
+def is_excel_url(url: str) -> bool:
+	return urlparse(url).path.endswith('.xls')
+
+def write_fixture(fixture_dir: str, url: str, response: requests.Response):
+	"""Write the body (<name>.body) and the metadata (<name>.json) of a response"""
+	name = fixture_name(url)
+	meta = {
+		'url': url,
+		'status': response.status_code,
+		'headers': {header: response.headers[header] for header in recorded_headers if header in response.headers},
+		'excel': is_excel_url(url),
+	}
+	# the metadata is written last, a fixture without metadata is ignored
+	for filename, content in ((name + '.body', response.content), (name + '.json', json.dumps(meta).encode())):
+		tmp_path = os.path.join(fixture_dir, filename + '.tmp')
+		with open(tmp_path, 'wb') as f:
+			f.write(content)
+		os.replace(tmp_path, os.path.join(fixture_dir, filename))
+
+def read_fixtures(fixture_dir: str) -> dict[str, dict]:
+	"""url -> metadata (with the name of the fixture) of all recorded responses"""
+	fixtures = {}
+	for filename in sorted(os.listdir(fixture_dir)):
+		if filename.endswith('.json'):
+			with open(os.path.join(fixture_dir, filename), encoding='utf-8') as f:
+				meta = json.load(f)
+			meta['name'] = filename[:-len('.json')]
+			fixtures[meta['url']] = meta
+	return fixtures
+
+class RecordingAdapter(HTTPAdapter):
+	"""
+	HTTPAdapter that writes each successful response (status 200) to fixture_dir, to be replayed by ReplayAdapter.
+	"""
+	def __init__(self, fixture_dir: str, **kwargs):
+		super().__init__(**kwargs)
+		self.fixture_dir = fixture_dir
+		os.makedirs(fixture_dir, exist_ok=True)
+
+	def send(self, request, **kwargs):
+		response = super().send(request, **kwargs)
+		if response.status_code == 200:
+			write_fixture(self.fixture_dir, request.url, response)
+		return response
+
+class ReplayAdapter(BaseAdapter):
+	"""
+	Transport adapter that answers the requests from a fixture directory written by RecordingAdapter.
+
+	Each response is delayed by latency seconds (varied by +/- jitter * latency). A request with an If-None-Match
+	header that matches the recorded ETag gets 304. An Excel file that wasn't recorded is replaced by one of the
+	recorded Excel files (unless strict), other URLs that weren't recorded get 404.
+	"""
+	def __init__(self, fixture_dir: str, latency: float = 0.0, jitter: float = 0.0, strict: bool = False):
+		super().__init__()
+		self.fixture_dir = fixture_dir
+		self.latency = latency
+		self.jitter = jitter
+		self.strict = strict
+		self.fixtures = read_fixtures(fixture_dir)
+		self.excel = [meta for meta in self.fixtures.values() if meta['excel']]
+		if not self.fixtures:
+			raise ValueError(f'No fixtures in {fixture_dir}')
+
+	def fixture(self, url: str) -> Optional[dict]:
+		meta = self.fixtures.get(url)
+		if meta is None and not self.strict and self.excel and is_excel_url(url):
+			meta = self.excel[int(fixture_name(url), 16) % len(self.excel)]
+		return meta
+
+	def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+		if self.latency > 0:
+			time.sleep(self.latency * random.uniform(1 - self.jitter, 1 + self.jitter))
+		meta = self.fixture(request.url)
+		if meta is None:
+			return self.build_response(request, 404, {}, b'')
+		headers = meta['headers']
+		if 'ETag' in headers and request.headers.get('If-None-Match') == headers['ETag']:
+			return self.build_response(request, 304, headers, b'')
+		with open(os.path.join(self.fixture_dir, meta['name'] + '.body'), 'rb') as f:
+			return self.build_response(request, meta['status'], headers, f.read())
+
+	def build_response(self, request, status: int, headers: dict, content: bytes) -> requests.Response:
+		response = requests.Response()
+		response.status_code = status
+		response.reason = {200: 'OK', 304: 'Not Modified', 404: 'Not Found'}.get(status, '')
+		response.headers = CaseInsensitiveDict(headers)
+		response._content = content
+		response.url = request.url
+		response.request = request
+		response.connection = self
+		return response
+
+	def close(self):
+		pass
+
+def mount_fixtures(
+	session: requests.Session,
+	record: Optional[str] = None,
+	replay: Optional[str] = None,
+	latency: float = 0.0,
+	pool_maxsize: int = 10
+) -> requests.Session:
+	"""Record the responses of the session to the directory record, or replay them from the directory replay"""
+	if replay is not None:
+		adapter = ReplayAdapter(replay, latency)
+	elif record is not None:
+		adapter = RecordingAdapter(record, pool_connections=1, pool_maxsize=pool_maxsize)
+	else:
+		return session
+	session.mount('http://', adapter)
+	session.mount('https://', adapter)
+	return session
+
+def add_fixture_arguments(parser: argparse.ArgumentParser):
+	parser.add_argument('--record', default=None, help='Record the responses to this directory.')
+	parser.add_argument('--replay', default=None, help='Replay the responses recorded in this directory instead of asking the server.')
+	parser.add_argument('--latency', default=0.0, type=float, help='Latency of each replayed response in seconds.')
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description="Show the recorded DAZUBI responses of a fixture directory")
+	parser.add_argument('fixture_dir', help='Directory with the recorded responses')
+	args = parser.parse_args()
+	fixtures = read_fixtures(args.fixture_dir)
+	excel = [meta for meta in fixtures.values() if meta['excel']]
+	size = sum(os.path.getsize(os.path.join(args.fixture_dir, meta['name'] + '.body')) for meta in fixtures.values())
+	for meta in fixtures.values():
+		if not meta['excel']: print(meta['status'], meta['url'])
+	print(f'===> {len(fixtures)} responses, {len(excel)} Excel files, {size / 1e6:.1f} MB')
@@ -0,0 +1,301 @@
+"""
+Iterative proportional fitting (IPF) for the synthetic population (promoted from notebooks/synthetic_population.ipynb).
+
+ipf_nd fits a dense N-dimensional seed to 1-D marginals. The marginal of every axis is computed with
+einsum and the seed is rescaled in place by broadcasting, so a sweep allocates only the marginals.
+ipf_sparse does the same for a seed in COO form (coordinates + values): only the non-zero cells are
+stored and updated, which is what makes high-cardinality tables like Beruf x Region x nationality fit.
+Zero cells of the seed (structural zeros) stay zero in both versions.
+
+Both stop when the largest deviation of a marginal from its target, relative to the total, is below
+tol, or after max_iter sweeps. IPF only converges if all marginals have the same total (see
+slice_marginals, which scales them to a common total).
+
+Benchmark against the notebook version on the Destatis marginals:
+
+    python -m modeling.ipf data/destatis
+"""
+import argparse
+import logging
+import os
+import time
+from itertools import product
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+FEATURES = ['age', 'sector', 'nationality', 'gender', 'education']
+
+# Destatis table -> the features (attribute columns 2, 3, ...) it contains, columns 'time', '1_variable_attribute_label' are year and state
+DESTATIS_TABLES = {
+    'age': ['gender', 'age'],
+    'areas': ['sector', 'nationality', 'gender'],
+    'edu': ['gender', 'education'],
+}
+# the table every feature marginal is taken from, the gender marginal of the areas table defines the total of a slice
+MARGINAL_SOURCES = {'age': 'age', 'sector': 'areas', 'nationality': 'areas', 'gender': 'areas', 'education': 'edu'}
+TOTAL_FEATURE = 'gender'
+
+
+# --- IPF ---
+
+def _max_deviation(current, target, total):
+    return np.abs(current - target).max() / total if total > 0 else 0.0
+
+
+def ipf_nd(seed, marginals, tol=1e-6, max_iter=100, full_output=False):
+    """
+    Fit a dense N-dimensional seed to 1-D marginals.
+
+    Args:
+        seed (np.ndarray): Initial table, one axis per marginal (e.g. np.ones).
+        marginals (list): Target totals per axis, marginals[d] has length seed.shape[d].
+        tol (float): Stop if the largest deviation of any marginal, relative to the total, is below tol.
+        max_iter (int): Maximum number of sweeps over all axes.
+        full_output (bool): Also return the number of sweeps and the final deviation.
+
+    Returns:
+        np.ndarray: The fitted table (and iterations, deviation if full_output).
+    """
+    arr = np.array(seed, dtype=float)
+    targets = [np.asarray(m, dtype=float) for m in marginals]
+    dims = arr.ndim
+    if len(targets) != dims:
+        raise ValueError(f'{len(targets)} marginals for a {dims}-dimensional seed')
+    total = targets[0].sum()
+    subscripts = list(range(dims))
+
+    deviation = np.inf
+    for iteration in range(1, max_iter + 1):
+        deviation = 0.0
+        for d, target in enumerate(targets):
+            current = np.einsum(arr, subscripts, [d])
+            # the deviation before rescaling is the fit of the previous axes, one sweep late but free
+            deviation = max(deviation, _max_deviation(current, target, total))
+            scale = np.divide(target, current, out=np.ones_like(current), where=current > 0)
+            shape = [1] * dims
+            shape[d] = len(scale)
+            arr *= scale.reshape(shape)
+        if deviation < tol:
+            break
+    else:
+        logger.warning('IPF did not converge after %d iterations (deviation %.2e)', max_iter, deviation)
+    return (arr, iteration, deviation) if full_output else arr
+
+
+def ipf_sparse(coords, values, marginals, tol=1e-6, max_iter=100, full_output=False):
+    """
+    Fit a sparse N-dimensional seed in COO form to 1-D marginals.
+
+    Args:
+        coords (np.ndarray): Integer coordinates of the non-zero cells, shape (dims, nnz).
+        values (np.ndarray): Seed values of the non-zero cells, shape (nnz,).
+        marginals, tol, max_iter, full_output: see ipf_nd.
+
+    Returns:
+        np.ndarray: The fitted values of the cells in coords (and iterations, deviation if full_output).
+    """
+    coords = np.asarray(coords)
+    values = np.array(values, dtype=float)
+    targets = [np.asarray(m, dtype=float) for m in marginals]
+    if len(targets) != len(coords):
+        raise ValueError(f'{len(targets)} marginals for a {len(coords)}-dimensional seed')
+    total = targets[0].sum()
+
+    deviation = np.inf
+    for iteration in range(1, max_iter + 1):
+        deviation = 0.0
+        for axis_coords, target in zip(coords, targets):
+            current = np.bincount(axis_coords, weights=values, minlength=len(target))
+            deviation = max(deviation, _max_deviation(current, target, total))
+            scale = np.divide(target, current, out=np.ones_like(current), where=current > 0)
+            values *= scale[axis_coords]
+        if deviation < tol:
+            break
+    else:
+        logger.warning('IPF did not converge after %d iterations (deviation %.2e)', max_iter, deviation)
+    return (values, iteration, deviation) if full_output else values
+
+
+def dense_to_coo(arr):
+    """COO form (coords, values) of the non-zero cells of a dense array."""
+    coords = np.array(np.nonzero(arr))
+    return coords, arr[tuple(coords)]
+
+
+def coo_to_dense(coords, values, shape):
+    arr = np.zeros(shape)
+    np.add.at(arr, tuple(coords), values)
+    return arr
+
+
+def integerize_trs(weights, size, rng=None):
+    """
+    Integer counts that sum to size from fractional weights (truncate, replicate, sample).
+
+    The weights are scaled to size, every cell gets the integer part of its weight and the missing
+    units are sampled without replacement with probabilities proportional to the fractional parts.
+    Unlike sampling all individuals, the counts differ from the weights by less than 1.
+    """
+    rng = np.random.default_rng() if rng is None else rng
+    weights = np.asarray(weights, dtype=float)
+    total = weights.sum()
+    if total <= 0 or size <= 0:
+        return np.zeros(weights.shape, dtype=np.int64)
+    expected = weights * (size / total)
+    counts = np.floor(expected).astype(np.int64)
+    remainder = int(size - counts.sum())
+    if remainder > 0:
+        fractions = (expected - counts).ravel()
+        picks = rng.choice(fractions.size, size=remainder, replace=False, p=fractions / fractions.sum())
+        np.add.at(counts.reshape(-1), picks, 1)
+    return counts
+
+
+# --- Destatis marginals ---
+
+def read_destatis(path, features):
+    """Destatis table as year, state, features..., count ('-' is 0)."""
+    df = pd.read_csv(path, sep=';')
+    columns = {'time': 'year', '1_variable_attribute_label': 'state', 'value': 'count'}
+    columns.update({f'{i}_variable_attribute_label': feature for i, feature in enumerate(features, start=2)})
+    df = df[list(columns)].rename(columns=columns)
+    df['count'] = pd.to_numeric(df['count'].replace('-', '0'), errors='coerce')
+    return df
+
+
+def extract_1d_marginals(df, group_cols, feature):
+    """Aggregates df to the columns group_cols..., feature, <feature>_count."""
+    return (
+        df
+        .groupby(group_cols + [feature])['count']
+        .sum()
+        .reset_index()
+        .rename(columns={'count': f'{feature}_count'})
+    )
+
+
+def load_marginals(data_dir, kind='new'):
+    """
+    The 1-D marginals per feature of the new ('new') or terminated ('term') contracts.
+
+    Returns:
+        dict: feature -> pd.Series of counts indexed by (year, state, category).
+    """
+    tables = {name: read_destatis(os.path.join(data_dir, f'{name}_{kind}.csv'), features)
+              for name, features in DESTATIS_TABLES.items()}
+    return {
+        feature: extract_1d_marginals(tables[MARGINAL_SOURCES[feature]], ['year', 'state'], feature)
+        .set_index(['year', 'state', feature])[f'{feature}_count'].fillna(0).astype(float).sort_index()
+        for feature in FEATURES
+    }
+
+
+def slice_marginals(marginals, year, state):
+    """
+    Marginals of one (year, state) slice, all scaled to the total of the gender marginal.
+
+    Returns:
+        list: One pd.Series per feature (index: categories), None if a marginal is missing or empty.
+    """
+    try:
+        total = marginals[TOTAL_FEATURE].loc[(year, state)].sum()
+    except KeyError:
+        return None
+    if total <= 0:
+        return None
+    result = []
+    for feature in FEATURES:
+        try:
+            s = marginals[feature].loc[(year, state)]
+        except KeyError:
+            return None
+        if s.empty or s.sum() <= 0:
+            return None
+        result.append(s * (total / s.sum()))
+    return result
+
+
+# --- Benchmark ---
+
+def _notebook_ipf_nd(seed, marginals, max_iter=20, tol=1e-5):
+    """The ipf_nd of notebooks/synthetic_population.ipynb, unchanged (its convergence check stops after one sweep)."""
+    dims = len(marginals)
+    arr = seed.copy().astype(float)
+    for _ in range(max_iter):
+        for d in range(dims):
+            axes = tuple(i for i in range(dims) if i != d)
+            current = arr.sum(axis=axes)
+            target = marginals[d]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                scale = np.where(current > 0, target / current, 1.0)
+            shape = [1] * dims
+            shape[d] = len(scale)
+            arr *= scale.reshape(shape)
+        if np.allclose(arr.sum(axis=tuple(range(dims))), marginals[0].sum(), rtol=tol):
+            break
+    return arr
+
+
+def marginal_deviation(arr, marginals):
+    """Largest deviation of a marginal of arr from its target, relative to the total."""
+    total = np.sum(marginals[0])
+    return max(_max_deviation(np.einsum(arr, list(range(arr.ndim)), [d]), np.asarray(target), total)
+               for d, target in enumerate(marginals))
+
+
+def benchmark(marginals, tol=1e-6, max_iter=100, density=None, random_state=0):
+    """
+    Fit all (year, state) slices with the notebook version, ipf_nd and ipf_sparse, time and deviation per method.
+
+    The seed is np.ones like in the notebook, or with density a random seed where only this fraction of
+    the cells is non-zero (structural zeros, like in a sparse Beruf x Region table).
+    """
+    rng = np.random.default_rng(random_state)
+    years = marginals[TOTAL_FEATURE].index.get_level_values('year').unique()
+    states = marginals[TOTAL_FEATURE].index.get_level_values('state').unique()
+    slices = [s for s in (slice_marginals(marginals, year, state) for year, state in product(years, states)) if s is not None]
+
+    def sparse(seed, targets):
+        coords, values = dense_to_coo(seed)
+        values, n_iter, _ = ipf_sparse(coords, values, targets, tol, max_iter, full_output=True)
+        return coo_to_dense(coords, values, seed.shape), n_iter
+
+    methods = {
+        'notebook': lambda seed, targets: (_notebook_ipf_nd(seed, targets), None),
+        'ipf_nd': lambda seed, targets: ipf_nd(seed, targets, tol, max_iter, full_output=True)[:2],
+        'ipf_sparse': sparse,
+    }
+    rows = []
+    for name, method in methods.items():
+        seconds, iterations, deviations = 0.0, [], []
+        for s in slices:
+            targets = [m.to_numpy() for m in s]
+            shape = [len(m) for m in targets]
+            seed = np.ones(shape) if density is None else rng.random(shape) * (rng.random(shape) < density)
+            start = time.perf_counter()
+            fitted, n_iter = method(seed, targets)
+            seconds += time.perf_counter() - start
+            iterations.append(n_iter)
+            deviations.append(marginal_deviation(fitted, targets))
+        rows.append({
+            'method': name,
+            'slices': len(slices),
+            'seconds': seconds,
+            'mean_iterations': np.mean(iterations) if iterations[0] is not None else np.nan,
+            'max_deviation': max(deviations),
+        })
+    return pd.DataFrame(rows).set_index('method')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the IPF implementations on the Destatis marginals")
+    parser.add_argument('data_dir', help='Directory with the Destatis tables (age_new.csv, areas_new.csv, edu_new.csv, ...)')
+    parser.add_argument('--kind', choices=['new', 'term'], default='new', help='New or terminated contracts')
+    parser.add_argument('--tol', type=float, default=1e-6)
+    parser.add_argument('--max-iter', type=int, default=100)
+    parser.add_argument('--density', type=float, default=None, help='Random seed with this fraction of non-zero cells (default: ones)')
+    args = parser.parse_args()
+
+    print(benchmark(load_marginals(args.data_dir, args.kind), args.tol, args.max_iter, args.density).to_string())
@@ -0,0 +1,665 @@
+"""
+Scenario engine for the dropout simulations (promoted from notebooks/simulations.ipynb).
+
+The engine extrapolates the features of the synthetic population per state (linear trends of the
+numerical features and of the category proportions), generates synthetic populations for future years
+under scenario manipulations and scores them with the XGBoost model.
+
+A scenario grid (scenario x effect size x region) is split into cells of one scenario and one year.
+The cells are independent, so they are generated and scored in a process pool (one batched
+Booster.predict per cell). Every finished cell is appended to a long CSV file, so an interrupted run
+continues where it stopped (only with the same model, data, grid and parameters, they are stored next to
+the file). At the end the results are written as the wide CSV the dashboard reads
+(year + one column <scenario>_proportion_ones per scenario).
+
+By default (--mode individuals) every individual is generated with its own numerical features and scored,
+like in the notebook. --mode profiles or expected is an approximation: the numerical features are fixed at
+their extrapolated means and a population is scored as its unique profiles with counts, so memory and
+predict time depend on the number of distinct profiles (about 1000 per state) instead of the population
+size. The model isn't linear, so the dropout share of the mean features is not the mean dropout share of
+the individuals, and the results of the modes are not comparable.
+
+Usage:
+
+    python -m modeling.scenario_engine --data data/synpop_feat.csv --model Dashboard/data/model.xgb.bz2 \\
+        --output Dashboard/data/scenario_analysis_results.csv.bz2 --workers 16
+
+The results are written to the file the dashboard reads (Dashboard/data/scenario_analysis_results.csv.bz2),
+convert them with Dashboard/scenario_store.py afterwards (make scenario-analysis runs both).
+"""
+import argparse
+import bz2
+import csv
+import hashlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import pandas as pd
+import xgboost as xgb
+from Dashboard.category_codes import category_codes_path, load_category_codes
+
+NUMERICAL_COLS = [
+    'Emp_Age_25_34_Share', 'Emp_Age_35_49_Share', 'Emp_Age_50_Plus_Share', 'Emp_Age_Under_25_Share',
+    'Emp_Bachelor_Share', 'Emp_Diplom_Magister_StateExam_Share', 'Emp_Foreign_Share', 'Emp_Index',
+    'Emp_Master_Tech_Share', 'Emp_No_Vocational_Edu_Share', 'Emp_PartTime_Share', 'Emp_Promotion_Share',
+    'Emp_Recognized_Vocational_Edu_Share', 'Emp_Sector_Agriculture_Share', 'Emp_Sector_Construction_Share',
+    'Emp_Sector_Manufacturing_Machinery_Share', 'Emp_Sector_Manufacturing_Other_Share',
+    'Emp_Sector_Manufacturing_Share', 'Emp_Sector_Services_Edu_Culture_Share',
+    'Emp_Sector_Services_Finance_Insurance_Share', 'Emp_Sector_Services_Health_Social_Share',
+    'Emp_Sector_Services_Other_Share', 'Emp_Sector_Services_Public_Admin_Share', 'Emp_Sector_Services_Share',
+    'Emp_Sector_Services_Trade_Share', 'Emp_Sector_Services_Transport_Com_Share', 'Emp_Total_Count',
+    'Emp_Vocational_Edu_Unknown_Share', 'Emp_Women_Share', 'Unemp_Age_25_34_Share', 'Unemp_Age_35_49_Share',
+    'Unemp_Age_50_Plus_Share', 'Unemp_Age_Under_25_Share', 'Unemp_Bachelor_Share',
+    'Unemp_Diplom_Magister_Master_StateExam_Share', 'Unemp_Edu_Unknown_Share', 'Unemp_Foreign_Share',
+    'Unemp_Index_2013_100', 'Unemp_LongTerm_Share', 'Unemp_No_Vocational_Edu_Share',
+    'Unemp_Promotion_Share', 'Unemp_Rate_Men', 'Unemp_Rate_Total', 'Unemp_Rate_Women',
+    'Unemp_Total_Count', 'Unemp_Vocational_Training_Share', 'Unemp_Women_Share',
+    'nominal_wage_index', 'nominal_wage_growth_rate'
+]
+CATEGORICAL_COLS = ['age', 'sector', 'nationality', 'gender', 'education']
+
+# the exact columns (and order) the model was trained on
+MODEL_COLUMNS = ['age', 'education', 'year', 'state', 'gender', 'sector', 'nationality'] + NUMERICAL_COLS
+
+EDUCATION_CATEGORIES = ['Ohne Hauptschulabschluss', 'Hauptschulabschluss', 'Realschul- oder vergleichbarer Abschluss', 'Hochschul- oder Fachhochschulreife']
+TARGET_HIGH_EDU = 'Realschul- oder vergleichbarer Abschluss'
+TARGET_LOW_EDU = 'Hauptschulabschluss'
+
+SCOPES = {
+    'all': 'All',
+    'HH': 'Hamburg',
+    "BW": "Baden-Württemberg",
+    "BY": "Bayern",
+    "BE": "Berlin",
+    "BB": "Brandenburg",
+    "HB": "Bremen",
+    "HE": "Hessen",
+    "MV": "Mecklenburg-Vorpommern",
+    "NI": "Niedersachsen",
+    "NW": "Nordrhein-Westfalen",
+    "RP": "Rheinland-Pfalz",
+    "SL": "Saarland",
+    "SN": "Sachsen",
+    "ST": "Sachsen-Anhalt",
+    "SH": "Schleswig-Holstein",
+    "TH": "Thüringen"
+}
+SHIFT_AMOUNTS_PERCENT = [1, 2, 5]
+START_YEAR = 2025
+END_YEAR = 2035
+NUM_INDIVIDUALS_PER_STATE = 5000
+# code tables of the training (modeling/utils.py:save_category_codes), shipped with the model
+CATEGORY_CODES_PATH = category_codes_path
+
+
+def _linear_trend(years, values):
+    """(slope, intercept) of a linear regression, a constant for a single point, None without points."""
+    if len(values) >= 2:
+        slope, intercept = np.polyfit(years, values, 1)
+        return slope, intercept
+    if len(values) == 1:
+        return 0.0, values[-1]
+    return None
+
+
+class ScenarioAnalysis:
+    """
+    Extrapolation of the synthetic population and generation of scenario populations.
+
+    All trends are fitted once in the constructor and kept as small arrays, so the engine can be sent
+    to worker processes without the historical data.
+    """
+
+    def __init__(self, data_path, numerical_cols=NUMERICAL_COLS, categorical_cols=CATEGORICAL_COLS, df=None,
+                 codes_path=CATEGORY_CODES_PATH):
+        """
+        Args:
+            data_path (str): Path to the historical synthetic population with features (CSV).
+            numerical_cols (list): Column names of the numerical features.
+            categorical_cols (list): Column names of the categorical features that are sampled.
+            df (pd.DataFrame, optional): The historical data, instead of reading data_path.
+            codes_path (str): Code tables of the categorical model features (see load_category_codes).
+        """
+        self.numerical_cols = list(numerical_cols)
+        self.categorical_cols = list(categorical_cols)
+        # ordinal codes of the categorical model features, the same tables as the dashboard
+        self.categories = load_category_codes(codes_path)
+        df = pd.read_csv(data_path) if df is None else df
+        # identifies the data and the codes the engine was built from (see run_parameters)
+        digest = hashlib.sha256(pd.util.hash_pandas_object(df, index=False).to_numpy().tobytes())
+        digest.update(json.dumps(self.categories, sort_keys=True).encode())
+        self.fingerprint = digest.hexdigest()
+        historical_df = df[df['year'] != 2023]
+
+        self.states = list(historical_df['state'].unique())
+        self.default_sizes = {
+            state: int((group['year'] == group['year'].max()).sum()) for state, group in historical_df.groupby('state')
+        }
+        self.overall_props = {
+            col: historical_df[col].value_counts(normalize=True).to_dict() for col in self.categorical_cols
+        }
+        self._fit_numerical_models(historical_df)
+        self._fit_categorical_models(historical_df)
+
+    def _fit_numerical_models(self, historical_df):
+        """Linear trend of the yearly mean of every numerical feature per state (national trend as fallback)."""
+        cols = self.numerical_cols
+        national = historical_df.groupby('year')[cols].mean()
+        national_std = historical_df[cols].std()
+        self.slope = {}
+        self.intercept = {}
+        self.std = {}
+        for state, state_df in historical_df.groupby('state'):
+            yearly = state_df.groupby('year')[cols].mean()
+            state_std = state_df[cols].std()
+            slope, intercept, std = np.zeros(len(cols)), np.full(len(cols), np.nan), np.zeros(len(cols))
+            for i, col in enumerate(cols):
+                values = yearly[col].dropna()
+                trend = _linear_trend(values.index.to_numpy(), values.to_numpy()) if len(values) >= 2 else None
+                if trend is None:
+                    # not enough data for the state, national trend
+                    national_values = national[col].dropna()
+                    trend = _linear_trend(national_values.index.to_numpy(), national_values.to_numpy())
+                if trend is not None:
+                    slope[i], intercept[i] = trend
+                std[i] = state_std[col]
+                if pd.isna(std[i]) or std[i] == 0:
+                    std[i] = national_std[col]
+                    if pd.isna(std[i]) or std[i] == 0:
+                        std[i] = 0.01  # Small epsilon to ensure some variance
+            self.slope[state], self.intercept[state], self.std[state] = slope, intercept, std
+
+        self.share_cols = np.array(['_Share' in col or '_Rate' in col or 'growth_rate' in col for col in cols])
+        self.count_cols = np.array(['Count' in col for col in cols])
+
+    def _fit_categorical_models(self, historical_df):
+        """Linear trend of the yearly proportion of every category per state and categorical feature."""
+        self.category_trends = {}
+        for state, state_df in historical_df.groupby('state'):
+            for col in self.categorical_cols:
+                counts = state_df.dropna(subset=[col]).groupby(['year', col]).size().unstack(fill_value=0)
+                if counts.empty:
+                    self.category_trends[state, col] = None
+                    continue
+                props = counts.div(counts.sum(axis=1), axis=0)
+                slope, intercept = np.polyfit(props.index.to_numpy(), props.to_numpy(), 1) if len(props) >= 2 \
+                    else (np.zeros(props.shape[1]), props.to_numpy()[-1])
+                self.category_trends[state, col] = (list(props.columns), slope, intercept)
+
+    def numerical_means(self, state, year):
+        """Extrapolated means of the numerical features of a state."""
+        return self.slope[state] * year + self.intercept[state]
+
+    def category_props(self, state, col, year):
+        """Extrapolated proportions of the categories of col in a state as dict category -> proportion."""
+        trend = self.category_trends.get((state, col))
+        if trend is not None:
+            cats, slope, intercept = trend
+            props = np.clip(slope * year + intercept, 0.0, 1.0)
+            if props.sum() > 0:
+                return dict(zip(cats, props / props.sum()))
+        # Fallback to overall historical proportions
+        return dict(self.overall_props[col])
+
+    def _manipulated_means(self, state, year, manipulations):
+        """Means of the numerical features of a state, manipulated values replace the extrapolation."""
+        means = self.numerical_means(state, year)
+        for i, col in enumerate(self.numerical_cols):
+            manipulation = manipulations.get(col, {})
+            value = manipulation.get(state, manipulation.get('All'))
+            if value is not None and not isinstance(value, dict):
+                means[i] = value
+        return means
+
+    def _manipulated_props(self, state, col, year, manipulations):
+        """(categories, probabilities) of col in a state, manipulated proportions replace the extrapolation."""
+        manipulation = manipulations.get(col, {})
+        props = manipulation.get(state, manipulation.get('All'))
+        if not isinstance(props, dict) or not props:
+            props = self.category_props(state, col, year)
+        cats = list(props.keys())
+        probs = np.array(list(props.values()), dtype=float)
+        if cats:
+            probs = probs / probs.sum() if probs.sum() > 0 else np.full(len(cats), 1.0 / len(cats))
+        return cats, probs
+
+    def generate_single_year_population(self, target_year, num_individuals_per_state=None,
+                                        scenario_manipulations=None, target_states_to_generate=None, rng=None):
+        """
+        Generates a synthetic population for a single target year.
+
+        Args:
+            target_year (int): The year for which to generate the population.
+            num_individuals_per_state (int, optional): Number of individuals per state,
+                                                       the size of the last historical year if None.
+            scenario_manipulations (dict, optional): Manipulations of features for this year,
+                                                     e.g. {'feature_name': {'StateA': value, 'All': value}}.
+            target_states_to_generate (list, optional): States to generate, all states if None.
+            rng (np.random.Generator, optional): Random generator (for reproducible cells).
+
+        Returns:
+            pd.DataFrame: The synthetic population of the target year.
+        """
+        rng = np.random.default_rng() if rng is None else rng
+        manipulations = scenario_manipulations or {}
+        states = [state for state in (target_states_to_generate or self.states) if state in self.slope]
+
+        populations = []
+        for state in states:
+            n = num_individuals_per_state or self.default_sizes.get(state, 5000)
+
+            means = self._manipulated_means(state, target_year, manipulations)
+            # all numerical features of the state in one draw
+            samples = rng.normal(means, self.std[state], size=(n, len(means)))
+            samples[:, self.share_cols] = np.clip(samples[:, self.share_cols], 0, 100)
+            samples[:, self.count_cols] = np.clip(samples[:, self.count_cols], 0, np.inf)
+            state_df = pd.DataFrame(samples, columns=self.numerical_cols)
+
+            for col in self.categorical_cols:
+                cats, probs = self._manipulated_props(state, col, target_year, manipulations)
+                if not cats:
+                    state_df[col] = None
+                    continue
+                state_df[col] = np.asarray(cats, dtype=object)[rng.choice(len(cats), size=n, p=probs)]
+
+            state_df['state'] = state
+            state_df['year'] = target_year
+            populations.append(state_df)
+        return pd.concat(populations, ignore_index=True)
+
+    def generate_single_year_profiles(self, target_year, num_individuals_per_state=None,
+                                   scenario_manipulations=None, target_states_to_generate=None, rng=None,
+                                   expected=False):
+        """
+        Population of a single target year as unique profiles with counts (column 'count').
+
+        This is an approximation of generate_single_year_population: the numerical features are the
+        (manipulated) extrapolated means of the state instead of per-individual draws around them, so
+        all individuals of a state only differ in their categorical features and the spread of the
+        numerical features is lost, which changes the predictions of the (non-linear) model. The
+        categoricals are sampled independently like in generate_single_year_population, so the counts
+        of the profiles are a multinomial draw from the product of their proportions (the expected
+        counts if expected is True). The number of rows is the number of distinct profiles, not the
+        size of the population.
+
+        Args: see generate_single_year_population.
+        """
+        rng = np.random.default_rng() if rng is None else rng
+        manipulations = scenario_manipulations or {}
+        states = [state for state in (target_states_to_generate or self.states) if state in self.slope]
+
+        populations = []
+        for state in states:
+            n = num_individuals_per_state or self.default_sizes.get(state, 5000)
+            means = self._manipulated_means(state, target_year, manipulations)
+            means[self.share_cols] = np.clip(means[self.share_cols], 0, 100)
+            means[self.count_cols] = np.clip(means[self.count_cols], 0, np.inf)
+
+            cols = self.categorical_cols
+            cats, probs = zip(*(self._manipulated_props(state, col, target_year, manipulations) for col in cols))
+            # joint distribution of the independent categoricals
+            joint = probs[0]
+            for p in probs[1:]:
+                joint = np.multiply.outer(joint, p)
+            joint = joint.ravel()
+            counts = joint * n if expected else rng.multinomial(n, joint / joint.sum())
+            present = np.flatnonzero(counts)
+            codes = np.unravel_index(present, [len(c) for c in cats])
+
+            state_df = pd.DataFrame(np.broadcast_to(means, (len(present), len(means))), columns=self.numerical_cols)
+            for col, col_cats, col_codes in zip(cols, cats, codes):
+                state_df[col] = np.asarray(col_cats, dtype=object)[col_codes]
+            state_df['state'] = state
+            state_df['year'] = target_year
+            state_df['count'] = counts[present]
+            populations.append(state_df)
+        return pd.concat(populations, ignore_index=True)
+
+    def generate_scenario_populations(self, start_year, end_year, num_individuals_per_state=None,
+                                      scenario_manipulations_over_time=None, target_states_to_generate=None, rng=None):
+        """Synthetic populations for all years from start_year to end_year (manipulations per year)."""
+        manipulations = scenario_manipulations_over_time or {}
+        return pd.concat([
+            self.generate_single_year_population(year, num_individuals_per_state, manipulations.get(year, {}),
+                                                 target_states_to_generate, rng)
+            for year in range(start_year, end_year + 1)
+        ], ignore_index=True)
+
+    def feature_matrix(self, population):
+        """Model input of a population: the categorical columns as ordinal codes, columns in MODEL_COLUMNS order."""
+        X = np.zeros((len(population), len(MODEL_COLUMNS)), dtype=np.float32)
+        for i, col in enumerate(MODEL_COLUMNS):
+            if col not in population.columns:
+                continue  # missing features are 0
+            if col in self.categories:
+                X[:, i] = pd.Categorical(population[col], categories=self.categories[col]).codes
+            else:
+                X[:, i] = population[col].to_numpy(dtype=np.float32)
+        return X
+
+    def education_manipulations(self, shift_amount, shift_direction, start_year, end_year, scope):
+        """
+        Year-specific proportions of 'education' for a shift of shift_amount (total over the period).
+
+        The share of TARGET_HIGH_EDU grows (increase) or shrinks (decrease) by the shift, TARGET_LOW_EDU
+        the other way around, and all categories are normalized to sum to 1. The baseline are the
+        extrapolated proportions of start_year (the mean over all states for 'All').
+        """
+        duration = max(end_year - start_year + 1, 1)
+        scopes = [scope] if isinstance(scope, str) else scope
+
+        base_props = {}
+        for current_scope in scopes:
+            states = self.states if current_scope == 'All' else [current_scope]
+            props = pd.DataFrame([self.category_props(state, 'education', start_year) for state in states]).fillna(0).mean()
+            base_props[current_scope] = {cat: props.get(cat, 0.0) for cat in set(EDUCATION_CATEGORIES) | set(props.index)}
+
+        manipulations = {}
+        for year in range(start_year, end_year + 1):
+            # cumulative shift: 0 at start_year, shift_amount at end_year
+            progress = (year - start_year) / (duration - 1) if duration > 1 else 0.0
+            shift = shift_amount * progress * (1 if shift_direction == 'increase' else -1)
+            year_manipulations = {}
+            for current_scope in scopes:
+                props = dict(base_props[current_scope])
+                props[TARGET_HIGH_EDU] += shift
+                props[TARGET_LOW_EDU] -= shift
+                props = {cat: float(np.clip(prop, 0.0, 1.0)) for cat, prop in props.items()}
+                total = sum(props.values())
+                year_manipulations[current_scope] = {cat: prop / total for cat, prop in props.items()} if total > 0 \
+                    else {cat: 1.0 / len(EDUCATION_CATEGORIES) for cat in EDUCATION_CATEGORIES}
+            manipulations.setdefault(year, {})['education'] = year_manipulations
+        return manipulations
+
+    def scenario_manipulations(self, config, start_year=START_YEAR, end_year=END_YEAR):
+        """Manipulations per year of a scenario configuration (see build_scenario_grid)."""
+        if config['type'] == 'bau':
+            return {}
+        if config['type'] == 'categorical':
+            return self.education_manipulations(config['shift_amount'], config['direction'], start_year, end_year, config['scope'])
+        if config['type'] == 'numerical':
+            states = self.states if config['scope'] == 'All' else [config['scope']]
+            i = self.numerical_cols.index(config['feature'])
+            base_value = np.mean([self.numerical_means(state, start_year)[i] for state in states])
+            annual_change = config['annual_change'] if config['direction'] == 'increase' else -config['annual_change']
+            return build_numerical_growth_scenario(config['feature'], base_extrapolated_value=base_value,
+                                                   annual_increase=annual_change, start_year=start_year,
+                                                   end_year=end_year, scope=config['scope'])
+        raise ValueError(f"Unknown scenario type '{config['type']}' of scenario '{config['name']}'")
+
+
+# --- Scenario Builder Utilities ---
+
+def build_numerical_growth_scenario(feature_name, start_value=None, annual_increase=None,
+                                    start_year=START_YEAR, end_year=END_YEAR, scope='All', base_extrapolated_value=None):
+    """
+    Builds a scenario dictionary for numerical feature growth over time.
+
+    Args:
+        feature_name (str): The name of the numerical feature to manipulate.
+        start_value (float, optional): The fixed target value for the feature.
+        annual_increase (float, optional): Annual increment to the base_extrapolated_value.
+        start_year (int): The starting year for the scenario.
+        end_year (int): The ending year for the scenario.
+        scope (str or list): 'All' for all states, or a string for a single state, or a list of specific states.
+        base_extrapolated_value (float, optional): The base value at start_year to apply annual_increase from.
+
+    Returns:
+        dict: A dictionary representing the numerical growth scenario.
+    """
+    scenario = {}
+    for year in range(start_year, end_year + 1):
+        target_value = start_value
+        if target_value is None:
+            if base_extrapolated_value is not None and annual_increase is not None:
+                target_value = base_extrapolated_value + (year - start_year) * annual_increase
+            else:
+                raise ValueError("Either start_value or (base_extrapolated_value and annual_increase) must be provided.")
+        states = [scope] if isinstance(scope, str) else scope
+        if not isinstance(states, list):
+            raise ValueError("Scope must be 'All', a string for a single state, or a list of states.")
+        scenario.setdefault(year, {}).setdefault(feature_name, {}).update({state: target_value for state in states})
+    return scenario
+
+
+def build_categorical_shift_scenario(feature_name, target_proportions_by_year,
+                                     start_year=START_YEAR, end_year=END_YEAR, scope='All'):
+    """
+    Builds a scenario dictionary for categorical feature shifts over time.
+
+    Args:
+        feature_name (str): The name of the categorical feature to manipulate.
+        target_proportions_by_year (dict): category: proportion pairs, fixed for all years,
+                                           or a dict year -> category: proportion pairs.
+        start_year (int): The starting year for the scenario.
+        end_year (int): The ending year for the scenario.
+        scope (str or list): 'All' for all states, or a list of specific states.
+
+    Returns:
+        dict: A dictionary representing the categorical shift scenario.
+    """
+    scenario = {}
+    year_specific = any(isinstance(v, dict) for v in target_proportions_by_year.values())
+    for year in range(start_year, end_year + 1):
+        proportions = target_proportions_by_year.get(year) if year_specific else target_proportions_by_year
+        if not proportions:
+            continue
+        total = sum(proportions.values())
+        normalized = {k: (v / total if total else 1.0 / len(proportions)) for k, v in proportions.items()}
+        if scope == 'All':
+            manipulation = {'All': normalized}
+        elif isinstance(scope, list):
+            manipulation = {state: normalized for state in scope}
+        else:
+            raise ValueError("Scope must be 'All' or a list of states.")
+        scenario.setdefault(year, {}).setdefault(feature_name, {}).update(manipulation)
+    return scenario
+
+
+def combine_scenarios(*scenario_parts):
+    """Combines multiple scenario dictionaries into a single scenario."""
+    combined = {}
+    for part in scenario_parts:
+        for year, features in part.items():
+            for feature_name, manipulations in features.items():
+                combined.setdefault(year, {}).setdefault(feature_name, {}).update(manipulations)
+    return combined
+
+
+def build_scenario_grid(scopes=SCOPES, shift_amounts_percent=SHIFT_AMOUNTS_PERCENT):
+    """
+    All scenario configurations: BAU per scope, and education, wage and unemployment scenarios
+    per shift amount, direction and scope. The names are the column prefixes of the results.
+    """
+    grid = [{'name': f"BAU_{key.upper()}", 'feature': None, 'type': 'bau', 'scope': scope}
+            for key, scope in scopes.items()]
+    scenarios = [
+        ('EDU', 'education', 'categorical', 'shift_amount'),
+        ('WAGE', 'nominal_wage_index', 'numerical', 'annual_change'),
+        ('UNEMP', 'Unemp_Rate_Total', 'numerical', 'annual_change')
+    ]
+    for prefix, feature, scenario_type, amount_key in scenarios:
+        for shift_percent in shift_amounts_percent:
+            for direction in ['increase', 'decrease']:
+                for key, scope in scopes.items():
+                    grid.append({
+                        'name': f"{prefix}{'+' if direction == 'increase' else '-'}{shift_percent}_{key.upper()}",
+                        'feature': feature,
+                        'type': scenario_type,
+                        amount_key: shift_percent / 100.0,
+                        'direction': direction,
+                        'scope': scope
+                    })
+    return grid
+
+
+# --- Model and parallel scoring ---
+
+def load_booster(model_path):
+    """XGBoost booster from a model file (.json/.ubj/.xgb, optionally .bz2) or an MLflow model directory."""
+    if os.path.isdir(model_path):
+        import mlflow
+        model = mlflow.xgboost.load_model(model_path)
+        return model.get_booster() if hasattr(model, 'get_booster') else model
+    booster = xgb.Booster()
+    if model_path.endswith('.bz2'):
+        with bz2.open(model_path, 'rb') as f:
+            booster.load_model(bytearray(f.read()))
+    else:
+        booster.load_model(model_path)
+    return booster
+
+
+SCORING_MODES = ['individuals', 'profiles', 'expected']
+
+_worker = {}
+
+def _init_worker(engine, model_raw):
+    # the engine and the model are sent once per process, not per cell
+    booster = xgb.Booster()
+    booster.load_model(model_raw)
+    booster.set_param({'nthread': 1})
+    _worker['engine'], _worker['booster'] = engine, booster
+
+
+def weighted_proportion_ones(booster, X, counts=None):
+    """Share of predicted dropouts of the rows of X, every row counts `counts` times."""
+    predictions = booster.predict(xgb.DMatrix(X, feature_names=MODEL_COLUMNS)) > 0.5
+    if counts is None:
+        return float(predictions.mean())
+    return float(np.dot(predictions, counts) / np.sum(counts))
+
+
+def score_cell(config, year, manipulations, num_individuals_per_state, seed, mode='individuals'):
+    """
+    Generate the population of one scenario and year and score it (in a worker process).
+
+    mode is one of SCORING_MODES:
+        individuals: every individual is generated with its own numerical features and scored
+                     (like the notebook, the default)
+        profiles: unique profiles with multinomial counts, every profile is scored once
+                  (approximation: the numerical features are fixed at their means)
+        expected: like profiles with the expected counts (no sampling noise)
+
+    Returns (scenario name, year, proportion of predicted dropouts).
+    """
+    engine, booster = _worker['engine'], _worker['booster']
+    states = None if config['scope'] == 'All' else [config['scope']]
+    rng = np.random.default_rng(seed)
+    if mode == 'individuals':
+        population = engine.generate_single_year_population(year, num_individuals_per_state, manipulations, states, rng)
+        return config['name'], year, weighted_proportion_ones(booster, engine.feature_matrix(population))
+    profiles = engine.generate_single_year_profiles(year, num_individuals_per_state, manipulations, states, rng,
+                                                    expected=mode == 'expected')
+    return config['name'], year, weighted_proportion_ones(booster, engine.feature_matrix(profiles), profiles['count'].to_numpy())
+
+
+def run_parameters(engine, booster, grid, start_year, end_year, num_individuals_per_state, seed, mode):
+    """Everything the result of a cell depends on, the model, data and codes as SHA-256."""
+    return {
+        'model': hashlib.sha256(booster.save_raw('ubj')).hexdigest(),
+        'data': engine.fingerprint,
+        'grid': grid,
+        'start_year': start_year,
+        'end_year': end_year,
+        'individuals': num_individuals_per_state,
+        'seed': seed,
+        'mode': mode,
+    }
+
+
+def load_partial(partial_path, params):
+    """
+    The (scenario, year) cells already in partial_path if it was written with params.
+
+    The parameters are stored next to it in <partial_path>.json, a partial file of other (or unknown)
+    parameters is deleted, so the run starts over.
+    """
+    params_path = partial_path + '.json'
+    stored = None
+    if os.path.exists(params_path):
+        with open(params_path, encoding='utf-8') as f:
+            stored = json.load(f)
+    if os.path.exists(partial_path) and stored != params:
+        print(f'{partial_path} was written with other parameters, starting over')
+        os.remove(partial_path)
+    with open(params_path, 'w', encoding='utf-8') as f:
+        json.dump(params, f, indent=2)
+    if not os.path.exists(partial_path):
+        return set()
+    return set(pd.read_csv(partial_path)[['scenario', 'year']].itertuples(index=False, name=None))
+
+
+def run_scenario_grid(engine, booster, grid, output_path, partial_path=None, start_year=START_YEAR,
+                      end_year=END_YEAR, num_individuals_per_state=NUM_INDIVIDUALS_PER_STATE, workers=None, seed=42,
+                      mode='individuals'):
+    """
+    Score all cells (scenario x year) of the grid in a process pool.
+
+    Every finished cell is appended to partial_path (scenario, year, proportion_ones), cells that are
+    already there are skipped if the partial file was written with the same model, data, grid and
+    parameters (see load_partial). Returns the wide results (year x <scenario>_proportion_ones) that are
+    also written to output_path, the partial file is deleted then. See score_cell for the scoring modes.
+    """
+    partial_path = partial_path or os.path.splitext(output_path.removesuffix('.bz2'))[0] + '.partial.csv'
+    params = run_parameters(engine, booster, grid, start_year, end_year, num_individuals_per_state, seed, mode)
+    done = load_partial(partial_path, params)
+
+    cells = []
+    for index, config in enumerate(grid):
+        manipulations = engine.scenario_manipulations(config, start_year, end_year)
+        for year in range(start_year, end_year + 1):
+            if (config['name'], year) not in done:
+                # the seed only depends on the cell, so the results don't depend on the scheduling
+                cells.append((config, year, manipulations.get(year, {}), num_individuals_per_state, [seed, index, year], mode))
+    print(f'{len(cells)} cells to score ({len(done)} already done)')
+
+    new_file = not os.path.exists(partial_path)
+    with open(partial_path, 'a', newline='') as f, ProcessPoolExecutor(
+            max_workers=workers, initializer=_init_worker, initargs=(engine, booster.save_raw('ubj'))) as executor:
+        writer = csv.writer(f)
+        if new_file:
+            writer.writerow(['scenario', 'year', 'proportion_ones'])
+        futures = [executor.submit(score_cell, *cell) for cell in cells]
+        for i, future in enumerate(as_completed(futures), 1):
+            writer.writerow(future.result())
+            f.flush()
+            if i % 100 == 0:
+                print(f'{i}/{len(cells)} cells')
+
+    long_results = pd.read_csv(partial_path)
+    names = [config['name'] for config in grid]
+    wide = long_results.pivot(index='year', columns='scenario', values='proportion_ones')[names]
+    wide.columns = [f'{name}_proportion_ones' for name in wide.columns]
+    wide.to_csv(output_path, index=True)
+    os.remove(partial_path)
+    os.remove(partial_path + '.json')
+    return wide
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run the scenario analysis for all scenarios, effect sizes and regions")
+    parser.add_argument('--data', default='data/synpop_feat.csv', help='Historical synthetic population with features')
+    parser.add_argument('--model', default='Dashboard/data/model.xgb.bz2', help='Model file or MLflow model directory')
+    parser.add_argument('--codes', default=CATEGORY_CODES_PATH, help='Category codes of the model (JSON written by the training)')
+    parser.add_argument('--output', default='Dashboard/data/scenario_analysis_results.csv.bz2',
+                        help='Wide CSV file of the results (compressed if it ends with .bz2)')
+    parser.add_argument('--workers', type=int, default=None, help='Number of processes (default: all cores)')
+    parser.add_argument('--individuals', type=int, default=NUM_INDIVIDUALS_PER_STATE, help='Individuals per state and year')
+    parser.add_argument('--start-year', type=int, default=START_YEAR)
+    parser.add_argument('--end-year', type=int, default=END_YEAR)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--mode', choices=SCORING_MODES, default='individuals',
+                        help='individuals (default): score every individual with its own numerical features; '
+                             'profiles, expected: faster approximation that fixes the numerical features at their '
+                             'means and scores the unique profiles with counts')
+    args = parser.parse_args()
+
+    engine = ScenarioAnalysis(args.data, codes_path=args.codes)
+    results = run_scenario_grid(engine, load_booster(args.model), build_scenario_grid(), args.output,
+                                start_year=args.start_year, end_year=args.end_year,
+                                num_individuals_per_state=args.individuals, workers=args.workers, seed=args.seed,
+                                mode=args.mode)
+    print(f'Saved: {args.output}')
+    print(results.head())
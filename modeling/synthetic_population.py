@@ -0,0 +1,255 @@
+"""
+Generation of the synthetic population from the Destatis marginals (promoted from notebooks/synthetic_population.ipynb).
+
+Every (kind, year, state) partition is fitted independently: the marginals of the slice are scaled to
+a common total, fitted with IPF (modeling.ipf) and the joint weights are integerized with TRS. A
+partition is stored as its unique profiles with the integer weight (number of synthetic apprentices)
+in the column weight, or with --expanded as one row per apprentice (modeling.utils.ExpandedPopulation
+is a lazy expanded view of the weighted form). The partitions run in a process pool and every finished
+partition is written straight to a Parquet dataset partitioned like the dashboard population:
+
+    data/synthetic_population/year=2019/state=Bayern/new.parquet    (dropped_out == 0)
+    data/synthetic_population/year=2019/state=Bayern/term.parquet   (dropped_out == 1)
+
+A partition is written to a hidden temporary file and renamed when it is complete, so the dataset
+never contains half-written files. Partitions that already exist are skipped, so an interrupted run
+continues where it stopped. The memory of a worker is bounded by one partition.
+
+The generation parameters (size, seed, tol, max_iter, expanded and the SHA-256 of the Destatis tables)
+are stored in <output>/_generation.json. A run only resumes if they are the same: otherwise it stops
+with a GenerationMismatch, or with --overwrite the existing dataset is deleted and regenerated, so a
+dataset never mixes partitions of different parameters or marginals.
+
+Every partition is validated against its marginals before it is written (modeling.validation): the run
+stops at the first partition that exceeds the thresholds, and at the end the validation report of the
+whole dataset is written to <output>/_validation.json. The command exits with code 1 if the validation
+fails, so a bad population doesn't reach training or the dashboard.
+
+Usage:
+
+    python -m modeling.synthetic_population data/destatis --output data/synthetic_population --workers 8
+"""
+import argparse
+import glob
+import hashlib
+import json
+import os
+import shutil
+import sys
+import zlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from itertools import product
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from modeling.ipf import (DESTATIS_TABLES, FEATURES, TOTAL_FEATURE, integerize_trs, ipf_nd, load_marginals,
+                          slice_marginals)
+from modeling.validation import (ValidationError, add_threshold_arguments, check, thresholds_from_args, validate_partition,
+                                 validate_population, write_report)
+
+KINDS = {'new': 0, 'term': 1}  # kind of the Destatis tables -> dropped_out
+N_PER_SLICE = 1000
+WEIGHT_COL = 'weight'
+GENERATION_FILE = '_generation.json'
+
+
+class GenerationMismatch(Exception):
+    pass
+
+
+def partition_path(root, kind, year, state):
+    return os.path.join(root, f'year={year}', f'state={state}', f'{kind}.parquet')
+
+
+def build_partition(kind, year, state, targets, size=N_PER_SLICE, seed=None, tol=1e-6, max_iter=100, expanded=False):
+    """
+    Synthetic apprentices of one (kind, year, state) partition.
+
+    Args:
+        kind (str): 'new' or 'term' (dropped_out 0 or 1).
+        targets (list): Marginals of the slice (pd.Series per feature in FEATURES, see slice_marginals).
+        size (int): Number of apprentices, the total of the marginals if None.
+        seed: Seed of the random generator of the integerization.
+        expanded (bool): One row per apprentice instead of the profiles with a weight.
+
+    Returns:
+        pd.DataFrame: The FEATURES as categoricals, dropped_out and weight (unless expanded).
+    """
+    joint = ipf_nd(np.ones([len(m) for m in targets]), [m.to_numpy() for m in targets], tol, max_iter)
+    size = int(round(joint.sum())) if size is None else size
+    counts = integerize_trs(np.clip(joint, 0, None), size, np.random.default_rng(seed)).ravel()
+    cells = np.flatnonzero(counts)
+    if expanded:
+        cells = np.repeat(cells, counts[cells])
+    codes = np.unravel_index(cells, joint.shape)
+    df = pd.DataFrame({
+        feature: pd.Categorical.from_codes(feature_codes, categories=m.index)
+        for feature, feature_codes, m in zip(FEATURES, codes, targets)
+    })
+    df['dropped_out'] = np.int8(KINDS[kind])
+    if not expanded:
+        df[WEIGHT_COL] = counts[cells].astype(np.int32)
+    return df
+
+
+def write_partition(df, path):
+    """Write df atomically: to a hidden temporary file (ignored by dataset readers), then rename."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = os.path.join(os.path.dirname(path), '.' + os.path.basename(path) + '.tmp')
+    pq.write_table(pa.Table.from_pandas(df, preserve_index=False), tmp_path)
+    os.replace(tmp_path, path)
+
+
+def run_partition(root, kind, year, state, targets, size, seed, tol, max_iter, expanded=False, thresholds=None):
+    """
+    Build, validate and write one partition (in a worker process), returns (kind, year, state, apprentices).
+
+    Raises ValidationError (and doesn't write the partition) if a 1-D marginal exceeds the thresholds.
+    """
+    # the seed only depends on the partition, so the population doesn't depend on the scheduling
+    partition_seed = [seed, KINDS[kind], int(year), zlib.crc32(state.encode())]
+    df = build_partition(kind, year, state, targets, size, partition_seed, tol, max_iter, expanded)
+    if thresholds is not None:
+        failures = check(validate_partition(df, targets), **thresholds)
+        if failures:
+            raise ValidationError(f"{kind} {year} {state}: {'; '.join(failures)}")
+    write_partition(df, partition_path(root, kind, year, state))
+    return kind, year, state, len(df) if expanded else int(df[WEIGHT_COL].sum())
+
+
+def _sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def generation_params(data_dir, kinds, size, seed, tol, max_iter, expanded):
+    """The parameters a partition depends on, the marginals as SHA-256 of the Destatis tables per kind."""
+    return {
+        'size': size,
+        'seed': seed,
+        'tol': tol,
+        'max_iter': max_iter,
+        'expanded': expanded,
+        'marginals': {kind: {f'{name}_{kind}.csv': _sha256(os.path.join(data_dir, f'{name}_{kind}.csv'))
+                             for name in DESTATIS_TABLES} for kind in kinds},
+    }
+
+
+def prepare_output(root, params, overwrite=False):
+    """
+    Check that the partitions in root were generated with params and store params in root/_generation.json.
+
+    The settings have to be equal, the marginals only for the kinds of this run (the other kinds are kept).
+    Raises GenerationMismatch if root contains partitions of other (or unknown) parameters, with
+    overwrite the dataset is deleted instead.
+    """
+    path = os.path.join(root, GENERATION_FILE)
+    stored = None
+    if os.path.exists(path):
+        with open(path, encoding='utf-8') as f:
+            stored = json.load(f)
+    if glob.glob(os.path.join(root, 'year=*', 'state=*', '*.parquet')):
+        if stored is None:
+            differences = [f'{GENERATION_FILE} is missing']
+        else:
+            differences = [key for key in params if key != 'marginals' and stored.get(key) != params[key]]
+            differences += [f'marginals of {kind}' for kind, hashes in params['marginals'].items()
+                            if stored.get('marginals', {}).get(kind, hashes) != hashes]
+        if differences:
+            if not overwrite:
+                raise GenerationMismatch(f"{root} was generated with other parameters ({', '.join(differences)}), "
+                                         "use another output directory or --overwrite")
+            print(f"Deleting {root} ({', '.join(differences)})")
+            shutil.rmtree(root)
+            stored = None
+    if stored is not None:
+        params = {**params, 'marginals': {**stored.get('marginals', {}), **params['marginals']}}
+    os.makedirs(root, exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(params, f, indent=2)
+
+
+def generate_population(data_dir, root, kinds=tuple(KINDS), size=N_PER_SLICE, workers=None, seed=42,
+                        tol=1e-6, max_iter=100, expanded=False, thresholds=None, overwrite=False):
+    """
+    Generate all missing (kind, year, state) partitions in a process pool.
+
+    Existing partitions are only kept if they were generated with the same parameters and marginals
+    (see prepare_output), otherwise GenerationMismatch is raised or, with overwrite, all partitions are
+    generated again.
+
+    With thresholds (see modeling.validation.check) every partition is validated before it is written,
+    the first ValidationError cancels the remaining partitions and is raised.
+
+    Returns:
+        list: (kind, year, state, apprentices) of the partitions written in this run.
+    """
+    prepare_output(root, generation_params(data_dir, kinds, size, seed, tol, max_iter, expanded), overwrite)
+    jobs = []
+    skipped = 0
+    for kind in kinds:
+        marginals = load_marginals(data_dir, kind)
+        index = marginals[TOTAL_FEATURE].index
+        for year, state in product(index.get_level_values('year').unique(), index.get_level_values('state').unique()):
+            if os.path.exists(partition_path(root, kind, year, state)):
+                skipped += 1
+                continue
+            targets = slice_marginals(marginals, year, state)
+            if targets is not None:
+                jobs.append((root, kind, year, state, targets, size, seed, tol, max_iter, expanded, thresholds))
+    print(f'{len(jobs)} partitions to build ({skipped} already written)')
+
+    written = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(run_partition, *job) for job in jobs]
+        try:
+            for future in as_completed(futures):
+                written.append(future.result())
+                if len(written) % 50 == 0:
+                    print(f'{len(written)}/{len(jobs)} partitions')
+        except ValidationError:
+            # fail fast, the partitions written so far are kept for the next run
+            executor.shutdown(cancel_futures=True)
+            raise
+    return written
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Generate the synthetic population from the Destatis marginals")
+    parser.add_argument('data_dir', help='Directory with the Destatis tables (age_new.csv, areas_new.csv, edu_new.csv, ...)')
+    parser.add_argument('-o', '--output', default='data/synthetic_population', help='Directory of the Parquet dataset')
+    parser.add_argument('--kinds', nargs='+', choices=list(KINDS), default=list(KINDS), help='New and/or terminated contracts')
+    parser.add_argument('--size', type=int, default=N_PER_SLICE, help='Apprentices per partition (0: the Destatis total)')
+    parser.add_argument('--workers', type=int, default=None, help='Number of processes (default: all cores)')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--tol', type=float, default=1e-6)
+    parser.add_argument('--max-iter', type=int, default=100)
+    parser.add_argument('--expanded', action='store_true', help='One row per apprentice instead of weighted profiles')
+    parser.add_argument('--no-validate', action='store_true', help="Don't validate the partitions")
+    parser.add_argument('--overwrite', action='store_true',
+                        help='Delete the dataset if it was generated with other parameters or marginals (default: stop)')
+    parser.add_argument('--report', default=None, help='Path of the validation report (default: <output>/_validation.json)')
+    add_threshold_arguments(parser)
+    args = parser.parse_args()
+
+    thresholds = None if args.no_validate else thresholds_from_args(args)
+    try:
+        written = generate_population(args.data_dir, args.output, args.kinds, args.size or None, args.workers,
+                                      args.seed, args.tol, args.max_iter, args.expanded, thresholds, args.overwrite)
+    except ValidationError as e:
+        sys.exit(f'Validation failed: {e}')
+    except GenerationMismatch as e:
+        sys.exit(str(e))
+    print(f'Saved: {args.output} ({len(written)} partitions, {sum(n for *_, n in written)} apprentices)')
+
+    if thresholds is not None:
+        report = validate_population(args.output, args.data_dir, thresholds)
+        report_path = args.report or os.path.join(args.output, '_validation.json')
+        write_report(report, report_path)
+        print(f"Saved: {report_path} ({'passed' if report['passed'] else 'failed'})")
+        if not report['passed']:
+            sys.exit(1)
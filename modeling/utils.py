@@ -2,8 +2,13 @@ from sklearn.metrics import classification_report, ConfusionMatrixDisplay
 from sklearn.preprocessing import OrdinalEncoder
 import matplotlib.pyplot as plt
 import mlflow
+import json
+import numpy as np
+import pandas as pd
 
-def check_classification_binary(model, X_train, X_test, y_train, y_test, normalize=None):
+WEIGHT_COL = 'weight'
+
+def check_classification_binary(model, X_train, X_test, y_train, y_test, normalize=None, sample_weight_train=None, sample_weight_test=None):
     """
     Evaluates the performance of a given model on training and testing datasets.
 
@@ -24,6 +29,8 @@ def check_classification_binary(model, X_train, X_test, y_train, y_test, normali
             - 'pred': Normalize over the predicted (columns).
             - 'all': Normalize over the whole matrix (all values sum to 1).
         See the scikit-learn documentation for more details.
+        sample_weight_train, sample_weight_test (array-like, optional): Weights of the rows, e.g. the weight
+            column of a weighted synthetic population (see split_weights).
 
     Visualization:
         - The function creates a 2x2 grid of subplots:
@@ -43,23 +50,122 @@ def check_classification_binary(model, X_train, X_test, y_train, y_test, normali
     values_format = 'd'
     if normalize != None:
         values_format = '.3f'
-    cmd_test = ConfusionMatrixDisplay.from_estimator(model, X_test, y_test, display_labels=classes, normalize=normalize, values_format=values_format, cmap='Blues', ax=axes[0][0])
+    cmd_test = ConfusionMatrixDisplay.from_estimator(model, X_test, y_test, sample_weight=sample_weight_test, display_labels=classes, normalize=normalize, values_format=values_format, cmap='Blues', ax=axes[0][0])
     axes[0][0].set_title('Test Data')
-    axes[1][0].text(0, 0, classification_report(y_test, test_pred_y, target_names=classes, digits=3), verticalalignment='top', fontfamily='monospace')
+    axes[1][0].text(0, 0, classification_report(y_test, test_pred_y, sample_weight=sample_weight_test, target_names=classes, digits=3), verticalalignment='top', fontfamily='monospace')
     axes[1][0].axis('off')
 
-    cmd_test = ConfusionMatrixDisplay.from_estimator(model, X_train, y_train, display_labels=classes, normalize=normalize, values_format=values_format, cmap='Greens', ax=axes[0][1])
+    cmd_test = ConfusionMatrixDisplay.from_estimator(model, X_train, y_train, sample_weight=sample_weight_train, display_labels=classes, normalize=normalize, values_format=values_format, cmap='Greens', ax=axes[0][1])
     axes[0][1].set_title('Train Data')
-    axes[1][1].text(0, 0, classification_report(y_train, train_pred_y, target_names=classes, digits=3), verticalalignment='top', fontfamily='monospace')
+    axes[1][1].text(0, 0, classification_report(y_train, train_pred_y, sample_weight=sample_weight_train, target_names=classes, digits=3), verticalalignment='top', fontfamily='monospace')
     axes[1][1].axis('off')
     if mlflow.active_run():
         print('will update classificatin_matrix.png')
         fig.tight_layout()
         mlflow.log_figure(fig, 'classification_matrix.png')
 
-def encode_categorical_columns(df, encoder=OrdinalEncoder(), num_columns=None, cat_columns=None):
+def encode_categorical_columns(df, encoder=OrdinalEncoder(), num_columns=None, cat_columns=None, fit=True):
+    """
+    Encodes the categorical columns of df with encoder (ordinal codes by default).
+
+    Fit the encoder on the training data and pass fit=False for the test data, so both use the same
+    codes. The codes are the ones the model is trained with, save them with save_category_codes.
+    """
     if cat_columns == None:
         cat_columns = [col for col in df.columns if col not in num_columns]
     df_copy = df.copy()
-    df_copy[cat_columns] = encoder.fit_transform(df_copy[cat_columns])
+    if fit:
+        df_copy[cat_columns] = encoder.fit_transform(df_copy[cat_columns])
+    else:
+        df_copy[cat_columns] = encoder.transform(df_copy[cat_columns])
     return df_copy
+
+def save_category_codes(encoder, cat_columns, path='../Dashboard/data/category_codes.json'):
+    """
+    Saves the categories of a fitted OrdinalEncoder as code tables for the dashboard and the scenario engine.
+
+    The position of a category in the list is the code the model was trained with.
+    Call this at the end of the training, with the encoder and columns of encode_categorical_columns,
+    and ship the file together with the model (Dashboard/data/model.xgb.bz2).
+
+    Args:
+        encoder: The fitted OrdinalEncoder.
+        cat_columns: The columns the encoder was fitted on (in the same order).
+        path: Path of the JSON file, by default next to the model of the dashboard.
+    """
+    codes = {col: [c.item() if hasattr(c, 'item') else c for c in cats] for col, cats in zip(cat_columns, encoder.categories_)}
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(codes, f, ensure_ascii=False, indent=2)
+
+def split_weights(df, weight_col=WEIGHT_COL):
+    """
+    Splits a weighted synthetic population into the rows without the weight column and the weights.
+
+    The weights can be passed as sample_weight to fit (XGBoost, scikit-learn) and to check_classification_binary,
+    a population stored as individuals gets a weight of 1 per row.
+
+    Returns:
+        tuple: (DataFrame without weight_col, np.ndarray of weights)
+    """
+    if weight_col not in df.columns:
+        return df, np.ones(len(df))
+    return df.drop(columns=weight_col), df[weight_col].to_numpy()
+
+def weighted_mean(df, by, columns, weight_col=WEIGHT_COL):
+    """
+    Weighted means of columns per group, the weighted version of df.groupby(by)[columns].mean().
+
+    Missing values are ignored like in mean(): they don't count in the numerator or in the weights.
+    """
+    columns = [columns] if isinstance(columns, str) else list(columns)
+    weights = df[weight_col] if weight_col in df.columns else pd.Series(1.0, index=df.index)
+    values = df[columns]
+    weighted = values.mul(weights, axis=0)
+    present = values.notna().mul(weights, axis=0)
+    keys = [df[col] for col in ([by] if isinstance(by, str) else by)]
+    return weighted.groupby(keys, observed=True).sum() / present.groupby(keys, observed=True).sum()
+
+class ExpandedPopulation:
+    """
+    Lazy individual-level view of a weighted synthetic population (one row per unit of weight).
+
+    Nothing is expanded until rows are requested, so code that needs individuals can iterate over
+    chunks or draw a sample without materializing the whole population:
+
+        view = ExpandedPopulation(df)
+        len(view)                   # number of individuals
+        for chunk in view.chunks(1_000_000): ...
+        view.sample(10_000, random_state=42)
+        view.to_frame()             # the full expanded DataFrame
+    """
+    def __init__(self, df, weight_col=WEIGHT_COL):
+        self.df = df
+        self.weight_col = weight_col
+        self.weights = df[weight_col].to_numpy().astype(np.int64)
+        self.offsets = np.concatenate([[0], np.cumsum(self.weights)])
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def _rows(self, positions):
+        """The individuals at the given positions of the expanded view."""
+        profiles = np.searchsorted(self.offsets, positions, side='right') - 1
+        return self.df.iloc[profiles].drop(columns=self.weight_col).reset_index(drop=True)
+
+    def __getitem__(self, key):
+        if not isinstance(key, slice):
+            raise TypeError('ExpandedPopulation only supports slices')
+        return self._rows(np.arange(*key.indices(len(self))))
+
+    def chunks(self, chunk_size=1_000_000):
+        """Expanded DataFrames of at most chunk_size individuals."""
+        for start in range(0, len(self), chunk_size):
+            yield self._rows(np.arange(start, min(start + chunk_size, len(self))))
+
+    def sample(self, n, random_state=None):
+        """n individuals drawn without replacement."""
+        rng = np.random.default_rng(random_state)
+        return self._rows(np.sort(rng.choice(len(self), size=n, replace=False)))
+
+    def to_frame(self):
+        return self.df.loc[self.df.index.repeat(self.weights)].drop(columns=self.weight_col).reset_index(drop=True)
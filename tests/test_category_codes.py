@@ -0,0 +1,38 @@
+import bz2
+import json
+
+import xgboost as xgb
+
+from Dashboard.category_codes import CAT_COLS, load_category_codes
+from Dashboard.model_artifact import model_path
+
+
+def max_split_codes(booster):
+    """Largest split condition per feature of the trees (x < condition goes left)."""
+    model = json.loads(booster.save_raw('json'))
+    result = {}
+    for tree in model['learner']['gradient_booster']['model']['trees']:
+        for left, feature, condition in zip(tree['left_children'], tree['split_indices'], tree['split_conditions']):
+            if left != -1:
+                name = booster.feature_names[feature]
+                result[name] = max(result.get(name, condition), condition)
+    return result
+
+
+def test_codes_are_the_sorted_categories():
+    codes = load_category_codes()
+    assert set(CAT_COLS) <= set(codes)
+    for col, cats in codes.items():
+        assert cats == sorted(cats), col
+        assert len(set(cats)) == len(cats), col
+
+
+def test_codes_cover_the_splits_of_the_shipped_model():
+    booster = xgb.Booster()
+    with bz2.open(model_path, 'rb') as f:
+        booster.load_model(bytearray(f.read()))
+    codes = load_category_codes()
+    for col, condition in max_split_codes(booster).items():
+        if col in codes:
+            # a split x < condition needs a code >= condition on its right side
+            assert len(codes[col]) > condition, col
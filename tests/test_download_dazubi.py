@@ -0,0 +1,137 @@
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from io import BytesIO
+
+import pandas as pd
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'data_collect'))
+
+from download_dazubi import (  # noqa: E402
+    DownloadCache, TokenBucket, backoff_delay, fetch_cached, join_attributes, parse_cached, unique_columns, write_parquet
+)
+
+
+def sheet(value):
+    """A DAZUBI sheet: the title (read as header by pandas), the header row, then one row per year."""
+    return pd.DataFrame([['Auszubildende', None], ['Jahr', 'Insgesamt'], [2019, value], [2020, value + 1]])
+
+
+def workbook(sheets):
+    buffer = BytesIO()
+    with pd.ExcelWriter(buffer, engine='openpyxl') as writer:
+        pd.DataFrame([['DAZUBI']]).to_excel(writer, sheet_name='Deckblatt', header=False, index=False)
+        for name, df in sheets.items():
+            df.to_excel(writer, sheet_name=name, header=False, index=False)
+    return buffer.getvalue()
+
+
+def test_unique_columns():
+    assert unique_columns(['a', 'b', 'a', 'a']) == ['a', 'b', 'a.1', 'a.2']
+    seen = {'a', 'a.1'}
+    assert unique_columns(['a', 'b'], seen) == ['a.2', 'b']
+    assert seen == {'a', 'a.1', 'a.2', 'b'}
+
+
+def test_sheets_with_the_same_columns_are_cached(tmp_path):
+    cache = DownloadCache(str(tmp_path))
+    key = ('7', '1', '0', '2023')
+    entry = {'key': list(key), 'sha256': cache.write_blob(workbook({'a': sheet(1), 'b': sheet(10), 'c': sheet(100)}))}
+    cache.save_entry(key, entry)
+
+    df, status = parse_cached(cache.root, (key, 'Beruf', 'Bund', 'downloaded'))
+    assert status == 'downloaded'
+    assert list(df.columns) == ['Jahr', 'Beruf', 'Region', 'Insgesamt', 'Insgesamt_7', 'Insgesamt_7.1']
+    assert df['Insgesamt_7.1'].tolist() == [100, 101]
+    # the fragment was written and is read instead of parsing the file again
+    fragment = cache.read_fragment(key, cache.entry(key))
+    pd.testing.assert_frame_equal(fragment, df, check_dtype=False)
+
+
+def attribute(columns, years=(2019, 2020)):
+    df = pd.DataFrame({'Jahr': list(years), 'Beruf': 'Beruf', 'Region': 'Bund'})
+    for i, col in enumerate(columns):
+        df[col] = [i * 10 + j for j in range(len(years))]
+    return df
+
+
+def test_join_attributes_with_suffixed_columns(tmp_path):
+    # the sheets of the second file already produced 'Insgesamt_a2', the suffix of its 'Insgesamt' collides with it
+    frames = [('a1', attribute(['Insgesamt'])), ('a2', attribute(['Insgesamt', 'Insgesamt_a2']))]
+    df = join_attributes(frames)
+    assert list(df.columns) == ['Jahr', 'Beruf', 'Region', 'Insgesamt', 'Insgesamt_a2', 'Insgesamt_a2.1']
+    assert df['Insgesamt_a2.1'].tolist() == [10, 11]
+    write_parquet(df, str(tmp_path / 'occ.parquet'))
+
+
+def test_join_attributes_with_repeated_years(tmp_path):
+    # repeated years are merged one after the other, the names have to be unique as well
+    frames = [('a1', attribute(['Insgesamt'], years=(2019, 2019))), ('a2', attribute(['Insgesamt', 'Insgesamt_a2']))]
+    df = join_attributes(frames)
+    assert df.columns.is_unique
+    write_parquet(df, str(tmp_path / 'occ.parquet'))
+
+
+def test_token_bucket_limits_the_rate():
+    bucket = TokenBucket(20.0)
+    start = time.monotonic()
+    for _ in range(5):
+        bucket.acquire()
+    # the first token is available at once, the other four take 1/20 s each
+    assert 0.18 <= time.monotonic() - start < 1.0
+
+
+def test_backoff_delay():
+    response = requests.Response()
+    response.headers['Retry-After'] = '3'
+    assert backoff_delay(0, response) == 3
+    response.headers['Retry-After'] = '120'
+    assert backoff_delay(0, response) == 60
+    assert 4 <= backoff_delay(3) <= 8
+    assert 30 <= backoff_delay(10) <= 60
+
+
+class DazubiStandIn(BaseHTTPRequestHandler):
+    """Serves one Excel file with an ETag, the first request fails with 503."""
+    content = workbook({'a': sheet(1)})
+    received = []
+
+    def do_GET(self):
+        self.received.append(self.headers.get('If-None-Match'))
+        if len(self.received) == 1:
+            self.send_response(503)
+            self.send_header('Retry-After', '0')
+            self.end_headers()
+        elif self.headers.get('If-None-Match') == '"v1"':
+            self.send_response(304)
+            self.end_headers()
+        else:
+            self.send_response(200)
+            self.send_header('ETag', '"v1"')
+            self.send_header('Content-Length', str(len(self.content)))
+            self.end_headers()
+            self.wfile.write(self.content)
+
+    def log_message(self, *args):
+        pass
+
+
+def test_fetch_cached_retries_and_sends_the_etag(tmp_path):
+    server = HTTPServer(('127.0.0.1', 0), DazubiStandIn)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        url = f'http://127.0.0.1:{server.server_port}/excel'
+        cache = DownloadCache(str(tmp_path))
+        key = ('7', '1', '0', '2023')
+        assert fetch_cached(cache, key, url, retries=2) == 'downloaded'
+        assert cache.read_blob(cache.entry(key)['sha256']) == DazubiStandIn.content
+        assert fetch_cached(cache, key, url, retries=2) == 'unchanged'
+        assert fetch_cached(cache, key, url, max_age=60) == 'cached'
+        # the 503 was retried, the second check was a conditional request
+        assert DazubiStandIn.received == [None, None, '"v1"']
+    finally:
+        server.shutdown()
+        server.server_close()
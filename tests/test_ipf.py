@@ -0,0 +1,91 @@
+import numpy as np
+import pytest
+
+from modeling.ipf import coo_to_dense, dense_to_coo, integerize_trs, ipf_nd, ipf_sparse
+
+TOL = 1e-8
+
+
+def marginals_of(arr):
+    return [np.einsum(arr, list(range(arr.ndim)), [d]) for d in range(arr.ndim)]
+
+
+def max_deviation(arr, marginals):
+    total = np.sum(marginals[0])
+    return max(np.abs(current - target).max() / total for current, target in zip(marginals_of(arr), marginals))
+
+
+@pytest.fixture
+def problem():
+    """A 3 x 4 x 2 seed with structural zeros and the (feasible) marginals of another table with the same zeros."""
+    rng = np.random.default_rng(0)
+    zeros = rng.random((3, 4, 2)) < 0.25
+    zeros[0, 0, 0] = True
+    seed = np.where(zeros, 0.0, rng.random((3, 4, 2)) + 0.1)
+    truth = np.where(zeros, 0.0, rng.random((3, 4, 2)) * 100 + 1)
+    return seed, marginals_of(truth)
+
+
+def test_ipf_nd_converges_to_the_marginals(problem):
+    seed, marginals = problem
+    fitted, iterations, deviation = ipf_nd(seed, marginals, tol=TOL, max_iter=1000, full_output=True)
+    assert deviation < TOL
+    assert iterations < 1000
+    assert max_deviation(fitted, marginals) < TOL
+
+
+def test_ipf_sparse_converges_and_agrees_with_ipf_nd(problem):
+    seed, marginals = problem
+    coords, values = dense_to_coo(seed)
+    fitted, _, deviation = ipf_sparse(coords, values, marginals, tol=TOL, max_iter=1000, full_output=True)
+    dense = coo_to_dense(coords, fitted, seed.shape)
+    assert deviation < TOL
+    assert max_deviation(dense, marginals) < TOL
+    np.testing.assert_allclose(dense, ipf_nd(seed, marginals, tol=TOL, max_iter=1000), rtol=1e-6, atol=1e-9)
+
+
+def test_structural_zeros_stay_zero(problem):
+    seed, marginals = problem
+    fitted = ipf_nd(seed, marginals, tol=TOL, max_iter=1000)
+    assert np.all(fitted[seed == 0] == 0)
+    assert np.all(fitted[seed > 0] > 0)
+    coords, values = dense_to_coo(seed)
+    assert np.all(coo_to_dense(coords, ipf_sparse(coords, values, marginals, tol=TOL, max_iter=1000), seed.shape)[seed == 0] == 0)
+
+
+def test_seed_is_not_modified(problem):
+    seed, marginals = problem
+    before = seed.copy()
+    ipf_nd(seed, marginals)
+    np.testing.assert_array_equal(seed, before)
+
+
+@pytest.mark.parametrize('n_marginals', [2, 4])
+def test_wrong_number_of_marginals(problem, n_marginals):
+    seed, marginals = problem
+    marginals = (marginals + [np.ones(2)])[:n_marginals]
+    with pytest.raises(ValueError):
+        ipf_nd(seed, marginals)
+    coords, values = dense_to_coo(seed)
+    with pytest.raises(ValueError):
+        ipf_sparse(coords, values, marginals)
+
+
+@pytest.mark.parametrize('size', [0, 1, 7, 100, 1001])
+def test_integerize_trs(size):
+    rng = np.random.default_rng(1)
+    weights = rng.random((5, 4)) * 10
+    weights[0, 0] = 0
+    counts = integerize_trs(weights, size, rng)
+    assert counts.shape == weights.shape
+    assert counts.dtype == np.int64
+    assert counts.sum() == size
+    assert np.all(np.abs(counts - weights * size / weights.sum()) < 1)
+    assert counts[0, 0] == 0
+
+
+@pytest.mark.parametrize('weights', [np.zeros(4), np.array([1.0, -1.0])])
+def test_integerize_trs_without_weight(weights):
+    counts = integerize_trs(weights, 10)
+    assert counts.sum() == 0
+    np.testing.assert_array_equal(counts, np.zeros(weights.shape, dtype=np.int64))
@@ -0,0 +1,33 @@
+import os
+
+import pandas as pd
+
+from modeling.scenario_engine import load_partial
+
+PARAMS = {'model': 'a', 'data': 'b', 'grid': [{'name': 'BAU_ALL'}], 'start_year': 2025, 'end_year': 2035,
+          'individuals': 5000, 'seed': 42, 'mode': 'individuals'}
+
+
+def write_cell(path):
+    pd.DataFrame({'scenario': ['BAU_ALL'], 'year': [2025], 'proportion_ones': [0.3]}).to_csv(path, index=False)
+
+
+def test_resume_with_the_same_parameters(tmp_path):
+    path = str(tmp_path / 'results.partial.csv')
+    assert load_partial(path, PARAMS) == set()
+    write_cell(path)
+    assert load_partial(path, PARAMS) == {('BAU_ALL', 2025)}
+
+
+def test_discard_a_partial_file_of_other_parameters(tmp_path):
+    path = str(tmp_path / 'results.partial.csv')
+    load_partial(path, PARAMS)
+    write_cell(path)
+    assert load_partial(path, {**PARAMS, 'mode': 'expected'}) == set()
+    assert not os.path.exists(path)
+
+
+def test_discard_a_partial_file_without_parameters(tmp_path):
+    path = str(tmp_path / 'results.partial.csv')
+    write_cell(path)
+    assert load_partial(path, PARAMS) == set()
@@ -0,0 +1,37 @@
+import os
+
+import pandas as pd
+
+from Dashboard.scenario_store import query_scenario_results, write_scenario_results
+
+
+def results(value):
+    return pd.DataFrame({
+        'scenario': ['BAU', 'EDU'], 'effect_size': [None, 10], 'region': [None, 'hh'],
+        'year': [2024, 2024], 'value': [value, value], 'series': [0, 1],
+    }).astype({'effect_size': 'Int16', 'year': 'int16', 'series': 'int32'})
+
+
+def test_the_store_is_replaced_by_switching_the_symlink(tmp_path):
+    root = tmp_path / 'scenario_results'
+    write_scenario_results(results(0.1), root)
+    first = os.path.realpath(root)
+    write_scenario_results(results(0.2), root)
+    second = os.path.realpath(root)
+    assert root.is_symlink() and first != second
+    # the previous version is kept for readers that are still reading it
+    assert os.path.isdir(first)
+    write_scenario_results(results(0.3), root)
+    assert not os.path.exists(first) and os.path.isdir(second)
+    assert sorted(path.name for path in tmp_path.iterdir()) == sorted(
+        ['scenario_results', os.path.basename(second), os.path.basename(os.path.realpath(root))])
+    assert (query_scenario_results(root=root)['value'] == 0.3).all()
+
+
+def test_a_store_written_as_a_directory_is_replaced(tmp_path):
+    root = tmp_path / 'scenario_results'
+    (root / 'scenario=BAU').mkdir(parents=True)
+    write_scenario_results(results(0.1), root)
+    assert root.is_symlink()
+    assert len(list(tmp_path.iterdir())) == 2
+    assert len(query_scenario_results(['EDU'], root=root)) == 1
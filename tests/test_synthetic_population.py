@@ -0,0 +1,48 @@
+import json
+import os
+
+import pytest
+
+from modeling.synthetic_population import GENERATION_FILE, GenerationMismatch, partition_path, prepare_output
+
+PARAMS = {'size': 1000, 'seed': 42, 'tol': 1e-6, 'max_iter': 100, 'expanded': False,
+          'marginals': {'new': {'age_new.csv': 'a'}}}
+
+
+def write_dummy_partition(root):
+    path = partition_path(root, 'new', 2019, 'Bayern')
+    os.makedirs(os.path.dirname(path))
+    open(path, 'wb').close()
+    return path
+
+
+def test_resume_with_the_same_parameters(tmp_path):
+    prepare_output(str(tmp_path), PARAMS)
+    path = write_dummy_partition(str(tmp_path))
+    prepare_output(str(tmp_path), PARAMS)
+    assert os.path.exists(path)
+
+
+@pytest.mark.parametrize('change', [{'seed': 1}, {'size': 500}, {'marginals': {'new': {'age_new.csv': 'b'}}}])
+def test_refuse_to_resume_with_other_parameters(tmp_path, change):
+    prepare_output(str(tmp_path), PARAMS)
+    path = write_dummy_partition(str(tmp_path))
+    with pytest.raises(GenerationMismatch):
+        prepare_output(str(tmp_path), {**PARAMS, **change})
+    assert os.path.exists(path)
+    prepare_output(str(tmp_path), {**PARAMS, **change}, overwrite=True)
+    assert not os.path.exists(path)
+
+
+def test_refuse_partitions_without_parameters(tmp_path):
+    write_dummy_partition(str(tmp_path))
+    with pytest.raises(GenerationMismatch):
+        prepare_output(str(tmp_path), PARAMS)
+
+
+def test_other_kinds_are_kept(tmp_path):
+    prepare_output(str(tmp_path), PARAMS)
+    write_dummy_partition(str(tmp_path))
+    prepare_output(str(tmp_path), {**PARAMS, 'marginals': {'term': {'age_term.csv': 'c'}}})
+    with open(tmp_path / GENERATION_FILE) as f:
+        assert json.load(f)['marginals'] == {'new': {'age_new.csv': 'a'}, 'term': {'age_term.csv': 'c'}}
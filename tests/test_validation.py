@@ -0,0 +1,41 @@
+import json
+
+import numpy as np
+import pytest
+
+from modeling.validation import check, compare, write_report
+
+
+@pytest.mark.parametrize('synthetic, target', [(np.zeros(3), np.ones(3)), (np.ones(3), np.zeros(3))])
+def test_empty_counts_have_no_kl(synthetic, target):
+    metrics = compare(synthetic, target)
+    assert metrics['kl'] is None
+    assert metrics['tae_share'] == 1.0
+
+
+def test_undefined_kl_fails_the_gate():
+    metrics = {'age': compare(np.zeros(3), np.ones(3)), 'gender': compare(np.ones(2), np.ones(2))}
+    assert check(metrics, max_tae_share=None, max_kl=0.02) == ['age: kl undefined (empty partition or target)']
+    assert check(metrics, max_tae_share=None, max_kl=None) == []
+
+
+def test_kl_is_only_reported_by_default():
+    metrics = {'sector': {'tae': 10.0, 'tae_share': 0.01, 'kl': 1.0}}
+    assert check(metrics) == []
+
+
+def test_a_small_category_sampled_to_zero_keeps_the_kl_small():
+    target = np.array([500.0, 300.0, 195.0, 5.0])
+    synthetic = np.array([502.0, 299.0, 199.0, 0.0])
+    metrics = compare(synthetic, target)
+    assert 0 < metrics['kl'] < 0.01
+    assert metrics['tae_share'] == pytest.approx(0.012)
+
+
+def test_report_is_valid_json(tmp_path):
+    path = tmp_path / 'report.json'
+    write_report({'marginals': {'age': compare(np.zeros(3), np.ones(3))}}, path)
+    with open(path) as f:
+        assert json.loads(f.read(), parse_constant=lambda constant: pytest.fail(constant))['marginals']['age']['kl'] is None
+    with pytest.raises(ValueError):
+        write_report({'kl': float('inf')}, tmp_path / 'invalid.json')